@@ -33,9 +33,14 @@
 
 namespace {
 
-const std::string default_params_path = Hardware::PC() ? util::getenv_default("HOME", "/.comma/params", "/data/params")
-                                                       : "/data/params";
-const std::string persistent_params_path = Hardware::PC() ? default_params_path : "/persist/comma/params";
+// resolved when Params are created, so a process can point HOME at its own params
+std::string default_params_path() {
+  return Hardware::PC() ? util::getenv_default("HOME", "/.comma/params", "/data/params") : "/data/params";
+}
+
+std::string persistent_params_path() {
+  return Hardware::PC() ? default_params_path() : "/persist/comma/params";
+}
 
 volatile sig_atomic_t params_do_exit = 0;
 void params_sig_handler(int signal) {
@@ -220,7 +225,7 @@ std::unordered_map<std::string, uint32_t> keys = {
 
 } // namespace
 
-Params::Params(bool persistent_param) : Params(persistent_param ? persistent_params_path : default_params_path) {}
+Params::Params(bool persistent_param) : Params(persistent_param ? persistent_params_path() : default_params_path()) {}
 
 Params::Params(const std::string &path) : params_path(path) {
   if (!ensure_params_path(params_path, params_path + "/d")) {
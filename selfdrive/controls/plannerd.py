@@ -9,38 +9,47 @@ from selfdrive.hardware import TICI
 import cereal.messaging as messaging
 
 
-def plannerd_thread(sm=None, pm=None):
-  config_realtime_process(5 if TICI else 2, Priority.CTRL_LOW)
+class Plannerd:
+  def __init__(self, sm=None, pm=None):
+    cloudlog.info("plannerd is waiting for CarParams")
+    params = Params()
+    self.CP = car.CarParams.from_bytes(params.get("CarParams", block=True))
+    cloudlog.info("plannerd got CarParams: %s", self.CP.carName)
+
+    use_lanelines = not params.get_bool('EndToEndToggle')
+    wide_camera = params.get_bool('EnableWideCamera') if TICI else False
+
+    cloudlog.event("e2e mode", on=use_lanelines)
 
-  cloudlog.info("plannerd is waiting for CarParams")
-  params = Params()
-  CP = car.CarParams.from_bytes(params.get("CarParams", block=True))
-  cloudlog.info("plannerd got CarParams: %s", CP.carName)
+    self.longitudinal_planner = Planner(self.CP)
+    self.lateral_planner = LateralPlanner(self.CP, use_lanelines=use_lanelines, wide_camera=wide_camera)
 
-  use_lanelines = not params.get_bool('EndToEndToggle')
-  wide_camera = params.get_bool('EnableWideCamera') if TICI else False
+    self.sm = sm
+    if self.sm is None:
+      self.sm = messaging.SubMaster(['carState', 'controlsState', 'radarState', 'modelV2'],
+                                    poll=['radarState', 'modelV2'], ignore_avg_freq=['radarState'])
 
-  cloudlog.event("e2e mode", on=use_lanelines)
+    self.pm = pm
+    if self.pm is None:
+      self.pm = messaging.PubMaster(['longitudinalPlan', 'liveLongitudinalMpc', 'lateralPlan', 'liveMpc'])
 
-  longitudinal_planner = Planner(CP)
-  lateral_planner = LateralPlanner(CP, use_lanelines=use_lanelines, wide_camera=wide_camera)
+  def step(self):
+    self.sm.update()
 
-  if sm is None:
-    sm = messaging.SubMaster(['carState', 'controlsState', 'radarState', 'modelV2'],
-                             poll=['radarState', 'modelV2'], ignore_avg_freq=['radarState'])
+    if self.sm.updated['modelV2']:
+      self.lateral_planner.update(self.sm, self.CP)
+      self.lateral_planner.publish(self.sm, self.pm)
+    if self.sm.updated['radarState']:
+      self.longitudinal_planner.update(self.sm, self.CP)
+      self.longitudinal_planner.publish(self.sm, self.pm)
 
-  if pm is None:
-    pm = messaging.PubMaster(['longitudinalPlan', 'liveLongitudinalMpc', 'lateralPlan', 'liveMpc'])
 
+def plannerd_thread(sm=None, pm=None):
+  config_realtime_process(5 if TICI else 2, Priority.CTRL_LOW)
+
+  plannerd = Plannerd(sm, pm)
   while True:
-    sm.update()
-
-    if sm.updated['modelV2']:
-      lateral_planner.update(sm, CP)
-      lateral_planner.publish(sm, pm)
-    if sm.updated['radarState']:
-      longitudinal_planner.update(sm, CP)
-      longitudinal_planner.publish(sm, pm)
+    plannerd.step()
 
 
 def main(sm=None, pm=None):
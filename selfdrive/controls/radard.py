@@ -173,50 +173,53 @@ class RadarD():
 
 
 # fuses camera and radar data for best lead detection
-def radard_thread(sm=None, pm=None, can_sock=None):
-  config_realtime_process(5 if TICI else 2, Priority.CTRL_LOW)
-
-  # wait for stats about the car to come in from controls
-  cloudlog.info("radard is waiting for CarParams")
-  CP = car.CarParams.from_bytes(Params().get("CarParams", block=True))
-  cloudlog.info("radard got CarParams")
-
-  # import the radar from the fingerprint
-  cloudlog.info("radard is importing %s", CP.carName)
-  RadarInterface = importlib.import_module('selfdrive.car.%s.radar_interface' % CP.carName).RadarInterface
-
-  # *** setup messaging
-  if can_sock is None:
-    can_sock = messaging.sub_sock('can')
-  if sm is None:
-    sm = messaging.SubMaster(['modelV2', 'carState'], ignore_avg_freq=['modelV2', 'carState'])  # Can't check average frequency, since radar determines timing
-  if pm is None:
-    pm = messaging.PubMaster(['radarState', 'liveTracks'])
-
-  RI = RadarInterface(CP)
-
-  rk = Ratekeeper(1.0 / CP.radarTimeStep, print_delay_threshold=None)
-  RD = RadarD(CP.radarTimeStep, RI.delay)
-
-  # TODO: always log leads once we can hide them conditionally
-  enable_lead = CP.openpilotLongitudinalControl or not CP.radarOffCan
-
-  while 1:
-    can_strings = messaging.drain_sock_raw(can_sock, wait_for_one=True)
-    rr = RI.update(can_strings)
+class RadardLoop:
+  def __init__(self, sm=None, pm=None, can_sock=None):
+    # wait for stats about the car to come in from controls
+    cloudlog.info("radard is waiting for CarParams")
+    CP = car.CarParams.from_bytes(Params().get("CarParams", block=True))
+    cloudlog.info("radard got CarParams")
+
+    # import the radar from the fingerprint
+    cloudlog.info("radard is importing %s", CP.carName)
+    RadarInterface = importlib.import_module('selfdrive.car.%s.radar_interface' % CP.carName).RadarInterface
+
+    # *** setup messaging
+    self.can_sock = can_sock
+    if self.can_sock is None:
+      self.can_sock = messaging.sub_sock('can')
+    self.sm = sm
+    if self.sm is None:
+      self.sm = messaging.SubMaster(['modelV2', 'carState'], ignore_avg_freq=['modelV2', 'carState'])  # Can't check average frequency, since radar determines timing
+    self.pm = pm
+    if self.pm is None:
+      self.pm = messaging.PubMaster(['radarState', 'liveTracks'])
+
+    self.RI = RadarInterface(CP)
+
+    self.rk = Ratekeeper(1.0 / CP.radarTimeStep, print_delay_threshold=None)
+    self.RD = RadarD(CP.radarTimeStep, self.RI.delay)
+
+    # TODO: always log leads once we can hide them conditionally
+    self.enable_lead = CP.openpilotLongitudinalControl or not CP.radarOffCan
+
+  def step(self):
+    """Returns False if the can msgs didn't complete a radar frame"""
+    can_strings = messaging.drain_sock_raw(self.can_sock, wait_for_one=True)
+    rr = self.RI.update(can_strings)
 
     if rr is None:
-      continue
+      return False
 
-    sm.update(0)
+    self.sm.update(0)
 
-    dat = RD.update(sm, rr, enable_lead)
-    dat.radarState.cumLagMs = -rk.remaining*1000.
+    dat = self.RD.update(self.sm, rr, self.enable_lead)
+    dat.radarState.cumLagMs = -self.rk.remaining*1000.
 
-    pm.send('radarState', dat)
+    self.pm.send('radarState', dat)
 
     # *** publish tracks for UI debugging (keep last) ***
-    tracks = RD.tracks
+    tracks = self.RD.tracks
     dat = messaging.new_message('liveTracks', len(tracks))
 
     for cnt, ids in enumerate(sorted(tracks.keys())):
@@ -226,9 +229,17 @@ def radard_thread(sm=None, pm=None, can_sock=None):
         "yRel": float(tracks[ids].yRel),
         "vRel": float(tracks[ids].vRel),
       }
-    pm.send('liveTracks', dat)
+    self.pm.send('liveTracks', dat)
+    return True
 
-    rk.monitor_time()
+
+def radard_thread(sm=None, pm=None, can_sock=None):
+  config_realtime_process(5 if TICI else 2, Priority.CTRL_LOW)
+
+  radard = RadardLoop(sm, pm, can_sock)
+  while 1:
+    if radard.step():
+      radard.rk.monitor_time()
 
 
 def main(sm=None, pm=None, can_sock=None):
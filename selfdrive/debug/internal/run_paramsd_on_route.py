@@ -4,38 +4,23 @@
 # type: ignore
 
 import math
-import multiprocessing
 
 import numpy as np
 from tqdm import tqdm
 
 from selfdrive.locationd.paramsd import ParamsLearner, States
-from tools.lib.logreader import LogReader
+from tools.lib.logreader import PrefetchLogIterator
 from tools.lib.route import Route
 
 ROUTE = "b2f1615665781088|2021-03-14--17-27-47"
 PLOT = True
 
 
-def load_segment(segment_name):
-  print(f"Loading {segment_name}")
-  if segment_name is None:
-    return []
-
-  try:
-    return list(LogReader(segment_name))
-  except ValueError as e:
-    print(f"Error parsing {segment_name}: {e}")
-    return []
-
-
 if __name__ == "__main__":
   route = Route(ROUTE)
 
-  msgs = []
-  with multiprocessing.Pool(24) as pool:
-    for d in pool.map(load_segment, route.log_paths()):
-      msgs += d
+  msgs = [m for m in PrefetchLogIterator(route.log_paths())
+          if m.which() in ('carParams', 'liveLocationKalman', 'carState', 'liveParameters')]
 
   for m in msgs:
     if m.which() == 'carParams':
@@ -63,7 +48,6 @@ if __name__ == "__main__":
   print(params)
   learner = ParamsLearner(CP, params['steerRatio'], params['stiffnessFactor'], math.radians(params['angleOffsetAverageDeg']))
   msgs = [m for m in tqdm(msgs) if m.which() in ('liveLocationKalman', 'carState', 'liveParameters')]
-  msgs = sorted(msgs, key=lambda m: m.logMonoTime)
 
   ts = []
   ts_log = []
@@ -181,32 +181,41 @@ class Calibrator():
     pm.send('liveCalibration', self.get_msg())
 
 
-def calibrationd_thread(sm=None, pm=None):
-  if sm is None:
-    sm = messaging.SubMaster(['cameraOdometry', 'carState'], poll=['cameraOdometry'])
+class Calibrationd:
+  def __init__(self, sm=None, pm=None):
+    self.sm = sm
+    if self.sm is None:
+      self.sm = messaging.SubMaster(['cameraOdometry', 'carState'], poll=['cameraOdometry'])
 
-  if pm is None:
-    pm = messaging.PubMaster(['liveCalibration'])
+    self.pm = pm
+    if self.pm is None:
+      self.pm = messaging.PubMaster(['liveCalibration'])
 
-  calibrator = Calibrator(param_put=True)
+    self.calibrator = Calibrator(param_put=True)
 
-  while 1:
-    timeout = 0 if sm.frame == -1 else 100
-    sm.update(timeout)
+  def step(self):
+    timeout = 0 if self.sm.frame == -1 else 100
+    self.sm.update(timeout)
 
-    if sm.updated['cameraOdometry']:
-      calibrator.handle_v_ego(sm['carState'].vEgo)
-      new_rpy = calibrator.handle_cam_odom(sm['cameraOdometry'].trans,
-                                           sm['cameraOdometry'].rot,
-                                           sm['cameraOdometry'].transStd,
-                                           sm['cameraOdometry'].rotStd)
+    if self.sm.updated['cameraOdometry']:
+      self.calibrator.handle_v_ego(self.sm['carState'].vEgo)
+      new_rpy = self.calibrator.handle_cam_odom(self.sm['cameraOdometry'].trans,
+                                                self.sm['cameraOdometry'].rot,
+                                                self.sm['cameraOdometry'].transStd,
+                                                self.sm['cameraOdometry'].rotStd)
 
       if DEBUG and new_rpy is not None:
         print('got new rpy', new_rpy)
 
     # 4Hz driven by cameraOdometry
-    if sm.frame % 5 == 0:
-      calibrator.send_data(pm)
+    if self.sm.frame % 5 == 0:
+      self.calibrator.send_data(self.pm)
+
+
+def calibrationd_thread(sm=None, pm=None):
+  calibrationd = Calibrationd(sm, pm)
+  while 1:
+    calibrationd.step()
 
 
 def main(sm=None, pm=None):
@@ -71,80 +71,82 @@ class ParamsLearner:
       self.kf.filter.reset_rewind()
 
 
-def main(sm=None, pm=None):
-  gc.disable()
+class Paramsd:
+  def __init__(self, sm=None, pm=None):
+    self.sm = sm
+    if self.sm is None:
+      self.sm = messaging.SubMaster(['liveLocationKalman', 'carState'], poll=['liveLocationKalman'])
+    self.pm = pm
+    if self.pm is None:
+      self.pm = messaging.PubMaster(['liveParameters'])
+
+    params_reader = Params()
+    # wait for stats about the car to come in from controls
+    cloudlog.info("paramsd is waiting for CarParams")
+    self.CP = car.CarParams.from_bytes(params_reader.get("CarParams", block=True))
+    cloudlog.info("paramsd got CarParams")
+
+    self.min_sr, self.max_sr = 0.5 * self.CP.steerRatio, 2.0 * self.CP.steerRatio
+
+    params = params_reader.get("LiveParameters")
+
+    # Check if car model matches
+    if params is not None:
+      params = json.loads(params)
+      if params.get('carFingerprint', None) != self.CP.carFingerprint:
+        cloudlog.info("Parameter learner found parameters for wrong car.")
+        params = None
 
-  if sm is None:
-    sm = messaging.SubMaster(['liveLocationKalman', 'carState'], poll=['liveLocationKalman'])
-  if pm is None:
-    pm = messaging.PubMaster(['liveParameters'])
-
-  params_reader = Params()
-  # wait for stats about the car to come in from controls
-  cloudlog.info("paramsd is waiting for CarParams")
-  CP = car.CarParams.from_bytes(params_reader.get("CarParams", block=True))
-  cloudlog.info("paramsd got CarParams")
-
-  min_sr, max_sr = 0.5 * CP.steerRatio, 2.0 * CP.steerRatio
-
-  params = params_reader.get("LiveParameters")
-
-  # Check if car model matches
-  if params is not None:
-    params = json.loads(params)
-    if params.get('carFingerprint', None) != CP.carFingerprint:
-      cloudlog.info("Parameter learner found parameters for wrong car.")
-      params = None
-
-  # Check if starting values are sane
-  if params is not None:
-    try:
-      angle_offset_sane = abs(params.get('angleOffsetAverageDeg')) < 10.0
-      steer_ratio_sane = min_sr <= params['steerRatio'] <= max_sr
-      params_sane = angle_offset_sane and steer_ratio_sane
-      if not params_sane:
-        cloudlog.info(f"Invalid starting values found {params}")
+    # Check if starting values are sane
+    if params is not None:
+      try:
+        angle_offset_sane = abs(params.get('angleOffsetAverageDeg')) < 10.0
+        steer_ratio_sane = self.min_sr <= params['steerRatio'] <= self.max_sr
+        params_sane = angle_offset_sane and steer_ratio_sane
+        if not params_sane:
+          cloudlog.info(f"Invalid starting values found {params}")
+          params = None
+      except Exception as e:
+        cloudlog.info(f"Error reading params {params}: {str(e)}")
         params = None
-    except Exception as e:
-      cloudlog.info(f"Error reading params {params}: {str(e)}")
-      params = None
 
-  # TODO: cache the params with the capnp struct
-  if params is None:
-    params = {
-      'carFingerprint': CP.carFingerprint,
-      'steerRatio': CP.steerRatio,
-      'stiffnessFactor': 1.0,
-      'angleOffsetAverageDeg': 0.0,
-    }
-    cloudlog.info("Parameter learner resetting to default values")
+    # TODO: cache the params with the capnp struct
+    if params is None:
+      params = {
+        'carFingerprint': self.CP.carFingerprint,
+        'steerRatio': self.CP.steerRatio,
+        'stiffnessFactor': 1.0,
+        'angleOffsetAverageDeg': 0.0,
+      }
+      cloudlog.info("Parameter learner resetting to default values")
 
-  # When driving in wet conditions the stiffness can go down, and then be too low on the next drive
-  # Without a way to detect this we have to reset the stiffness every drive
-  params['stiffnessFactor'] = 1.0
+    # When driving in wet conditions the stiffness can go down, and then be too low on the next drive
+    # Without a way to detect this we have to reset the stiffness every drive
+    params['stiffnessFactor'] = 1.0
 
-  learner = ParamsLearner(CP, params['steerRatio'], params['stiffnessFactor'], math.radians(params['angleOffsetAverageDeg']))
+    self.learner = ParamsLearner(self.CP, params['steerRatio'], params['stiffnessFactor'], math.radians(params['angleOffsetAverageDeg']))
 
-  angle_offset_average = params['angleOffsetAverageDeg']
-  angle_offset = angle_offset_average
+    self.angle_offset_average = params['angleOffsetAverageDeg']
+    self.angle_offset = self.angle_offset_average
 
-  while True:
+  def step(self):
+    sm = self.sm
     sm.update()
 
     for which, updated in sm.updated.items():
       if updated:
         t = sm.logMonoTime[which] * 1e-9
-        learner.handle_log(t, which, sm[which])
+        self.learner.handle_log(t, which, sm[which])
 
     if sm.updated['liveLocationKalman']:
-      x = learner.kf.x
+      x = self.learner.kf.x
       if not all(map(math.isfinite, x)):
         cloudlog.error("NaN in liveParameters estimate. Resetting to default values")
-        learner = ParamsLearner(CP, CP.steerRatio, 1.0, 0.0)
-        x = learner.kf.x
+        self.learner = ParamsLearner(self.CP, self.CP.steerRatio, 1.0, 0.0)
+        x = self.learner.kf.x
 
-      angle_offset_average = clip(math.degrees(x[States.ANGLE_OFFSET]), angle_offset_average - MAX_ANGLE_OFFSET_DELTA, angle_offset_average + MAX_ANGLE_OFFSET_DELTA)
-      angle_offset = clip(math.degrees(x[States.ANGLE_OFFSET] + x[States.ANGLE_OFFSET_FAST]), angle_offset - MAX_ANGLE_OFFSET_DELTA, angle_offset + MAX_ANGLE_OFFSET_DELTA)
+      self.angle_offset_average = clip(math.degrees(x[States.ANGLE_OFFSET]), self.angle_offset_average - MAX_ANGLE_OFFSET_DELTA, self.angle_offset_average + MAX_ANGLE_OFFSET_DELTA)
+      self.angle_offset = clip(math.degrees(x[States.ANGLE_OFFSET] + x[States.ANGLE_OFFSET_FAST]), self.angle_offset - MAX_ANGLE_OFFSET_DELTA, self.angle_offset + MAX_ANGLE_OFFSET_DELTA)
 
       msg = messaging.new_message('liveParameters')
       msg.logMonoTime = sm.logMonoTime['carState']
@@ -153,25 +155,33 @@ def main(sm=None, pm=None):
       msg.liveParameters.sensorValid = True
       msg.liveParameters.steerRatio = float(x[States.STEER_RATIO])
       msg.liveParameters.stiffnessFactor = float(x[States.STIFFNESS])
-      msg.liveParameters.angleOffsetAverageDeg = angle_offset_average
-      msg.liveParameters.angleOffsetDeg = angle_offset
+      msg.liveParameters.angleOffsetAverageDeg = self.angle_offset_average
+      msg.liveParameters.angleOffsetDeg = self.angle_offset
       msg.liveParameters.valid = all((
         abs(msg.liveParameters.angleOffsetAverageDeg) < 10.0,
         abs(msg.liveParameters.angleOffsetDeg) < 10.0,
         0.2 <= msg.liveParameters.stiffnessFactor <= 5.0,
-        min_sr <= msg.liveParameters.steerRatio <= max_sr,
+        self.min_sr <= msg.liveParameters.steerRatio <= self.max_sr,
       ))
 
       if sm.frame % 1200 == 0:  # once a minute
         params = {
-          'carFingerprint': CP.carFingerprint,
+          'carFingerprint': self.CP.carFingerprint,
           'steerRatio': msg.liveParameters.steerRatio,
           'stiffnessFactor': msg.liveParameters.stiffnessFactor,
           'angleOffsetAverageDeg': msg.liveParameters.angleOffsetAverageDeg,
         }
         put_nonblocking("LiveParameters", json.dumps(params))
 
-      pm.send('liveParameters', msg)
+      self.pm.send('liveParameters', msg)
+
+
+def main(sm=None, pm=None):
+  gc.disable()
+
+  paramsd = Paramsd(sm, pm)
+  while True:
+    paramsd.step()
 
 
 if __name__ == "__main__":
@@ -7,74 +7,85 @@ from selfdrive.monitoring.driver_monitor import DriverStatus, MAX_TERMINAL_ALERT
 from selfdrive.locationd.calibrationd import Calibration
 
 
-def dmonitoringd_thread(sm=None, pm=None):
-  if pm is None:
-    pm = messaging.PubMaster(['driverMonitoringState'])
+class DMonitoringd:
+  def __init__(self, sm=None, pm=None):
+    self.pm = pm
+    if self.pm is None:
+      self.pm = messaging.PubMaster(['driverMonitoringState'])
 
-  if sm is None:
-    sm = messaging.SubMaster(['driverState', 'liveCalibration', 'carState', 'controlsState', 'modelV2'], poll=['driverState'])
+    self.sm = sm
+    if self.sm is None:
+      self.sm = messaging.SubMaster(['driverState', 'liveCalibration', 'carState', 'controlsState', 'modelV2'], poll=['driverState'])
 
-  driver_status = DriverStatus(rhd=Params().get_bool("IsRHD"))
+    self.driver_status = DriverStatus(rhd=Params().get_bool("IsRHD"))
 
-  sm['liveCalibration'].calStatus = Calibration.INVALID
-  sm['liveCalibration'].rpyCalib = [0, 0, 0]
-  sm['carState'].buttonEvents = []
-  sm['carState'].standstill = True
+    self.sm['liveCalibration'].calStatus = Calibration.INVALID
+    self.sm['liveCalibration'].rpyCalib = [0, 0, 0]
+    self.sm['carState'].buttonEvents = []
+    self.sm['carState'].standstill = True
 
-  v_cruise_last = 0
-  driver_engaged = False
+    self.v_cruise_last = 0
+    self.driver_engaged = False
 
-  # 10Hz <- dmonitoringmodeld
-  while True:
-    sm.update()
+  def step(self):
+    self.sm.update()
 
-    if not sm.updated['driverState']:
-      continue
+    if not self.sm.updated['driverState']:
+      return
 
     # Get interaction
-    if sm.updated['carState']:
-      v_cruise = sm['carState'].cruiseState.speed
-      driver_engaged = len(sm['carState'].buttonEvents) > 0 or \
-                        v_cruise != v_cruise_last or \
-                        sm['carState'].steeringPressed or \
-                        sm['carState'].gasPressed
-      if driver_engaged:
-        driver_status.update(Events(), True, sm['controlsState'].enabled, sm['carState'].standstill)
-      v_cruise_last = v_cruise
-
-    if sm.updated['modelV2']:
-      driver_status.set_policy(sm['modelV2'])
+    if self.sm.updated['carState']:
+      v_cruise = self.sm['carState'].cruiseState.speed
+      self.driver_engaged = len(self.sm['carState'].buttonEvents) > 0 or \
+                            v_cruise != self.v_cruise_last or \
+                            self.sm['carState'].steeringPressed or \
+                            self.sm['carState'].gasPressed
+      if self.driver_engaged:
+        self.driver_status.update(Events(), True, self.sm['controlsState'].enabled, self.sm['carState'].standstill)
+      self.v_cruise_last = v_cruise
+
+    if self.sm.updated['modelV2']:
+      self.driver_status.set_policy(self.sm['modelV2'])
 
     # Get data from dmonitoringmodeld
     events = Events()
-    driver_status.get_pose(sm['driverState'], sm['liveCalibration'].rpyCalib, sm['carState'].vEgo, sm['controlsState'].enabled)
+    self.driver_status.get_pose(self.sm['driverState'], self.sm['liveCalibration'].rpyCalib, self.sm['carState'].vEgo, self.sm['controlsState'].enabled)
 
     # Block engaging after max number of distrations
-    if driver_status.terminal_alert_cnt >= MAX_TERMINAL_ALERTS or driver_status.terminal_time >= MAX_TERMINAL_DURATION:
+    if self.driver_status.terminal_alert_cnt >= MAX_TERMINAL_ALERTS or self.driver_status.terminal_time >= MAX_TERMINAL_DURATION:
       events.add(car.CarEvent.EventName.tooDistracted)
 
     # Update events from driver state
-    driver_status.update(events, driver_engaged, sm['controlsState'].enabled, sm['carState'].standstill)
+    self.driver_status.update(events, self.driver_engaged, self.sm['controlsState'].enabled, self.sm['carState'].standstill)
 
     # build driverMonitoringState packet
     dat = messaging.new_message('driverMonitoringState')
     dat.driverMonitoringState = {
       "events": events.to_msg(),
-      "faceDetected": driver_status.face_detected,
-      "isDistracted": driver_status.driver_distracted,
-      "awarenessStatus": driver_status.awareness,
-      "posePitchOffset": driver_status.pose.pitch_offseter.filtered_stat.mean(),
-      "posePitchValidCount": driver_status.pose.pitch_offseter.filtered_stat.n,
-      "poseYawOffset": driver_status.pose.yaw_offseter.filtered_stat.mean(),
-      "poseYawValidCount": driver_status.pose.yaw_offseter.filtered_stat.n,
-      "stepChange": driver_status.step_change,
-      "awarenessActive": driver_status.awareness_active,
-      "awarenessPassive": driver_status.awareness_passive,
-      "isLowStd": driver_status.pose.low_std,
-      "hiStdCount": driver_status.hi_stds,
-      "isActiveMode": driver_status.active_monitoring_mode,
+      "faceDetected": self.driver_status.face_detected,
+      "isDistracted": self.driver_status.driver_distracted,
+      "awarenessStatus": self.driver_status.awareness,
+      "posePitchOffset": self.driver_status.pose.pitch_offseter.filtered_stat.mean(),
+      "posePitchValidCount": self.driver_status.pose.pitch_offseter.filtered_stat.n,
+      "poseYawOffset": self.driver_status.pose.yaw_offseter.filtered_stat.mean(),
+      "poseYawValidCount": self.driver_status.pose.yaw_offseter.filtered_stat.n,
+      "stepChange": self.driver_status.step_change,
+      "awarenessActive": self.driver_status.awareness_active,
+      "awarenessPassive": self.driver_status.awareness_passive,
+      "isLowStd": self.driver_status.pose.low_std,
+      "hiStdCount": self.driver_status.hi_stds,
+      "isActiveMode": self.driver_status.active_monitoring_mode,
     }
-    pm.send('driverMonitoringState', dat)
+    self.pm.send('driverMonitoringState', dat)
+
+
+def dmonitoringd_thread(sm=None, pm=None):
+  dmonitoringd = DMonitoringd(sm, pm)
+
+  # 10Hz <- dmonitoringmodeld
+  while True:
+    dmonitoringd.step()
+
 
 def main(sm=None, pm=None):
   dmonitoringd_thread(sm, pm)
@@ -0,0 +1,108 @@
+"""Local cache of the CAN msgs of a log, packed into numpy arrays.
+
+Only the can events are kept. Their frames are stored in log order as flat
+columns (address, busTime, src, length) plus one buffer with all the data
+bytes, so a cached segment is a few MB that loads without bz2 or capnp.
+
+Frames aren't grouped by bus: the car and panda safety tests have to see
+them in the order they were logged. Per bus lookups, like the fingerprint,
+select on the src column instead.
+"""
+import hashlib
+import os
+
+import numpy as np
+
+from cereal import log as capnp_log
+from tools.lib.cache import DEFAULT_CACHE_DIR
+from tools.lib.file_helpers import atomic_write_in_dir, mkdirs_exists_ok
+from tools.lib.logreader import LogReader
+
+CACHE_DIR = os.environ.get("CAN_CACHE_DIR", os.path.join(DEFAULT_CACHE_DIR, "can"))
+
+# bump when the packed format changes
+CACHE_VERSION = 1
+
+FIELDS = ("mono_times", "valid", "counts", "address", "bus_time", "src", "length", "dat")
+
+
+class PackedCan(object):
+  def __init__(self, mono_times, valid, counts, address, bus_time, src, length, dat):
+    # per can event
+    self.mono_times = mono_times
+    self.valid = valid
+    self.counts = counts
+    # per frame
+    self.address = address
+    self.bus_time = bus_time
+    self.src = src
+    self.length = length
+    # data bytes of all frames
+    self.dat = dat
+
+    self.frame_offsets = np.concatenate(([0], np.cumsum(counts, dtype=np.int64)))
+    self.dat_offsets = np.concatenate(([0], np.cumsum(length, dtype=np.int64)))
+
+  @classmethod
+  def from_msgs(cls, msgs):
+    can = sorted((m for m in msgs if m.which() == "can"), key=lambda m: m.logMonoTime)
+    frames = [f for m in can for f in m.can]
+    dats = [f.dat for f in frames]
+    return cls(
+      mono_times=np.array([m.logMonoTime for m in can], dtype=np.uint64),
+      valid=np.array([m.valid for m in can], dtype=bool),
+      counts=np.array([len(m.can) for m in can], dtype=np.uint32),
+      address=np.array([f.address for f in frames], dtype=np.uint32),
+      bus_time=np.array([f.busTime for f in frames], dtype=np.uint16),
+      src=np.array([f.src for f in frames], dtype=np.uint8),
+      length=np.array([len(d) for d in dats], dtype=np.uint8),
+      dat=np.frombuffer(b"".join(dats), dtype=np.uint8),
+    )
+
+  @classmethod
+  def load(cls, path):
+    with np.load(path) as npz:
+      return cls(**{k: npz[k] for k in FIELDS})
+
+  def save(self, path):
+    mkdirs_exists_ok(os.path.dirname(path))
+    with atomic_write_in_dir(path, mode="wb", overwrite=True) as f:
+      np.savez(f, **{k: getattr(self, k) for k in FIELDS})
+
+  def __len__(self):
+    return len(self.mono_times)
+
+  def fingerprint(self):
+    """Returns address -> data length for each bus, skipping the msgs sent by openpilot."""
+    fingerprint = {i: dict() for i in range(3)}
+    for bus in np.unique(self.src):
+      if bus >= 128:
+        continue
+      mask = self.src == bus
+      # a later length of the same address wins, like filling the dict in log order
+      fingerprint[int(bus)] = dict(zip(self.address[mask].tolist(), self.length[mask].tolist()))
+    return fingerprint
+
+  def __iter__(self):
+    """Yields each can event serialized, and its frames as (address, busTime, dat, src)."""
+    address, bus_time, src = self.address.tolist(), self.bus_time.tolist(), self.src.tolist()
+    dat, dat_offsets, frame_offsets = self.dat.tobytes(), self.dat_offsets.tolist(), self.frame_offsets.tolist()
+    for i, (mono_time, valid) in enumerate(zip(self.mono_times.tolist(), self.valid.tolist())):
+      frames = [(address[j], bus_time[j], dat[dat_offsets[j]:dat_offsets[j+1]], src[j])
+                for j in range(frame_offsets[i], frame_offsets[i+1])]
+
+      evt = capnp_log.Event.new_message(logMonoTime=mono_time, valid=valid)
+      for c, f in zip(evt.init("can", len(frames)), frames):
+        c.address, c.busTime, c.dat, c.src = f
+      yield evt.to_bytes(), frames
+
+
+def load_can(fn, cache_dir=CACHE_DIR):
+  """Returns the PackedCan of the log at fn, which is only read the first time."""
+  path = os.path.join(cache_dir, f"v{CACHE_VERSION}", hashlib.sha256(fn.encode()).hexdigest() + ".npz")
+  if os.path.exists(path):
+    return PackedCan.load(path)
+
+  can = PackedCan.from_msgs(LogReader(fn))
+  can.save(path)
+  return can
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+import os
+import sys
+import tempfile
+import time
+
+from selfdrive.test.process_replay.log_store import LogStore
+from selfdrive.test.process_replay.process_replay import CONFIGS
+from selfdrive.test.process_replay.test_processes import BASE_URL, get_segment, segments
+from tools.lib.logreader import LogReader
+
+
+def log_names(segment, ref_commit):
+  # the input and the refs of a segment, as test_processes loads them
+  yield segment, get_segment(segment)
+  for cfg in CONFIGS:
+    name = "%s_%s_%s.bz2" % (segment, cfg.proc_name, ref_commit)
+    yield name, BASE_URL + name
+
+
+def load_time(load, segment, ref_commit):
+  t = time.monotonic()
+  num_msgs = sum(len(load(name, fn)) for name, fn in log_names(segment, ref_commit))
+  return num_msgs, time.monotonic() - t
+
+
+if __name__ == "__main__":
+  segment = sys.argv[1] if len(sys.argv) > 1 else segments[0][1]
+  process_replay_dir = os.path.dirname(os.path.abspath(__file__))
+  with open(os.path.join(process_replay_dir, "ref_commit")) as f:
+    ref_commit = f.read().strip()
+
+  num_msgs, logreader_time = load_time(lambda name, fn: list(LogReader(fn)), segment, ref_commit)
+  with tempfile.TemporaryDirectory() as store_dir:
+    store = LogStore(store_dir)
+    _, cold_time = load_time(store.load, segment, ref_commit)
+    _, warm_time = load_time(store.load, segment, ref_commit)
+
+  print(f"{segment}: input and {len(CONFIGS)} refs, {num_msgs} msgs")
+  print(f"\tLogReader:  {logreader_time:.2f}s")
+  print(f"\tcold store: {cold_time:.2f}s")
+  print(f"\twarm store: {warm_time:.2f}s ({logreader_time / warm_time:.1f}x)")
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import sys
+
+import numpy as np
+
+from selfdrive.test.process_replay.process_replay import CONFIGS, replay_process
+from selfdrive.test.process_replay.test_processes import get_segment, segments
+from tools.lib.logreader import LogReader
+
+# fixed, so numbers are comparable between runs
+BENCHMARK_SEGMENTS = [dict(segments)[car] for car in ("TOYOTA", "HONDA")]
+
+# relative change counted as a regression
+THRESHOLD = 0.1
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+
+# metric -> whether higher is better
+METRICS = {
+  "msgs_per_sec": True,
+  "latency_p50_ms": False,
+  "latency_p99_ms": False,
+  "peak_rss_mb": False,
+}
+
+
+def read_status_kb(field):
+  # VmRSS is the current RSS, VmHWM its peak since the last reset
+  with open("/proc/self/status") as f:
+    for line in f:
+      if line.startswith(field + ":"):
+        return int(line.split()[1])
+  raise KeyError(field)
+
+
+def benchmark_segment(proc_name, log_path, conn):
+  cfg = next(cfg for cfg in CONFIGS if cfg.proc_name == proc_name)
+
+  rss = read_status_kb("VmRSS")
+  lr = list(LogReader(log_path))
+  logs_rss = read_status_kb("VmRSS") - rss
+
+  # only count the peak while replaying, not while decompressing the log
+  with open("/proc/self/clear_refs", "w") as f:
+    f.write("5")
+
+  latencies, replay_times = [], []
+  replay_process(cfg, lr, latencies=latencies, replay_times=replay_times)
+
+  if cfg.fake_pubsubmaster:
+    # python processes run in this interpreter, next to the log they're replaying
+    peak_rss = read_status_kb("VmHWM") - logs_rss
+  else:
+    # native processes are children, which are reaped by the time the replay is done
+    peak_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+  conn.send({
+    "msgs": sum(msg.which() in cfg.pub_sub for msg in lr),
+    "seconds": sum(replay_times),
+    "latencies": latencies,
+    "peak_rss_kb": peak_rss,
+  })
+
+
+def run_segment(proc_name, log_path):
+  # every segment gets a fresh interpreter, so the peak RSS is its own
+  ctx = multiprocessing.get_context("spawn")
+  recv_conn, send_conn = ctx.Pipe(duplex=False)
+  proc = ctx.Process(target=benchmark_segment, args=(proc_name, log_path, send_conn))
+  proc.start()
+  send_conn.close()
+  try:
+    return recv_conn.recv()
+  except EOFError:
+    raise Exception(f"{proc_name} benchmark failed on {log_path}") from None
+  finally:
+    proc.join()
+
+
+def run_benchmark(proc_name, logs):
+  segment_results = [run_segment(proc_name, log_path) for log_path in logs]
+
+  msgs = sum(r["msgs"] for r in segment_results)
+  seconds = sum(r["seconds"] for r in segment_results)
+  latencies = [l for r in segment_results for l in r["latencies"]]
+  p50, p99 = np.percentile(latencies, [50, 99]) * 1e3
+  return {
+    "msgs": msgs,
+    "seconds": seconds,
+    "msgs_per_sec": msgs / seconds,
+    "latency_p50_ms": p50,
+    "latency_p99_ms": p99,
+    "peak_rss_mb": max(r["peak_rss_kb"] for r in segment_results) / 1024,
+  }
+
+
+def compare(results, baseline, threshold=THRESHOLD):
+  """Returns a line per metric, and whether any of them regressed."""
+  lines, regressed = [], False
+  for proc_name, result in results.items():
+    if proc_name not in baseline:
+      # reported, but only checked once a baseline is recorded for it
+      lines.append(f"{proc_name}: not in baseline, skipped. Record it with --update-baseline")
+      continue
+
+    for metric, higher_is_better in METRICS.items():
+      new, old = result[metric], baseline[proc_name][metric]
+      change = (new - old) / old if old else 0.
+      worse = -change if higher_is_better else change
+
+      line = f"{proc_name} {metric}: {old:.2f} -> {new:.2f} ({change:+.1%})"
+      if worse > threshold:
+        line += " REGRESSION"
+        regressed = True
+      lines.append(line)
+  return lines, regressed
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Benchmark how fast each process replays")
+  parser.add_argument("--segments", type=str, nargs="*", default=BENCHMARK_SEGMENTS,
+                      help="Segment names or local rlog paths to replay")
+  parser.add_argument("--procs", type=str, nargs="*", default=[cfg.proc_name for cfg in CONFIGS],
+                      help="Processes to benchmark (e.g. controlsd)")
+  parser.add_argument("--output", type=str, default="process_replay_benchmark.json",
+                      help="Where to write the results as JSON")
+  parser.add_argument("--compare", type=str, default=BASELINE,
+                      help="Baseline JSON from an earlier run to check for regressions")
+  parser.add_argument("--update-baseline", action="store_true",
+                      help="Write the results to the baseline instead of comparing against it")
+  parser.add_argument("--threshold", type=float, default=THRESHOLD,
+                      help="Relative change of a metric that counts as a regression")
+  args = parser.parse_args()
+
+  logs = [s if os.path.exists(s) else get_segment(s) for s in args.segments]
+
+  results = {}
+  for proc_name in args.procs:
+    print(f"***** benchmarking {proc_name} *****")
+    results[proc_name] = run_benchmark(proc_name, logs)
+    print(json.dumps(results[proc_name], indent=2))
+
+  with open(args.output, "w") as f:
+    json.dump({"segments": args.segments, "processes": results}, f, indent=2)
+  print(f"results written to {args.output}")
+
+  if args.update_baseline:
+    with open(BASELINE, "w") as f:
+      json.dump({"segments": args.segments, "processes": results}, f, indent=2)
+      f.write("\n")
+    print(f"baseline updated: {BASELINE}")
+    sys.exit(0)
+
+  with open(args.compare) as f:
+    baseline = json.load(f)
+  if baseline["segments"] != args.segments:
+    print("WARNING: baseline was run on different segments")
+
+  lines, regressed = compare(results, baseline["processes"], args.threshold)
+  print("\n".join(lines))
+  print("BENCHMARK REGRESSED" if regressed else "BENCHMARK PASSED")
+  sys.exit(int(regressed))
@@ -3,9 +3,12 @@ import bz2
 import os
 import sys
 import numbers
-import dictdiffer
+import multiprocessing
 from collections import Counter
 
+import capnp
+import numpy as np
+
 if "CI" in os.environ:
   def tqdm(x):
     return x
@@ -15,48 +18,157 @@ else:
 from tools.lib.logreader import LogReader
 
 EPSILON = sys.float_info.epsilon
+# msgs per job when comparing in parallel
+CHUNK_SIZE = 1000
+
+STRUCT_TYPES = (capnp.lib.capnp._DynamicStructReader, capnp.lib.capnp._DynamicStructBuilder)  # pylint: disable=c-extension-no-member,protected-access
+LIST_TYPES = (capnp.lib.capnp._DynamicListReader, capnp.lib.capnp._DynamicListBuilder)  # pylint: disable=c-extension-no-member,protected-access
+ENUM_TYPES = (capnp.lib.capnp._DynamicEnum,)  # pylint: disable=c-extension-no-member,protected-access
 
 
 def save_log(dest, log_msgs, compress=True):
+  """Writes log_msgs to dest, returns them uncompressed."""
   dat = b"".join([msg.as_builder().to_bytes() for msg in tqdm(log_msgs)])
 
-  if compress:
-    dat = bz2.compress(dat)
-
   with open(dest, "wb") as f:
-   f.write(dat)
-
-
-def remove_ignored_fields(msg, ignore):
-  msg = msg.as_builder()
-  for key in ignore:
-    attr = msg
-    keys = key.split(".")
-    if msg.which() != keys[0] and len(keys) > 1:
-      continue
-
-    for k in keys[:-1]:
-      try:
-        attr = getattr(msg, k)
-      except AttributeError:
-        break
-    else:
-      v = getattr(attr, keys[-1])
-      if isinstance(v, bool):
-        val = False
-      elif isinstance(v, numbers.Number):
-        val = 0
-      else:
-        raise NotImplementedError
-      setattr(attr, keys[-1], val)
-  return msg.as_reader()
-
-
-def compare_logs(log1, log2, ignore_fields=None, ignore_msgs=None, tolerance=None):
+   f.write(bz2.compress(dat) if compress else dat)
+  return dat
+
+
+# The diff walks both capnp structs directly, but the output is exactly what
+# dictdiffer.diff gives for msg.to_dict(verbose=True) with the tolerance filter.
+
+def to_python(v):
+  """Converts a capnp value the way to_dict(verbose=True) does."""
+  if isinstance(v, STRUCT_TYPES):
+    return v.to_dict(verbose=True)
+  elif isinstance(v, LIST_TYPES):
+    return [to_python(x) for x in v]
+  elif isinstance(v, ENUM_TYPES):
+    return str(v)
+  elif isinstance(v, memoryview):
+    return bytes(v)
+  return v
+
+
+def dotted(node, default_type=list):
+  if all(isinstance(k, str) and '.' not in k for k in node):
+    return '.'.join(node)
+  return default_type(node)
+
+
+def outside_tolerance(a, b, tolerance):
+  if a == b:
+    return False
+  if isinstance(a, numbers.Number) and isinstance(b, numbers.Number):
+    # dictdiffer only supports relative tolerance, we also want to check for absolute
+    d, m = abs(a - b), max(abs(a), abs(b))
+    return d > max(tolerance, tolerance * m) and d > EPSILON * m
+  return True
+
+
+def ignore_prefixes(ignore):
+  """Returns the paths that have an ignored path below them, fields outside them are never ignored."""
+  prefixes = set()
+  for k in ignore:
+    path = tuple(k.split('.')) if isinstance(k, str) else tuple(k)
+    prefixes.update(path[:i] for i in range(len(path)))
+  return prefixes
+
+
+def struct_fields(s):
+  if len(s.schema.union_fields):
+    return (s.which(),) + s.schema.non_union_fields
+  return s.schema.non_union_fields
+
+
+def diff_structs(s1, s2, node, ignore, prefixes, tolerance, diff):
+  fields1, fields2 = struct_fields(s1), struct_fields(s2)
+  if tuple(node) in prefixes:
+    # matched like dictdiffer's ignore
+    def check(key):
+      return dotted(node + [key], tuple) not in ignore and tuple(node + [key]) not in ignore
+    fields1 = [k for k in fields1 if check(k)]
+    fields2 = [k for k in fields2 if check(k)]
+  addition = [k for k in fields2 if k not in fields1]
+  deletion = [k for k in fields1 if k not in fields2]
+
+  for k in fields1:
+    if k in fields2:
+      diff_values(getattr(s1, k), getattr(s2, k), node + [k], ignore, prefixes, tolerance, diff)
+  if addition:
+    diff.append(("add", dotted(node), [(k, to_python(getattr(s2, k))) for k in addition]))
+  if deletion:
+    diff.append(("remove", dotted(node), [(k, to_python(getattr(s1, k))) for k in deletion]))
+
+
+def diff_lists(l1, l2, node, ignore, prefixes, tolerance, diff):
+  n = min(len(l1), len(l2))
+  if n and isinstance(l1[0], float):
+    # compare float lists at once, only the values out of tolerance are converted
+    a = np.fromiter(l1, dtype=np.float64, count=len(l1))[:n]
+    b = np.fromiter(l2, dtype=np.float64, count=len(l2))[:n]
+    with np.errstate(invalid='ignore'):
+      d, m = np.abs(a - b), np.maximum(np.abs(a), np.abs(b))
+      changed = (d > np.maximum(tolerance, tolerance * m)) & (d > EPSILON * m)
+    for i in np.flatnonzero(changed):
+      diff.append(("change", list(node) + [int(i)], (float(a[i]), float(b[i]))))
+  elif n and isinstance(l1[0], numbers.Number):
+    # ints and bools, equal lists are the common case
+    a, b = list(l1)[:n], list(l2)[:n]
+    if a != b:
+      for i in range(n):
+        if outside_tolerance(a[i], b[i], tolerance):
+          diff.append(("change", list(node) + [i], (a[i], b[i])))
+  else:
+    for i in range(n):
+      diff_values(l1[i], l2[i], node + [i], ignore, prefixes, tolerance, diff)
+
+  if len(l2) > n:
+    diff.append(("add", dotted(node), [(i, to_python(l2[i])) for i in range(n, len(l2))]))
+  if len(l1) > n:
+    diff.append(("remove", dotted(node), [(i, to_python(l1[i])) for i in reversed(range(n, len(l1)))]))
+
+
+def diff_values(v1, v2, node, ignore, prefixes, tolerance, diff):
+  if isinstance(v1, STRUCT_TYPES) and isinstance(v2, STRUCT_TYPES):
+    diff_structs(v1, v2, node, ignore, prefixes, tolerance, diff)
+  elif isinstance(v1, LIST_TYPES) and isinstance(v2, LIST_TYPES):
+    diff_lists(v1, v2, node, ignore, prefixes, tolerance, diff)
+  else:
+    v1, v2 = to_python(v1), to_python(v2)
+    if outside_tolerance(v1, v2, tolerance):
+      diff.append(("change", dotted(node), (v1, v2)))
+
+
+def compare_msgs(log1, log2, ignore_fields, tolerance):
+  """Diffs the readers field by field, skipping ignored fields without copying the msgs."""
+  ignore = {tuple(k) if isinstance(k, list) else k for k in ignore_fields}
+  prefixes = ignore_prefixes(ignore)
+
+  diff = []
+  for msg1, msg2 in zip(log1, log2):
+    diff_values(msg1, msg2, [], ignore, prefixes, tolerance, diff)
+  return diff
+
+
+_chunk_args = None
+
+
+def compare_chunk(bounds):
+  log1, log2, ignore_fields, tolerance = _chunk_args
+  start, end = bounds
+  return compare_msgs(log1[start:end], log2[start:end], ignore_fields, tolerance)
+
+
+def compare_logs(log1, log2, ignore_fields=None, ignore_msgs=None, tolerance=None, workers=None):
+  global _chunk_args
   if ignore_fields is None:
     ignore_fields = []
   if ignore_msgs is None:
     ignore_msgs = []
+  tolerance = EPSILON if tolerance is None else tolerance
+  workers = multiprocessing.cpu_count() if workers is None else workers
 
   log1, log2 = [list(filter(lambda m: m.which() not in ignore_msgs, log)) for log in (log1, log2)]
 
@@ -65,33 +177,26 @@ def compare_logs(log1, log2, ignore_fields=None, ignore_msgs=None, tolerance=Non
     cnt2 = Counter([m.which() for m in log2])
     raise Exception(f"logs are not same length: {len(log1)} VS {len(log2)}\n\t\t{cnt1}\n\t\t{cnt2}")
 
-  diff = []
-  for msg1, msg2 in tqdm(zip(log1, log2)):
+  for msg1, msg2 in zip(log1, log2):
     if msg1.which() != msg2.which():
       print(msg1, msg2)
       raise Exception("msgs not aligned between logs")
 
-    msg1_bytes = remove_ignored_fields(msg1, ignore_fields).as_builder().to_bytes()
-    msg2_bytes = remove_ignored_fields(msg2, ignore_fields).as_builder().to_bytes()
-
-    if msg1_bytes != msg2_bytes:
-      msg1_dict = msg1.to_dict(verbose=True)
-      msg2_dict = msg2.to_dict(verbose=True)
-
-      tolerance = EPSILON if tolerance is None else tolerance
-      dd = dictdiffer.diff(msg1_dict, msg2_dict, ignore=ignore_fields)
-
-      # Dictdiffer only supports relative tolerance, we also want to check for absolute
-      def outside_tolerance(diff):
-        if diff[0] == "change":
-          a, b = diff[2]
-          if isinstance(a, numbers.Number) and isinstance(b, numbers.Number):
-            return abs(a - b) > max(tolerance, tolerance * max(abs(a), abs(b)))
-        return True
-
-      dd = list(filter(outside_tolerance, dd))
-
-      diff.extend(dd)
+  # forked workers see the logs without pickling every msg
+  _chunk_args = (log1, log2, ignore_fields, tolerance)
+  chunks = [(i, i + CHUNK_SIZE) for i in range(0, len(log1), CHUNK_SIZE)]
+  diff = []
+  try:
+    # pool workers are daemonic and can't fork again, e.g. in test_processes
+    if workers <= 1 or len(chunks) <= 1 or multiprocessing.current_process().daemon:
+      for chunk in tqdm(chunks):
+        diff.extend(compare_chunk(chunk))
+    else:
+      with multiprocessing.get_context("fork").Pool(min(workers, len(chunks))) as pool:
+        for chunk_diff in tqdm(pool.imap(compare_chunk, chunks)):
+          diff.extend(chunk_diff)
+  finally:
+    _chunk_args = None
   return diff
 
 
@@ -0,0 +1,72 @@
+"""Content-addressed local store for the input and reference logs of process replay.
+
+Logs are stored decompressed, as the raw capnp events, in a file named after
+the sha256 of its contents. Names point at a hash. Inputs are named by segment,
+refs by their file name, which includes the ref_commit. Refs that didn't
+change between ref commits are stored once. Loading a stored log skips the
+download and the bz2 decompression, and capnp reads the events straight
+from the bytes.
+"""
+import bz2
+import hashlib
+import os
+import urllib.parse
+
+from cereal import log as capnp_log
+from tools.lib.cache import DEFAULT_CACHE_DIR
+from tools.lib.file_helpers import atomic_write_in_dir, mkdirs_exists_ok
+from tools.lib.filereader import FileReader
+
+STORE_DIR = os.environ.get("PROCESS_REPLAY_STORE", os.path.join(DEFAULT_CACHE_DIR, "process_replay"))
+
+
+class LogStore(object):
+  def __init__(self, store_dir=STORE_DIR):
+    self.store_dir = store_dir
+
+  def _name_path(self, name):
+    return os.path.join(self.store_dir, "names", name.replace("/", "_"))
+
+  def _object_path(self, digest):
+    return os.path.join(self.store_dir, "objects", digest[:2], digest)
+
+  def get(self, name):
+    """Returns the decompressed log stored under name, or None."""
+    try:
+      with open(self._name_path(name)) as f:
+        digest = f.read().strip()
+      with open(self._object_path(digest), "rb") as f:
+        return f.read()
+    except FileNotFoundError:
+      return None
+
+  def put(self, name, dat):
+    """Stores a decompressed log under name, returns its hash."""
+    digest = hashlib.sha256(dat).hexdigest()
+    object_path = self._object_path(digest)
+    if not os.path.exists(object_path):
+      mkdirs_exists_ok(os.path.dirname(object_path))
+      with atomic_write_in_dir(object_path, mode="wb", overwrite=True) as f:
+        f.write(dat)
+
+    name_path = self._name_path(name)
+    mkdirs_exists_ok(os.path.dirname(name_path))
+    with atomic_write_in_dir(name_path, mode="w", overwrite=True) as f:
+      f.write(digest)
+    return digest
+
+  def fetch(self, name, fn):
+    """Returns the decompressed log at fn, which is stored under name on first use."""
+    dat = self.get(name)
+    if dat is None:
+      with FileReader(fn) as f:
+        dat = f.read()
+      if urllib.parse.urlparse(fn).path.endswith(".bz2"):
+        dat = bz2.decompress(dat)
+      self.put(name, dat)
+    return dat
+
+  def load(self, name, fn):
+    """Returns the msgs of the log at fn, which is stored under name on first use."""
+    return list(capnp_log.Event.read_multiple_bytes(self.fetch(name, fn)))
+
@@ -24,6 +24,8 @@ from selfdrive.manager.process_config import managed_processes
 NUMPY_TOLERANCE = 1e-7
 CI = "CI" in os.environ
 TIMEOUT = 15
+# replay python processes in a thread, instead of calling their step function in lockstep
+THREADED_REPLAY = os.getenv("THREADED_REPLAY") is not None
 
 ProcessConfig = namedtuple('ProcessConfig', ['proc_name', 'pub_sub', 'ignore', 'init_callback', 'should_recv_callback', 'tolerance', 'fake_pubsubmaster'])
 
@@ -151,12 +153,52 @@ class FakePubMaster(messaging.PubMaster):
     return dat
 
 
+class LockstepSubMaster(messaging.SubMaster):
+  """SubMaster for lockstep replay, update() consumes the msgs queued with update_msgs()."""
+  def __init__(self, services):
+    super(LockstepSubMaster, self).__init__(services, addr=None)
+    self.sock = {s: DumbSocket(s) for s in services}
+    self.queued = None
+
+  def update(self, timeout=-1):
+    if self.queued is None:
+      raise Exception("Process updated without new msgs, replay is out of sync")
+    super(LockstepSubMaster, self).update_msgs(0, self.queued)
+    self.queued = None
+
+  def update_msgs(self, cur_time, msgs):
+    self.queued = msgs
+
+
+class LockstepPubMaster(FakePubMaster):
+  """PubMaster for lockstep replay, collects everything sent during a step."""
+  def __init__(self, services):
+    super(LockstepPubMaster, self).__init__(services)
+    self.sent = []
+
+  def send(self, s, dat):
+    if isinstance(dat, bytes):
+      self.sent.append(log.Event.from_bytes(dat))
+    else:
+      self.sent.append(dat.as_reader())
+
+  def drain(self):
+    sent, self.sent = self.sent, []
+    return sent
+
+
 def fingerprint(msgs, fsm, can_sock, fingerprint):
   print("start fingerprinting")
+  canmsgs = [msg for msg in msgs if msg.which() == "can"]
+
+  if isinstance(fsm, LockstepSubMaster):
+    # the process is created after this and fingerprints right away
+    can_sock.data = [msg.as_builder().to_bytes() for msg in canmsgs[:300]]
+    return
+
   fsm.wait_on_getitem = True
 
   # populate fake socket with data for fingerprinting
-  canmsgs = [msg for msg in msgs if msg.which() == "can"]
   wait_for_event(can_sock.recv_called)
   can_sock.recv_called.clear()
   can_sock.data = [msg.as_builder().to_bytes() for msg in canmsgs[:300]]
@@ -235,6 +277,16 @@ def ublox_rcv_callback(msg):
      return []
 
 
+# classes with a step() method running one iteration of the process' main loop
+LOCKSTEP_PROCS = {
+  "controlsd": "Controls",
+  "radard": "RadardLoop",
+  "plannerd": "Plannerd",
+  "calibrationd": "Calibrationd",
+  "dmonitoringd": "DMonitoringd",
+  "paramsd": "Paramsd",
+}
+
 CONFIGS = [
   ProcessConfig(
     proc_name="controlsd",
@@ -335,27 +387,32 @@ CONFIGS = [
 ]
 
 
-def replay_process(cfg, lr, fingerprint=None):
-  if cfg.fake_pubsubmaster:
-    return python_replay_process(cfg, lr, fingerprint)
+def replay_process(cfg, lr, fingerprint=None, latencies=None, replay_times=None):
+  """Replays lr through the process and returns its output msgs.
+
+     If latencies is a list, the time the process took to handle each msg that runs an iteration of
+     its loop, the msgs it responds to, is appended to it.
+     If replay_times is a list, the time spent replaying the msgs, after the process is set up
+     and fingerprinted, is appended to it.
+  """
+  if not cfg.fake_pubsubmaster:
+    return cpp_replay_process(cfg, lr, fingerprint, latencies, replay_times)
+  elif cfg.proc_name in LOCKSTEP_PROCS and not THREADED_REPLAY:
+    return lockstep_replay_process(cfg, lr, fingerprint, latencies, replay_times)
   else:
-    return cpp_replay_process(cfg, lr, fingerprint)
+    return python_replay_process(cfg, lr, fingerprint, latencies, replay_times)
 
 
-def python_replay_process(cfg, lr, fingerprint=None):
-  sub_sockets = [s for _, sub in cfg.pub_sub.items() for s in sub]
-  pub_sockets = [s for s in cfg.pub_sub.keys() if s != 'can']
+def get_recv_socks(cfg, msg, CP, fsm):
+  if cfg.should_recv_callback is not None:
+    return cfg.should_recv_callback(msg, CP, cfg, fsm)
 
-  fsm = FakeSubMaster(pub_sockets)
-  fpm = FakePubMaster(sub_sockets)
-  args = (fsm, fpm)
-  if 'can' in list(cfg.pub_sub.keys()):
-    can_sock = FakeSocket()
-    args = (fsm, fpm, can_sock)
+  recv_socks = [s for s in cfg.pub_sub[msg.which()] if
+                (fsm.frame + 1) % int(service_list[msg.which()].frequency / service_list[s].frequency) == 0]
+  return recv_socks, bool(len(recv_socks))
 
-  all_msgs = sorted(lr, key=lambda msg: msg.logMonoTime)
-  pub_msgs = [msg for msg in all_msgs if msg.which() in list(cfg.pub_sub.keys())]
 
+def setup_python_process(cfg, lr, fingerprint=None):
   params = Params()
   params.clear_all()
   params.put_bool("OpenpilotEnabledToggle", True)
@@ -387,7 +444,25 @@ def python_replay_process(cfg, lr, fingerprint=None):
 
   assert(type(managed_processes[cfg.proc_name]) is PythonProcess)
   managed_processes[cfg.proc_name].prepare()
-  mod = importlib.import_module(managed_processes[cfg.proc_name].module)
+  return importlib.import_module(managed_processes[cfg.proc_name].module)
+
+
+def python_replay_process(cfg, lr, fingerprint=None, latencies=None, replay_times=None):
+  sub_sockets = [s for _, sub in cfg.pub_sub.items() for s in sub]
+  pub_sockets = [s for s in cfg.pub_sub.keys() if s != 'can']
+
+  fsm = FakeSubMaster(pub_sockets)
+  fpm = FakePubMaster(sub_sockets)
+  args = (fsm, fpm)
+  if 'can' in list(cfg.pub_sub.keys()):
+    can_sock = FakeSocket()
+    args = (fsm, fpm, can_sock)
+
+  all_msgs = sorted(lr, key=lambda msg: msg.logMonoTime)
+  pub_msgs = [msg for msg in all_msgs if msg.which() in list(cfg.pub_sub.keys())]
+
+  mod = setup_python_process(cfg, lr, fingerprint)
+  params = Params()
 
   thread = threading.Thread(target=mod.main, args=args)
   thread.daemon = True
@@ -407,13 +482,10 @@ def python_replay_process(cfg, lr, fingerprint=None):
     fsm.wait_for_update()
 
   log_msgs, msg_queue = [], []
+  start_time = time.monotonic()
   for msg in tqdm(pub_msgs, disable=CI):
-    if cfg.should_recv_callback is not None:
-      recv_socks, should_recv = cfg.should_recv_callback(msg, CP, cfg, fsm)
-    else:
-      recv_socks = [s for s in cfg.pub_sub[msg.which()] if
-                    (fsm.frame + 1) % int(service_list[msg.which()].frequency / service_list[s].frequency) == 0]
-      should_recv = bool(len(recv_socks))
+    recv_socks, should_recv = get_recv_socks(cfg, msg, CP, fsm)
+    t = time.monotonic()
 
     if msg.which() == 'can':
       can_sock.send(msg.as_builder().to_bytes())
@@ -429,10 +501,83 @@ def python_replay_process(cfg, lr, fingerprint=None):
         m = fpm.wait_for_msg()
         log_msgs.append(m)
         recv_cnt -= m.which() in recv_socks
+
+      if latencies is not None:
+        latencies.append(time.monotonic() - t)
+
+  if replay_times is not None:
+    replay_times.append(time.monotonic() - start_time)
   return log_msgs
 
 
-def cpp_replay_process(cfg, lr, fingerprint=None):
+def lockstep_replay_process(cfg, lr, fingerprint=None, latencies=None, replay_times=None):
+  """Replays a python process by calling its step function, bit-identical to python_replay_process.
+
+     Every step gets exactly the msgs the threaded replay would hand the process, without
+     the thread switches and Event round trips per msg.
+  """
+  sub_sockets = [s for _, sub in cfg.pub_sub.items() for s in sub]
+  pub_sockets = [s for s in cfg.pub_sub.keys() if s != 'can']
+
+  fsm = LockstepSubMaster(pub_sockets)
+  fpm = LockstepPubMaster(sub_sockets)
+  args = (fsm, fpm)
+  can_sock = None
+  if 'can' in list(cfg.pub_sub.keys()):
+    can_sock = FakeSocket(wait=False)
+    args = (fsm, fpm, can_sock)
+
+  all_msgs = sorted(lr, key=lambda msg: msg.logMonoTime)
+  pub_msgs = [msg for msg in all_msgs if msg.which() in list(cfg.pub_sub.keys())]
+
+  mod = setup_python_process(cfg, lr, fingerprint)
+  params = Params()
+
+  if cfg.init_callback is not None:
+    cfg.init_callback(all_msgs, fsm, can_sock, fingerprint)
+
+  proc = getattr(mod, LOCKSTEP_PROCS[cfg.proc_name])(*args)
+  if can_sock is not None:
+    # drop what's left from fingerprinting
+    can_sock.data = []
+
+  CP = car.CarParams.from_bytes(params.get("CarParams", block=True))
+
+  log_msgs, msg_queue = [], []
+  start_time = time.monotonic()
+  for msg in tqdm(pub_msgs, disable=CI):
+    recv_socks, should_recv = get_recv_socks(cfg, msg, CP, fsm)
+
+    if msg.which() == 'can':
+      can_sock.send(msg.as_builder().to_bytes())
+    else:
+      msg_queue.append(msg.as_builder())
+
+    if should_recv:
+      fsm.update_msgs(0, msg_queue)
+      msg_queue = []
+
+    # processes driven by can step on every can msg, the others on every update. steps that only
+    # read can without responding, like radard between radar msgs, aren't a loop iteration
+    if msg.which() == 'can' or should_recv:
+      t = time.monotonic()
+      proc.step()
+      if latencies is not None and should_recv:
+        latencies.append(time.monotonic() - t)
+      if fsm.queued is not None:
+        raise Exception("Process didn't update on new msgs, replay is out of sync")
+
+    sent = fpm.drain()
+    if should_recv and sum(m.which() in recv_socks for m in sent) < len(recv_socks):
+      raise Exception("Process didn't send %s, replay is out of sync" % recv_socks)
+    log_msgs.extend(sent)
+
+  if replay_times is not None:
+    replay_times.append(time.monotonic() - start_time)
+  return log_msgs
+
+
+def cpp_replay_process(cfg, lr, fingerprint=None, latencies=None, replay_times=None):
   sub_sockets = [s for _, sub in cfg.pub_sub.items() for s in sub]  # We get responses here
   pm = messaging.PubMaster(cfg.pub_sub.keys())
 
@@ -453,7 +598,9 @@ def cpp_replay_process(cfg, lr, fingerprint=None):
     for s in sub_sockets:
       messaging.recv_one_or_none(sockets[s])
 
+    start_time = time.monotonic()
     for i, msg in enumerate(tqdm(pub_msgs, disable=CI)):
+      t = time.monotonic()
       pm.send(msg.which(), msg.as_builder())
 
       resp_sockets = cfg.pub_sub[msg.which()] if cfg.should_recv_callback is None else cfg.should_recv_callback(msg)
@@ -469,6 +616,12 @@ def cpp_replay_process(cfg, lr, fingerprint=None):
         while not pm.all_readers_updated(msg.which()):
           time.sleep(0)
 
+      if latencies is not None and len(resp_sockets):
+        latencies.append(time.monotonic() - t)
+
+    if replay_times is not None:
+      replay_times.append(time.monotonic() - start_time)
+
     managed_processes[cfg.proc_name].signal(signal.SIGKILL)
     managed_processes[cfg.proc_name].stop()
 
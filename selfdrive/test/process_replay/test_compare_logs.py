@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+import math
+import numbers
+import random
+import unittest
+import unittest.mock
+
+import dictdiffer
+
+from cereal import log
+from selfdrive.test.process_replay import compare_logs as cl
+from selfdrive.test.process_replay.compare_logs import EPSILON, compare_logs
+
+GEARS = ["park", "drive", "unknown"]
+
+
+def dictdiffer_compare(log1, log2, ignore_fields, tolerance):
+  # the diff as it was computed before walking the structs
+  tolerance = EPSILON if tolerance is None else tolerance
+
+  def outside_tolerance(diff):
+    if diff[0] == "change":
+      a, b = diff[2]
+      if isinstance(a, numbers.Number) and isinstance(b, numbers.Number):
+        return abs(a - b) > max(tolerance, tolerance * max(abs(a), abs(b)))
+    return True
+
+  diff = []
+  for msg1, msg2 in zip(log1, log2):
+    dd = dictdiffer.diff(msg1.to_dict(verbose=True), msg2.to_dict(verbose=True), ignore=ignore_fields)
+    diff.extend(filter(outside_tolerance, dd))
+  return diff
+
+
+def perturb(v, rnd):
+  # the same value, a tiny or a large change, or nan
+  r = rnd.random()
+  if r < 0.5:
+    return v
+  elif r < 0.7:
+    return v * (1 + 1e-9)
+  elif r < 0.8:
+    return v + 1e-4
+  elif r < 0.9:
+    return v + rnd.uniform(-10, 10)
+  return math.nan
+
+
+def random_pair(rnd):
+  which = rnd.choice(["carState", "liveCalibration", "controlsState", "can"])
+  msgs = []
+  mono_time = rnd.randrange(10**12)
+  seed = rnd.random()
+  for i in range(2):
+    # the second msg changes every value with some probability
+    vrnd = random.Random(seed)
+    prnd = rnd if i else random.Random(0)
+    p = (lambda v: perturb(v, prnd)) if i else (lambda v: v)
+    changed = (lambda: prnd.random() < 0.2) if i else (lambda: False)
+
+    msg = log.Event.new_message(logMonoTime=mono_time + (i if changed() else 0))
+    if which == "carState":
+      cs = msg.init("carState")
+      cs.vEgo = p(vrnd.uniform(0, 40))
+      cs.gasPressed = vrnd.random() < 0.5 if not changed() else vrnd.random() >= 0.5
+      cs.cruiseState.speed = p(vrnd.uniform(0, 40))
+      gear = vrnd.randrange(len(GEARS))
+      cs.gearShifter = GEARS[(gear + changed()) % len(GEARS)]
+      n = vrnd.randrange(4) + (prnd.randrange(-1, 2) if i else 0)
+      for be in cs.init("buttonEvents", max(n, 0)):
+        be.pressed = vrnd.random() < 0.5
+    elif which == "liveCalibration":
+      lc = msg.init("liveCalibration")
+      rpy = [p(vrnd.uniform(-0.1, 0.1)) for _ in range(3)]
+      lc.rpyCalib = rpy[:2] if changed() else rpy
+      lc.calStatus = vrnd.randrange(3) + changed()
+    elif which == "controlsState":
+      msg.init("controlsState").vCruise = p(vrnd.uniform(0, 160))
+    else:
+      frames = msg.init("can", vrnd.randrange(1, 4))
+      for f in frames:
+        f.address = vrnd.randrange(2048) + changed()
+        f.src = vrnd.randrange(3)
+        f.dat = bytes(vrnd.randrange(256) for _ in range(8)) + (b"\x00" if changed() else b"")
+    # readers, like the msgs of a LogReader
+    msgs.append(log.Event.from_bytes(msg.to_bytes()))
+  return msgs
+
+
+class TestCompareLogs(unittest.TestCase):
+  def setUp(self):
+    rnd = random.Random(0)
+    self.log1, self.log2 = zip(*[random_pair(rnd) for _ in range(500)])
+
+  def assert_same_diff(self, ignore_fields, tolerance=None, **kwargs):
+    expected = dictdiffer_compare(self.log1, self.log2, ignore_fields, tolerance)
+    diff = compare_logs(self.log1, self.log2, ignore_fields, tolerance=tolerance, **kwargs)
+    self.assertEqual(diff, expected)
+    return diff
+
+  def test_matches_dictdiffer(self):
+    for tolerance in [None, 1e-3, 1]:
+      with self.subTest(tolerance=tolerance):
+        diff = self.assert_same_diff([], tolerance)
+        self.assertGreater(len(diff), 0)
+
+  def test_ignored_fields(self):
+    ignore = ["logMonoTime", "carState.vEgo", "carState.cruiseState.speed", "liveCalibration.rpyCalib",
+              ("can",), ["controlsState", "vCruise"]]
+    diff = self.assert_same_diff(ignore)
+    paths = {str(d[1]) for d in diff}
+    self.assertFalse(any(p.startswith(("logMonoTime", "carState.vEgo", "carState.cruiseState", "liveCalibration.rpyCalib",
+                                       "['liveCalibration', 'rpyCalib'"))
+                         for p in paths), paths)
+
+  def test_float_tolerance(self):
+    msg1 = log.Event.new_message()
+    msg1.init("liveCalibration").rpyCalib = [0., 1., 1e6]
+    msg2 = log.Event.new_message()
+    msg2.init("liveCalibration").rpyCalib = [5e-4, 1.002, 1e6 + 100]
+    log1, log2 = [log.Event.from_bytes(msg1.to_bytes())], [log.Event.from_bytes(msg2.to_bytes())]
+
+    # absolute tolerance near 0, relative tolerance for large values
+    diff = compare_logs(log1, log2, tolerance=1e-3)
+    self.assertEqual(diff, dictdiffer_compare(log1, log2, [], 1e-3))
+    self.assertEqual([d[1] for d in diff], [["liveCalibration", "rpyCalib", 1]])
+
+  def test_list_length(self):
+    msg1 = log.Event.new_message()
+    msg1.init("carState").init("buttonEvents", 3)[1].pressed = True
+    msg2 = log.Event.new_message()
+    msg2.init("carState").init("buttonEvents", 1)
+    log1, log2 = [log.Event.from_bytes(msg1.to_bytes())], [log.Event.from_bytes(msg2.to_bytes())]
+
+    for a, b in [(log1, log2), (log2, log1)]:
+      diff = compare_logs(a, b)
+      self.assertEqual(diff, dictdiffer_compare(a, b, [], None))
+      self.assertEqual([d[:2] for d in diff], [("remove" if a is log1 else "add", "carState.buttonEvents")])
+
+  def test_parallel(self):
+    # msgs are split into chunks, which are compared in forked workers
+    with unittest.mock.patch.object(cl, "CHUNK_SIZE", 64):
+      self.assert_same_diff(["carState.vEgo"], workers=4)
+
+
+if __name__ == "__main__":
+  unittest.main()
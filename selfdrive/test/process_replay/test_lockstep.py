@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+import os
+import shutil
+import tempfile
+import unittest
+
+from parameterized import parameterized
+
+from selfdrive.test.process_replay.compare_logs import compare_logs
+from selfdrive.test.process_replay.log_store import LogStore
+from selfdrive.test.process_replay.process_replay import CONFIGS, LOCKSTEP_PROCS, lockstep_replay_process, \
+                                                         python_replay_process
+from selfdrive.test.process_replay.test_processes import get_segment, segments
+
+SEGMENT = dict(segments)[os.getenv("LOCKSTEP_CAR", "TOYOTA")]
+
+# wall clock times and lags measured by the process, everything else has to match exactly
+NONDETERMINISTIC_FIELDS = ["logMonoTime", "controlsState.startMonoTime", "controlsState.cumLagMs",
+                           "radarState.cumLagMs", "longitudinalPlan.processingDelay"]
+
+
+class TestLockstepReplay(unittest.TestCase):
+  @classmethod
+  def setUpClass(cls):
+    cls.msgs = LogStore().load(SEGMENT, get_segment(SEGMENT))
+
+  def setUp(self):
+    # replays reset and write params
+    self.home = tempfile.mkdtemp()
+    self._home = os.environ.get('HOME')
+    os.environ['HOME'] = self.home
+
+  def tearDown(self):
+    os.environ['HOME'] = self._home
+    shutil.rmtree(self.home)
+
+  @parameterized.expand([(proc,) for proc in LOCKSTEP_PROCS])
+  def test_lockstep_matches_threaded(self, proc_name):
+    cfg = next(cfg for cfg in CONFIGS if cfg.proc_name == proc_name)
+
+    threaded = python_replay_process(cfg, self.msgs)
+    lockstep = lockstep_replay_process(cfg, self.msgs)
+
+    self.assertGreater(len(lockstep), 0)
+    diff = compare_logs(threaded, lockstep, NONDETERMINISTIC_FIELDS)
+    self.assertEqual(diff, [], f"{proc_name} differs between threaded and lockstep replay on {SEGMENT}")
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -1,11 +1,15 @@
 #!/usr/bin/env python3
 import argparse
+import itertools
+import multiprocessing
 import os
 import sys
+import tempfile
 from typing import Any
 
 from selfdrive.car.car_helpers import interface_names
 from selfdrive.test.process_replay.compare_logs import compare_logs
+from selfdrive.test.process_replay.log_store import LogStore
 from selfdrive.test.process_replay.process_replay import CONFIGS, replay_process
 from tools.lib.logreader import LogReader
 
@@ -54,8 +58,10 @@ def test_process(cfg, lr, cmp_log_fn, ignore_fields=None, ignore_msgs=None):
   if ignore_msgs is None:
     ignore_msgs = []
 
-  cmp_log_path = cmp_log_fn if os.path.exists(cmp_log_fn) else BASE_URL + os.path.basename(cmp_log_fn)
-  cmp_log_msgs = list(LogReader(cmp_log_path))
+  if os.path.exists(cmp_log_fn):
+    cmp_log_msgs = list(LogReader(cmp_log_fn))
+  else:
+    cmp_log_msgs = LogStore().load(os.path.basename(cmp_log_fn), BASE_URL + os.path.basename(cmp_log_fn))
 
   log_msgs = replay_process(cfg, lr)
 
@@ -76,6 +82,27 @@ def test_process(cfg, lr, cmp_log_fn, ignore_fields=None, ignore_msgs=None):
   except Exception as e:
     return str(e)
 
+_segment_log: Any = (None, None)
+
+
+def init_worker(run_dir):
+  # replays reset and write params, so every worker gets its own, removed with run_dir
+  os.environ['HOME'] = tempfile.mkdtemp(dir=run_dir)
+
+
+def run_test(job):
+  """Replays one process on one segment, returns (segment, proc_name, result)."""
+  global _segment_log
+  segment, proc_name, cmp_log_fn, ignore_fields, ignore_msgs = job
+
+  # jobs are ordered by segment, keep the last one around
+  if _segment_log[0] != segment:
+    _segment_log = (segment, LogStore().load(segment, get_segment(segment)))
+
+  cfg = next(cfg for cfg in CONFIGS if cfg.proc_name == proc_name)
+  return segment, proc_name, test_process(cfg, _segment_log[1], cmp_log_fn, ignore_fields, ignore_msgs)
+
+
 def format_diff(results, ref_commit):
   diff1, diff2 = "", ""
   diff2 += "***** tested against commit %s *****\n" % ref_commit
@@ -122,6 +149,8 @@ if __name__ == "__main__":
                         help="Extra fields or msgs to ignore (e.g. carState.events)")
   parser.add_argument("--ignore-msgs", type=str, nargs="*", default=[],
                         help="Msgs to ignore (e.g. carEvents)")
+  parser.add_argument("-j", "--jobs", type=int, default=multiprocessing.cpu_count(),
+                        help="Number of replays to run in parallel, each with its own params")
   args = parser.parse_args()
 
   cars_whitelisted = len(args.whitelist_cars) > 0
@@ -143,25 +172,47 @@ if __name__ == "__main__":
     assert len(untested) == 0, "Cars missing routes: %s" % (str(untested))
 
   results: Any = {}
+  jobs = []
   for car_brand, segment in segments:
     if (cars_whitelisted and car_brand.upper() not in args.whitelist_cars) or \
        (not cars_whitelisted and car_brand.upper() in args.blacklist_cars):
       continue
 
-    print("***** testing route segment %s *****\n" % segment)
-
     results[segment] = {}
 
-    rlog_fn = get_segment(segment)
-    lr = LogReader(rlog_fn)
-
     for cfg in CONFIGS:
       if (procs_whitelisted and cfg.proc_name not in args.whitelist_procs) or \
          (not procs_whitelisted and cfg.proc_name in args.blacklist_procs):
         continue
 
       cmp_log_fn = os.path.join(process_replay_dir, "%s_%s_%s.bz2" % (segment, cfg.proc_name, ref_commit))
-      results[segment][cfg.proc_name] = test_process(cfg, lr, cmp_log_fn, args.ignore_fields, args.ignore_msgs)
+      results[segment][cfg.proc_name] = None  # keeps the order of the report
+      jobs.append((segment, cfg.proc_name, cmp_log_fn, args.ignore_fields, args.ignore_msgs))
+
+  if args.jobs > 1:
+    # native processes are started with multiprocessing, which pool workers can't do. They
+    # also replay over real sockets, so they run one at a time here while the pool works.
+    fake_pubsubmaster = {cfg.proc_name: cfg.fake_pubsubmaster for cfg in CONFIGS}
+    # otherwise the first workers all download the same segment at once
+    for segment in dict.fromkeys(j[0] for j in jobs):
+      LogStore().fetch(segment, get_segment(segment))
+    # removed by the main process, workers don't run atexit handlers and could be killed
+    run_dir = tempfile.TemporaryDirectory(prefix="process_replay_")
+    pool = multiprocessing.Pool(args.jobs, initializer=init_worker, initargs=(run_dir.name,))
+    pool_results = pool.imap_unordered(run_test, [j for j in jobs if fake_pubsubmaster[j[1]]])
+    done = itertools.chain(map(run_test, [j for j in jobs if not fake_pubsubmaster[j[1]]]), pool_results)
+  else:
+    pool = None
+    done = map(run_test, jobs)
+
+  for segment, proc_name, result in done:
+    print("***** tested %s on route segment %s *****" % (proc_name, segment))
+    results[segment][proc_name] = result
+
+  if pool is not None:
+    pool.close()
+    pool.join()
+    run_dir.cleanup()
 
   diff1, diff2, failed = format_diff(results, ref_commit)
   with open(os.path.join(process_replay_dir, "diff.txt"), "w") as f:
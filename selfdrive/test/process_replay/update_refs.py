@@ -4,10 +4,10 @@ import sys
 
 from selfdrive.test.openpilotci import upload_file
 from selfdrive.test.process_replay.compare_logs import save_log
+from selfdrive.test.process_replay.log_store import LogStore
 from selfdrive.test.process_replay.process_replay import replay_process, CONFIGS
 from selfdrive.test.process_replay.test_processes import segments, get_segment
 from selfdrive.version import get_git_commit
-from tools.lib.logreader import LogReader
 
 if __name__ == "__main__":
 
@@ -22,6 +22,7 @@ if __name__ == "__main__":
   with open(ref_commit_fn, "w") as f:
     f.write(ref_commit)
 
+  store = LogStore()
   for car_brand, segment in segments:
     rlog_fn = get_segment(segment)
 
@@ -29,12 +30,12 @@ if __name__ == "__main__":
       print("failed to get segment %s" % segment)
       sys.exit(1)
 
-    lr = LogReader(rlog_fn)
+    lr = store.load(segment, rlog_fn)
 
     for cfg in CONFIGS:
       log_msgs = replay_process(cfg, lr)
       log_fn = os.path.join(process_replay_dir, "%s_%s_%s.bz2" % (segment, cfg.proc_name, ref_commit))
-      save_log(log_fn, log_msgs)
+      store.put(os.path.basename(log_fn), save_log(log_fn, log_msgs))
 
       if not no_upload:
         upload_file(log_fn, os.path.basename(log_fn))
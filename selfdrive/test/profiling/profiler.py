@@ -1,90 +1,150 @@
 #!/usr/bin/env python3
-import os
-import sys
+import argparse
 import cProfile  # pylint: disable=import-error
+import importlib
+import io
+import os
+import pstats
+import unittest.mock
+from collections import Counter
+
+import numpy as np
 import pprofile  # pylint: disable=import-error
 import pyprof2calltree  # pylint: disable=import-error
 
-from common.params import Params
-from tools.lib.logreader import LogReader
-from selfdrive.test.profiling.lib import SubMaster, PubMaster, SubSocket, ReplayDone
-from selfdrive.test.process_replay.process_replay import CONFIGS
-
-BASE_URL = "https://commadataci.blob.core.windows.net/openpilotci/"
-
-CARS = {
-  'toyota': ("77611a1fac303767|2020-02-29--13-29-33/3", "TOYOTA COROLLA TSS2 2019"),
-  'honda': ("99c94dc769b5d96e|2019-08-03--14-19-59/2", "HONDA CIVIC 2016 TOURING"),
-  "vw": ("e2a273d7e6eecec2|2021-03-03--16-05-26/4", "AUDI A3"),
-}
-
-
-def get_inputs(msgs, process):
-  for config in CONFIGS:
-    if config.proc_name == process:
-      sub_socks = list(config.pub_sub.keys())
-      trigger = sub_socks[0]
-      break
-
-  # some procs block on CarParams
-  for msg in msgs:
-    if msg.which() == 'carParams':
-      Params().put("CarParams", msg.as_builder().to_bytes())
-      break
-
-  sm = SubMaster(msgs, trigger, sub_socks)
-  pm = PubMaster()
-  if 'can' in sub_socks:
-    can_sock = SubSocket(msgs, 'can')
-  else:
-    can_sock = None
-  return sm, pm, can_sock
-
-
-def profile(proc, func, car='vw'):
-  segment, fingerprint = CARS[car]
-  segment = segment.replace('|', '/')
-  rlog_url = f"{BASE_URL}{segment}/rlog.bz2"
-  msgs = list(LogReader(rlog_url)) * int(os.getenv("LOOP", "1"))
-
-  os.environ['FINGERPRINT'] = fingerprint
-
-  def run(sm, pm, can_sock):
+from cereal.services import service_list
+from selfdrive.manager.process_config import managed_processes
+from selfdrive.test.process_replay import process_replay
+from selfdrive.test.process_replay.log_store import LogStore
+from selfdrive.test.process_replay.process_replay import CONFIGS, LOCKSTEP_PROCS, THREADED_REPLAY, get_recv_socks, \
+                                                         replay_process
+from selfdrive.test.process_replay.test_processes import get_segment, segments
+
+LOOP = int(os.getenv("LOOP", "1"))
+
+# histogram bin edges in ms, the last bin catches everything slower
+HISTOGRAM_BINS = [0, 0.5, 1, 2, 5, 10, 20, 50, 100, np.inf]
+
+# number of functions reported by own time
+TOP_FUNCTIONS = 20
+
+
+def get_budget(cfg, msgs, triggers):
+  """A loop has to finish before the msg triggering the next one comes in.
+
+     Which msgs trigger a loop is up to the process' recv callback: every can msg for controlsd,
+     10 ms, but only the can msgs with radar tracks for radard, 50 ms.
+  """
+  counts = Counter(msg.which() for msg in msgs)
+  if not triggers:
+    # native processes are replayed without get_recv_socks, every msg they respond to triggers a loop
+    triggers = Counter()
+    for msg in msgs:
+      if msg.which() in cfg.pub_sub:
+        socks = cfg.pub_sub[msg.which()] if cfg.should_recv_callback is None else cfg.should_recv_callback(msg)
+        triggers[msg.which()] += LOOP * bool(len(socks))
+  rate = sum(service_list[s].frequency * n / (LOOP * counts[s]) for s, n in triggers.items() if n)
+  return 1. / rate
+
+
+def get_latencies(cfg, msgs):
+  """Returns the loop times, and how many msgs of each service triggered a loop."""
+  latencies, triggers = [], Counter()
+
+  def recv_socks(cfg, msg, CP, fsm):
+    socks, should_recv = get_recv_socks(cfg, msg, CP, fsm)
+    triggers[msg.which()] += should_recv
+    return socks, should_recv
+
+  with unittest.mock.patch.object(process_replay, "get_recv_socks", recv_socks):
+    for _ in range(LOOP):
+      replay_process(cfg, msgs, latencies=latencies)
+  return np.array(latencies), triggers
+
+
+def profile_steps(cfg, msgs):
+  # only the process' own loop, not the replay around it
+  mod = importlib.import_module(managed_processes[cfg.proc_name].module)
+  proc_cls = getattr(mod, LOCKSTEP_PROCS[cfg.proc_name])
+  step = proc_cls.step
+
+  pr = cProfile.Profile()
+  def profiled_step(self):
+    pr.enable()
     try:
-      if can_sock is not None:
-        func(sm, pm, can_sock)
-      else:
-        func(sm, pm)
-    except ReplayDone:
-      pass
-
-  # Statistical
-  sm, pm, can_sock = get_inputs(msgs, proc)
-  with pprofile.StatisticalProfile()(period=0.00001) as pr:
-    run(sm, pm, can_sock)
-  pr.dump_stats(f'cachegrind.out.{proc}_statistical')
-
-  # Deterministic
-  sm, pm, can_sock = get_inputs(msgs, proc)
-  with cProfile.Profile() as pr:
-    run(sm, pm, can_sock)
+      return step(self)
+    finally:
+      pr.disable()
+
+  with unittest.mock.patch.object(proc_cls, "step", profiled_step):
+    get_latencies(cfg, msgs)
+  return pr
+
+
+def format_histogram(latencies, width=50):
+  counts, _ = np.histogram(latencies * 1e3, bins=HISTOGRAM_BINS)
+  lines = []
+  for lo, hi, count in zip(HISTOGRAM_BINS[:-1], HISTOGRAM_BINS[1:], counts):
+    label = f"{lo:>5g} - {hi:<4g} ms" if np.isfinite(hi) else f"{lo:>5g} ms +     "
+    bar = "#" * int(np.ceil(width * count / max(counts.max(), 1)))
+    lines.append(f"  {label} {count:7d} {bar}")
+  return "\n".join(lines)
+
+
+def report_latencies(cfg, msgs, latencies, triggers):
+  budget = get_budget(cfg, msgs, triggers)
+  p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1e3
+  over_budget = np.sum(latencies > budget)
+  print(f"{len(latencies)} loops, p50 {p50:.2f} ms, p95 {p95:.2f} ms, p99 {p99:.2f} ms, max {latencies.max() * 1e3:.2f} ms")
+  print(f"{over_budget} loops ({over_budget / len(latencies):.2%}) over the {budget * 1e3:.0f} ms budget")
+  print(format_histogram(latencies))
+
+
+def profile(cfg, msgs, statistical=False):
+  proc = cfg.proc_name
+
+  # timed without a profiler attached, which would inflate the loop times
+  print(f"***** {proc} loop times *****")
+  report_latencies(cfg, msgs, *get_latencies(cfg, msgs))
+
+  if not cfg.fake_pubsubmaster:
+    # native processes run in a child, there's nothing to profile in python
+    return
+  elif proc not in LOCKSTEP_PROCS or THREADED_REPLAY:
+    # cProfile only sees the thread it's enabled in, not the one running the process
+    print(f"{proc} isn't replayed in lockstep, not profiling")
+    return
+
+  if statistical:
+    with pprofile.StatisticalProfile()(period=0.00001) as pr:
+      get_latencies(cfg, msgs)
+    pr.dump_stats(f'cachegrind.out.{proc}_statistical')
+
+  pr = profile_steps(cfg, msgs)
   pyprof2calltree.convert(pr.getstats(), f'cachegrind.out.{proc}_deterministic')
 
+  print(f"***** {proc} hottest functions *****")
+  s = io.StringIO()
+  pstats.Stats(pr, stream=s).sort_stats(pstats.SortKey.TIME).print_stats(TOP_FUNCTIONS)
+  print(s.getvalue())
+
 
 if __name__ == '__main__':
-  from selfdrive.controls.controlsd import main as controlsd_thread
-  from selfdrive.controls.radard import radard_thread
-  from selfdrive.locationd.paramsd import main as paramsd_thread
-
-  procs = {
-    'radard': radard_thread,
-    'controlsd': controlsd_thread,
-    'paramsd': paramsd_thread,
-  }
-
-  proc = sys.argv[1]
-  if proc not in procs:
-    print(f"{proc} not available")
-    sys.exit(0)
-  else:
-    profile(proc, procs[proc])
+  parser = argparse.ArgumentParser(description="Profile the main loop of processes on a process replay segment")
+  parser.add_argument("procs", type=str, nargs="*", default=[cfg.proc_name for cfg in CONFIGS],
+                      help="Processes to profile, all of process replay by default")
+  parser.add_argument("--car", type=str, default="TOYOTA", choices=[car for car, _ in segments],
+                      help="Process replay segment to run on")
+  parser.add_argument("--statistical", action="store_true",
+                      help="Also dump a statistical profile, which is closer to the real time split")
+  args = parser.parse_args()
+
+  segment = dict(segments)[args.car]
+  msgs = LogStore().load(segment, get_segment(segment))
+
+  cfgs = {cfg.proc_name: cfg for cfg in CONFIGS}
+  for proc in args.procs:
+    if proc not in cfgs:
+      print(f"{proc} not available")
+      continue
+    profile(cfgs[proc], msgs, args.statistical)
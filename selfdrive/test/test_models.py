@@ -1,7 +1,11 @@
 #!/usr/bin/env python3
 # pylint: disable=E1101
+import io
 import os
 import importlib
+import multiprocessing
+import sys
+import tempfile
 import unittest
 from collections import defaultdict, Counter
 from parameterized import parameterized_class
@@ -13,9 +17,9 @@ from selfdrive.car.honda.values import HONDA_BOSCH
 from selfdrive.car.honda.values import CAR as HONDA
 from selfdrive.car.chrysler.values import CAR as CHRYSLER
 from selfdrive.car.hyundai.values import CAR as HYUNDAI
+from selfdrive.test.can_cache import load_can
 from selfdrive.test.test_routes import routes, non_tested_cars
 from selfdrive.test.openpilotci import get_url
-from tools.lib.logreader import LogReader
 
 from panda.tests.safety import libpandasafety_py
 from panda.tests.safety.common import package_can_msg
@@ -34,6 +38,7 @@ ignore_carstate_check = [
   CHRYSLER.PACIFICA_2017_HYBRID,
 ]
 
+# every car is its own class, which only shares the can cache on disk with the others
 @parameterized_class(('car_model'), [(car,) for car in all_known_cars()])
 class TestCarModel(unittest.TestCase):
 
@@ -49,21 +54,15 @@ class TestCarModel(unittest.TestCase):
 
     for seg in [2, 1, 0]:
       try:
-        lr = LogReader(get_url(ROUTES[cls.car_model], seg))
+        can = load_can(get_url(ROUTES[cls.car_model], seg))
         break
       except Exception:
         if seg == 0:
           raise
 
-    can_msgs = []
-    fingerprint = {i: dict() for i in range(3)}
-    for msg in lr:
-      if msg.which() == "can":
-        for m in msg.can:
-          if m.src < 128:
-            fingerprint[m.src][m.address] = len(m.dat)
-        can_msgs.append(msg)
-    cls.can_msgs = sorted(can_msgs, key=lambda msg: msg.logMonoTime)
+    # serialized can events and their (address, busTime, dat, src) frames
+    cls.can_msgs = list(can)
+    fingerprint = can.fingerprint()
 
     CarInterface, CarController, CarState = interfaces[cls.car_model]
 
@@ -101,8 +100,8 @@ class TestCarModel(unittest.TestCase):
     # TODO: also check for checkusm and counter violations from can parser
     can_invalid_cnt = 0
     CC = car.CarControl.new_message()
-    for i, msg in enumerate(self.can_msgs):
-      CS = self.CI.update(CC, (msg.as_builder().to_bytes(),))
+    for i, (msg, _) in enumerate(self.can_msgs):
+      CS = self.CI.update(CC, (msg,))
       self.CI.apply(CC)
 
       # wait 2s for low frequency msgs to be seen
@@ -119,8 +118,8 @@ class TestCarModel(unittest.TestCase):
     assert RI
 
     error_cnt = 0
-    for msg in self.can_msgs:
-      radar_data = RI.update((msg.as_builder().to_bytes(),))
+    for msg, _ in self.can_msgs:
+      radar_data = RI.update((msg,))
       if radar_data is not None:
         error_cnt += car.RadarData.Error.canError in radar_data.errors
     self.assertLess(error_cnt, 20)
@@ -134,13 +133,13 @@ class TestCarModel(unittest.TestCase):
     self.assertEqual(0, set_status)
 
     failed_addrs = Counter()
-    for can in self.can_msgs:
-      for msg in can.can:
-        if msg.src >= 128:
+    for _, frames in self.can_msgs:
+      for address, _, dat, src in frames:
+        if src >= 128:
           continue
-        to_send = package_can_msg([msg.address, 0, msg.dat, msg.src])
+        to_send = package_can_msg([address, 0, dat, src])
         if not safety.safety_rx_hook(to_send):
-          failed_addrs[hex(msg.address)] += 1
+          failed_addrs[hex(address)] += 1
     self.assertFalse(len(failed_addrs), f"panda safety RX check failed: {failed_addrs}")
 
   def test_panda_safety_carstate(self):
@@ -155,13 +154,13 @@ class TestCarModel(unittest.TestCase):
 
     checks = defaultdict(lambda: 0)
     CC = car.CarControl.new_message()
-    for can in self.can_msgs:
-      for msg in can.can:
-        if msg.src >= 128:
+    for can, frames in self.can_msgs:
+      for address, _, dat, src in frames:
+        if src >= 128:
           continue
-        to_send = package_can_msg([msg.address, 0, msg.dat, msg.src])
+        to_send = package_can_msg([address, 0, dat, src])
         safety.safety_rx_hook(to_send)
-      CS = self.CI.update(CC, (can.as_builder().to_bytes(),))
+      CS = self.CI.update(CC, (can,))
 
       # TODO: check steering state
       # check that openpilot and panda safety agree on the car's state
@@ -185,5 +184,32 @@ class TestCarModel(unittest.TestCase):
 
     self.assertFalse(len(failed_checks), f"panda safety doesn't agree with CarState: {failed_checks}")
 
+def init_worker(run_dir):
+  # car interfaces can read params, so every worker gets its own, removed with run_dir.
+  # the can cache dir was resolved on import, so it's still shared
+  os.environ['HOME'] = tempfile.mkdtemp(dir=run_dir)
+
+
+def run_car_tests(cls_name):
+  suite = unittest.defaultTestLoader.loadTestsFromName(cls_name, sys.modules[__name__])
+  stream = io.StringIO()
+  result = unittest.TextTestRunner(stream=stream, verbosity=2).run(suite)
+  return stream.getvalue(), result.testsRun, len(result.failures) + len(result.errors), len(result.skipped)
+
+
 if __name__ == "__main__":
-  unittest.main()
+  # without args every car class runs in its own process, otherwise it's plain unittest
+  if len(sys.argv) > 1:
+    unittest.main()
+
+  car_classes = [name for name, obj in list(globals().items())
+                 if isinstance(obj, type) and issubclass(obj, TestCarModel) and obj is not TestCarModel]
+  ran, failed, skipped = 0, 0, 0
+  # removed by the main process, workers don't run atexit handlers
+  with tempfile.TemporaryDirectory(prefix="test_models_") as run_dir, \
+       multiprocessing.Pool(int(os.getenv("JOBS", str(os.cpu_count()))), initializer=init_worker, initargs=(run_dir,)) as pool:
+    for output, n, n_failed, n_skipped in pool.imap_unordered(run_car_tests, car_classes):
+      print(output, end="")
+      ran, failed, skipped = ran + n, failed + n_failed, skipped + n_skipped
+  print(f"Ran {ran} tests in {len(car_classes)} car classes, {failed} failed, {skipped} skipped")
+  sys.exit(int(failed > 0))
@@ -4,9 +4,11 @@ import os
 import subprocess
 import time
 import unittest
-from collections import Counter
+from collections import Counter, defaultdict
 from pathlib import Path
 
+import numpy as np
+
 import cereal.messaging as messaging
 from cereal.services import service_list
 from common.basedir import BASEDIR
@@ -16,79 +18,167 @@ from selfdrive.loggerd.config import ROOT
 from selfdrive.test.helpers import set_params_enabled
 from tools.lib.logreader import LogReader
 
-# Baseline CPU usage by process
-PROCS = {
-  "selfdrive.controls.controlsd": 50.0,
-  "./loggerd": 45.0,
-  "./locationd": 9.1,
-  "selfdrive.controls.plannerd": 20.0,
-  "./_ui": 15.0,
-  "selfdrive.locationd.paramsd": 9.1,
-  "./camerad": 7.07,
-  "./_sensord": 6.17,
-  "selfdrive.controls.radard": 5.67,
-  "./_modeld": 4.48,
-  "./boardd": 3.63,
-  "./_dmonitoringmodeld": 2.67,
-  "selfdrive.thermald.thermald": 2.41,
-  "selfdrive.locationd.calibrationd": 2.0,
-  "selfdrive.monitoring.dmonitoringd": 1.90,
-  "./proclogd": 1.54,
-  "selfdrive.logmessaged": 0.2,
-  "./clocksd": 0.02,
-  "./ubloxd": 0.02,
-  "selfdrive.tombstoned": 0,
-  "./logcatd": 0,
-}
-
-if TICI:
-  PROCS.update({
-    "./loggerd": 60.0,
-    "selfdrive.controls.controlsd": 26.0,
-    "./camerad": 25.0,
-    "selfdrive.controls.plannerd": 12.0,
-    "selfdrive.locationd.paramsd": 5.0,
-    "./_dmonitoringmodeld": 10.0,
-    "selfdrive.thermald.thermald": 1.5,
-  })
+# Baseline CPU usage by process and publish interval jitter by service, per device.
+# Bump the version when what's measured changes, and rerun with UPDATE_BASELINE=1
+BASELINE_PATH = os.path.join(BASEDIR, "selfdrive/test/onroad_baseline.json")
+BASELINE_VERSION = 1
+UPDATE_BASELINE = os.getenv("UPDATE_BASELINE") is not None
+DEVICE = "tici" if TICI else "eon"
+
+# a difference from the baseline needs a one sided t statistic this big to count, roughly p < 0.005
+T_CRITICAL = 3.0
+
+# CPU usage has to grow by this factor and this many percent to count as a regression
+CPU_REGRESSION_FACTOR = 1.05
+CPU_REGRESSION_MARGIN = 1.0
+
+# jitter has to grow by this factor and this many ms to count as a regression
+JITTER_FACTOR = 1.5
+JITTER_MARGIN_MS = 1.0
+
+# a service is periodic when its median interval is this close to its period, relative to the period.
+# services published on events or in bursts have a rate, but no jitter to speak of
+PERIODIC_TOLERANCE = 0.2
+
+
+def load_baseline():
+  with open(BASELINE_PATH) as f:
+    baseline = json.load(f)
+  if baseline["version"] != BASELINE_VERSION:
+    raise Exception(f"baseline is version {baseline['version']}, expected {BASELINE_VERSION}. Rerun with UPDATE_BASELINE=1")
+  return baseline[DEVICE]
+
+
+def update_baseline(proclogs, jitter):
+  with open(BASELINE_PATH) as f:
+    baseline = json.load(f)
+  baseline["version"] = BASELINE_VERSION
+
+  # the list of processes is maintained by hand, only their numbers are updated
+  procs = baseline.get(DEVICE, {}).get("cpu", {})
+  cpu_usage = get_cpu_usage(proclogs, procs)
+  baseline[DEVICE] = {
+    "cpu": {proc_name: round(float(np.mean(cpu_usage[proc_name])), 2) if len(cpu_usage.get(proc_name, [])) else usage
+            for proc_name, usage in procs.items()},
+    "jitter": {s: {k: round(float(v), 3) for k, v in jitter_stats(j).items()} for s, j in sorted(jitter.items())},
+  }
+  with open(BASELINE_PATH, "w") as f:
+    json.dump(baseline, f, indent=2)
+    f.write("\n")
 
 
 def cputime_total(ct):
   return ct.cpuUser + ct.cpuSystem + ct.cpuChildrenUser + ct.cpuChildrenSystem
 
 
-def check_cpu_usage(first_proc, last_proc):
+def get_cpu_usage(proclogs, proc_names):
+  """Returns the CPU usage in % of each process between consecutive procLogs."""
+  t = np.array([m.logMonoTime for m in proclogs]) / 1e9
+  cpu_usage = {}
+  for proc_name in proc_names:
+    cputime = np.array([next((cputime_total(p) for p in m.procLog.procs if proc_name in p.cmdline), np.nan) for m in proclogs])
+    usage = np.diff(cputime) / np.diff(t) * 100.
+    cpu_usage[proc_name] = usage[np.isfinite(usage)]
+  return cpu_usage
+
+
+def get_jitter(lr):
+  """Returns how far each interval between msgs of a service is off its period in ms, for every periodic service."""
+  mono_times = defaultdict(list)
+  for m in lr:
+    mono_times[m.which()].append(m.logMonoTime)
+
+  jitter = {}
+  for s, t in mono_times.items():
+    if s not in service_list or service_list[s].frequency <= 0 or len(t) < 2:
+      continue
+    period = 1e3 / service_list[s].frequency
+    j = np.abs(np.diff(sorted(t)) / 1e6 - period)
+    if np.median(j) < PERIODIC_TOLERANCE * period:
+      jitter[s] = j
+  return jitter
+
+
+def jitter_stats(jitter):
+  p50, p95, p99 = np.percentile(jitter, [50, 95, 99])
+  return {"mean": np.mean(jitter), "p50": p50, "p95": p95, "p99": p99, "max": np.max(jitter)}
+
+
+def t_statistic(samples, mean):
+  # one sample t-test of samples against the baseline mean
+  if len(samples) < 2:
+    return 0.
+  diff = np.mean(samples) - mean
+  std = np.std(samples, ddof=1)
+  if std == 0:
+    return np.copysign(np.inf, diff) if diff else 0.
+  return diff / (std / np.sqrt(len(samples)))
+
+
+def check_cpu_usage(cpu_usage, baseline):
   result =  "------------------------------------------------\n"
   result += "------------------ CPU Usage -------------------\n"
   result += "------------------------------------------------\n"
+  result += f"{'process'.ljust(35)}  {'mean':>7}  {'p95':>7}  {'base':>7}\n"
 
   r = True
-  dt = (last_proc.logMonoTime - first_proc.logMonoTime) / 1e9
-  for proc_name, normal_cpu_usage in PROCS.items():
-    first, last = None, None
-    try:
-      first = [p for p in first_proc.procLog.procs if proc_name in p.cmdline][0]
-      last = [p for p in last_proc.procLog.procs if proc_name in p.cmdline][0]
-      cpu_time = cputime_total(last) - cputime_total(first)
-      cpu_usage = cpu_time / dt * 100.
-      if cpu_usage > max(normal_cpu_usage * 1.1, normal_cpu_usage + 5.0):
-        # TODO: fix high CPU when playing sounds constantly in UI
-        if proc_name == "./_ui" and cpu_usage < 50.:
-          continue
-        result += f"Warning {proc_name} using more CPU than normal\n"
-        r = False
-      elif cpu_usage < min(normal_cpu_usage * 0.65, max(normal_cpu_usage - 1.0, 0.0)):
-        result += f"Warning {proc_name} using less CPU than normal\n"
-        r = False
-      result += f"{proc_name.ljust(35)}  {cpu_usage:.2f}%\n"
-    except IndexError:
-      result += f"{proc_name.ljust(35)}  NO METRICS FOUND {first=} {last=}\n"
+  for proc_name, normal_cpu_usage in baseline.items():
+    usage = cpu_usage.get(proc_name, [])
+    if not len(usage):
+      result += f"{proc_name.ljust(35)}  NO METRICS FOUND\n"
       r = False
+      continue
+
+    # way off the normal usage fails no matter how noisy the samples are
+    mean = np.mean(usage)
+    if mean > max(normal_cpu_usage * 1.1, normal_cpu_usage + 5.0):
+      # TODO: fix high CPU when playing sounds constantly in UI
+      if proc_name == "./_ui" and mean < 50.:
+        continue
+      result += f"Warning {proc_name} using more CPU than normal\n"
+      r = False
+    elif mean < min(normal_cpu_usage * 0.65, max(normal_cpu_usage - 1.0, 0.0)):
+      result += f"Warning {proc_name} using less CPU than normal\n"
+      r = False
+    elif mean > max(normal_cpu_usage * CPU_REGRESSION_FACTOR, normal_cpu_usage + CPU_REGRESSION_MARGIN) and \
+         t_statistic(usage, normal_cpu_usage) > T_CRITICAL and proc_name != "./_ui":
+      result += f"Warning {proc_name} using significantly more CPU than the baseline\n"
+      r = False
+    result += f"{proc_name.ljust(35)}  {mean:6.2f}%  {np.percentile(usage, 95):6.2f}%  {normal_cpu_usage:6.2f}%\n"
   result += "------------------------------------------------\n"
   print(result)
   return r
 
 
+def check_jitter(jitter, baseline):
+  result =  "------------------------------------------------------------------\n"
+  result += "------------------ Publish interval jitter (ms) ------------------\n"
+  result += "------------------------------------------------------------------\n"
+  result += f"{'service'.ljust(25)}  {'p50':>7}  {'p95':>7}  {'p99':>7}  {'max':>7}  {'base p99':>8}\n"
+
+  r = True
+  for s in sorted(baseline.keys() - jitter.keys()):
+    result += f"Warning {s} not publishing periodically anymore\n"
+    r = False
+
+  for s, j in sorted(jitter.items()):
+    stats = jitter_stats(j)
+    base = baseline.get(s)
+    if base is None:
+      # only reported until a baseline is recorded on this device
+      result += f"{s} not in the jitter baseline, rerun with UPDATE_BASELINE=1 to gate it\n"
+    else:
+      regressed = stats["mean"] > max(base["mean"] * JITTER_FACTOR, base["mean"] + JITTER_MARGIN_MS)
+      if regressed and t_statistic(j, base["mean"]) > T_CRITICAL:
+        result += f"Warning {s} publishing less regularly than normal\n"
+        r = False
+    base_p99 = f"{base['p99']:8.2f}" if base is not None else f"{'-':>8}"
+    result += f"{s.ljust(25)}  {stats['p50']:7.2f}  {stats['p95']:7.2f}  {stats['p99']:7.2f}  {stats['max']:7.2f}  {base_p99}\n"
+  result += "------------------------------------------------------------------\n"
+  print(result)
+  return r
+
+
 class TestOnroad(unittest.TestCase):
 
   @classmethod
@@ -129,6 +219,12 @@ class TestOnroad(unittest.TestCase):
         proc.kill()
 
     cls.lr = list(LogReader(os.path.join(str(cls.segments[1]), "rlog.bz2")))
+    cls.proclogs = [m for m in cls.lr if m.which() == 'procLog']
+    cls.jitter = get_jitter(cls.lr)
+
+    if UPDATE_BASELINE:
+      update_baseline(cls.proclogs, cls.jitter)
+    cls.baseline = load_baseline()
 
   def test_cloudlog_size(self):
     msgs = [m for m in self.lr if m.which() == 'logMessage']
@@ -141,11 +237,15 @@ class TestOnroad(unittest.TestCase):
     self.assertEqual(len(big_logs), 0, f"Log spam: {big_logs}")
 
   def test_cpu_usage(self):
-    proclogs = [m for m in self.lr if m.which() == 'procLog']
-    self.assertGreater(len(proclogs), service_list['procLog'].frequency * 45, "insufficient samples")
-    cpu_ok = check_cpu_usage(proclogs[0], proclogs[-1])
+    self.assertGreater(len(self.proclogs), service_list['procLog'].frequency * 45, "insufficient samples")
+    cpu_usage = get_cpu_usage(self.proclogs, self.baseline["cpu"])
+    cpu_ok = check_cpu_usage(cpu_usage, self.baseline["cpu"])
     self.assertTrue(cpu_ok)
 
+  def test_jitter(self):
+    jitter_ok = check_jitter(self.jitter, self.baseline["jitter"])
+    self.assertTrue(jitter_ok)
+
 
 if __name__ == "__main__":
   unittest.main()
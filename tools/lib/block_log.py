@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""Seekable block compressed log files.
+
+Events are grouped into blocks of about BLOCK_SIZE bytes, which are compressed
+independently. A table with the offset and sizes of every block is stored at
+the end of the file, so blocks can be decompressed in parallel or on their own.
+
+  MAGIC | block 0 | ... | block n-1 | table (n x offset, size, raw size) | table offset, n | MAGIC
+"""
+import os
+import sys
+import mmap
+import zlib
+import struct
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+
+MAGIC = b"OPBLOCK1"
+BLOCK_SIZE = 1024 * 1024
+COMPRESSION_LEVEL = 3
+
+_TABLE_ENTRY = struct.Struct("<QQQ")
+_FOOTER = struct.Struct("<QQ8s")
+
+
+def write_block_log(f, dat, boundaries):
+  """Writes decompressed log data to the file object f as a block log.
+
+     boundaries are the offsets in dat where events end, blocks are only split there.
+  """
+  table = []
+  offset = f.write(MAGIC)
+
+  begin = 0
+  for end in boundaries:
+    if end - begin < BLOCK_SIZE and end != len(dat):
+      continue
+    block = zlib.compress(dat[begin:end], COMPRESSION_LEVEL)
+    table.append((offset, len(block), end - begin))
+    offset += f.write(block)
+    begin = end
+
+  for entry in table:
+    f.write(_TABLE_ENTRY.pack(*entry))
+  f.write(_FOOTER.pack(offset, len(table), MAGIC))
+
+
+def _read_table(m):
+  table_offset, num_blocks, magic = _FOOTER.unpack_from(m, len(m) - _FOOTER.size)
+  if magic != MAGIC or m[:len(MAGIC)] != MAGIC:
+    raise ValueError("not a block log")
+  return [_TABLE_ENTRY.unpack_from(m, table_offset + i * _TABLE_ENTRY.size) for i in range(num_blocks)]
+
+
+def _decompress_block(m, entry):
+  offset, size, raw_size = entry
+  with memoryview(m) as view:
+    dat = zlib.decompress(view[offset:offset + size])
+  assert len(dat) == raw_size
+  return dat
+
+
+def read_block_log(fn, workers=None):
+  """Returns the decompressed contents of a block log, decompressing blocks in parallel."""
+  workers = workers if workers is not None else multiprocessing.cpu_count()
+  with open(fn, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+    table = _read_table(m)
+    # zlib releases the GIL, so threads are enough
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+      return b"".join(pool.map(lambda entry: _decompress_block(m, entry), table))
+
+
+def iter_block_log(fn, first_block=0):
+  """Yields the decompressed blocks of a block log one at a time."""
+  with open(fn, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+    for entry in _read_table(m)[first_block:]:
+      yield _decompress_block(m, entry)
+
+
+if __name__ == "__main__":
+  from tools.lib.logreader import convert_log
+
+  for log_path in sys.argv[1:]:
+    dest = convert_log(log_path)
+    print(f"{log_path} -> {dest} ({os.path.getsize(dest) / 1e6:.1f} MB)")
@@ -0,0 +1,230 @@
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from tools.lib.file_helpers import atomic_write_in_dir, mkdirs_exists_ok
+
+INDEX_NAME = "index.db"
+
+# files of the URLFile cache from before the index, chunks were named after their position / CHUNK_SIZE as a float
+OLD_CHUNK_RE = re.compile(r"^([0-9a-f]{64})_(\d+)\.0$")
+OLD_LENGTH_RE = re.compile(r"^([0-9a-f]{64})_length$")
+
+# seconds between writes of the last access times of cache hits, which are kept in memory until then
+ACCESS_FLUSH_INTERVAL = 1.
+
+
+class ChunkCache(object):
+  """Size capped disk cache for downloaded file chunks.
+
+     Chunks are stored one per file, with a single sqlite index tracking their
+     size and last access time. When the cache grows past max_size the least
+     recently used chunks are evicted. The index is shared by all processes
+     using the same cache directory, and keeps the total size of the chunks
+     up to date with triggers.
+  """
+  def __init__(self, cache_dir, max_size):
+    self.cache_dir = cache_dir
+    self.max_size = max_size
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self._index_path = os.path.join(cache_dir, INDEX_NAME)
+    self._tlocal = threading.local()
+    self._stats_lock = threading.Lock()
+    # (time, url_hash, first chunk, last chunk) of hits whose access time isn't written yet
+    self._accessed = []
+    self._accessed_lock = threading.Lock()
+    self._last_flush = time.monotonic()
+
+  def _db(self):
+    # sqlite connections can't be shared between threads. Reconnect if the
+    # cache directory was removed from under us.
+    db = getattr(self._tlocal, "db", None)
+    try:
+      inode = os.stat(self._index_path).st_ino
+    except FileNotFoundError:
+      inode = None
+    if db is None or inode != self._tlocal.inode:
+      mkdirs_exists_ok(self.cache_dir)
+      db = sqlite3.connect(self._index_path, timeout=60, isolation_level=None)
+      db.execute("PRAGMA journal_mode=WAL")
+      # INSERT OR REPLACE only fires the delete trigger with this
+      db.execute("PRAGMA recursive_triggers=ON")
+      db.execute("CREATE TABLE IF NOT EXISTS chunks (url_hash TEXT, chunk INTEGER, size INTEGER, last_access REAL, "
+                 "PRIMARY KEY (url_hash, chunk))")
+      db.execute("CREATE INDEX IF NOT EXISTS chunks_last_access ON chunks (last_access)")
+      db.execute("CREATE TABLE IF NOT EXISTS lengths (url_hash TEXT PRIMARY KEY, length INTEGER)")
+      db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+      db.execute("CREATE TABLE IF NOT EXISTS total_size (size INTEGER)")
+      db.execute("CREATE TRIGGER IF NOT EXISTS chunks_insert AFTER INSERT ON chunks "
+                 "BEGIN UPDATE total_size SET size = size + new.size; END")
+      db.execute("CREATE TRIGGER IF NOT EXISTS chunks_delete AFTER DELETE ON chunks "
+                 "BEGIN UPDATE total_size SET size = size - old.size; END")
+      db.execute("CREATE TRIGGER IF NOT EXISTS chunks_update AFTER UPDATE OF size ON chunks "
+                 "BEGIN UPDATE total_size SET size = size - old.size + new.size; END")
+      # once the triggers exist, for indices from before them
+      db.execute("INSERT INTO total_size SELECT COALESCE(SUM(size), 0) FROM chunks "
+                 "WHERE NOT EXISTS (SELECT 1 FROM total_size)")
+      self._tlocal.db = db
+      self._tlocal.inode = os.stat(self._index_path).st_ino
+      if self._migrate(db):
+        self._evict()
+    return db
+
+  def _migrate(self, db):
+    """Adds the chunk and length files of the old cache format to the index, once per cache directory.
+
+       Returns whether anything was migrated.
+    """
+    db.execute("BEGIN IMMEDIATE")
+    try:
+      if db.execute("SELECT value FROM meta WHERE key = 'migrated'").fetchone() is not None:
+        db.execute("COMMIT")
+        return False
+
+      migrated = False
+      for fn in os.listdir(self.cache_dir):
+        path = os.path.join(self.cache_dir, fn)
+        chunk_match, length_match = OLD_CHUNK_RE.match(fn), OLD_LENGTH_RE.match(fn)
+        try:
+          if chunk_match:
+            url_hash, chunk = chunk_match.group(1), int(chunk_match.group(2))
+            new_path = self.chunk_path(url_hash, chunk)
+            os.replace(path, new_path)
+            st = os.stat(new_path)
+            db.execute("INSERT OR REPLACE INTO chunks VALUES (?, ?, ?, ?)", (url_hash, chunk, st.st_size, st.st_mtime))
+            migrated = True
+          elif length_match:
+            with open(path) as f:
+              length = int(f.read())
+            db.execute("INSERT OR IGNORE INTO lengths VALUES (?, ?)", (length_match.group(1), length))
+            os.remove(path)
+            migrated = True
+        except (OSError, ValueError):
+          pass
+      db.execute("INSERT INTO meta VALUES ('migrated', '1')")
+      db.execute("COMMIT")
+    except Exception:
+      db.execute("ROLLBACK")
+      raise
+    return migrated
+
+  def chunk_path(self, url_hash, chunk):
+    return os.path.join(self.cache_dir, f"{url_hash}_{chunk}")
+
+  def lookup(self, url_hash, chunks, count=True):
+    """Returns the subset of chunks that is cached, and marks them as recently used.
+
+       count=False doesn't add the lookup to the hit/miss counters, e.g. for prefetching.
+    """
+    chunks = list(chunks)
+    if not chunks:
+      return set()
+
+    db = self._db()
+    rows = db.execute("SELECT chunk FROM chunks WHERE url_hash = ? AND chunk BETWEEN ? AND ?",
+                      (url_hash, min(chunks), max(chunks))).fetchall()
+    cached = {r[0] for r in rows} & set(chunks)
+    if cached:
+      with self._accessed_lock:
+        self._accessed.append((time.time(), url_hash, min(cached), max(cached)))
+      self._flush_accessed()
+
+    if count:
+      with self._stats_lock:
+        self.hits += len(cached)
+        self.misses += len(chunks) - len(cached)
+    return cached
+
+  def _flush_accessed(self, force=False):
+    # writes the last access times of hits, every ACCESS_FLUSH_INTERVAL instead of on each hit
+    with self._accessed_lock:
+      if not self._accessed or (not force and time.monotonic() - self._last_flush < ACCESS_FLUSH_INTERVAL):
+        return
+      accessed, self._accessed = self._accessed, []
+      self._last_flush = time.monotonic()
+
+    db = self._db()
+    db.execute("BEGIN IMMEDIATE")
+    try:
+      db.executemany("UPDATE chunks SET last_access = ? WHERE url_hash = ? AND chunk BETWEEN ? AND ?", accessed)
+      db.execute("COMMIT")
+    except Exception:
+      db.execute("ROLLBACK")
+      raise
+
+  def _total_size(self, db):
+    return db.execute("SELECT size FROM total_size").fetchone()[0]
+
+  def put(self, url_hash, chunk, data):
+    db = self._db()  # creates the cache directory
+    with atomic_write_in_dir(self.chunk_path(url_hash, chunk), mode="wb", overwrite=True) as f:
+      f.write(data)
+    db.execute("INSERT OR REPLACE INTO chunks VALUES (?, ?, ?, ?)", (url_hash, chunk, len(data), time.time()))
+    self._evict()
+
+  def _evict(self):
+    db = self._db()
+    if self._total_size(db) <= self.max_size:
+      return
+
+    # the least recently used chunks go first, including hits not written yet
+    self._flush_accessed(force=True)
+    db.execute("BEGIN IMMEDIATE")
+    try:
+      total = self._total_size(db)
+      evicted = []
+      if total > self.max_size:
+        for url_hash, chunk, size in db.execute("SELECT url_hash, chunk, size FROM chunks ORDER BY last_access"):
+          if total <= self.max_size:
+            break
+          evicted.append((url_hash, chunk))
+          total -= size
+        db.executemany("DELETE FROM chunks WHERE url_hash = ? AND chunk = ?", evicted)
+      db.execute("COMMIT")
+    except Exception:
+      db.execute("ROLLBACK")
+      raise
+
+    for url_hash, chunk in evicted:
+      try:
+        os.remove(self.chunk_path(url_hash, chunk))
+      except FileNotFoundError:
+        pass
+    with self._stats_lock:
+      self.evictions += len(evicted)
+
+  def remove(self, url_hash):
+    """Removes all chunks of url_hash from the cache."""
+    db = self._db()
+    chunks = [r[0] for r in db.execute("SELECT chunk FROM chunks WHERE url_hash = ?", (url_hash,))]
+    db.execute("DELETE FROM chunks WHERE url_hash = ?", (url_hash,))
+    for chunk in chunks:
+      try:
+        os.remove(self.chunk_path(url_hash, chunk))
+      except FileNotFoundError:
+        pass
+
+  def get_length(self, url_hash):
+    row = self._db().execute("SELECT length FROM lengths WHERE url_hash = ?", (url_hash,)).fetchone()
+    return row[0] if row is not None else None
+
+  def put_length(self, url_hash, length):
+    self._db().execute("INSERT OR REPLACE INTO lengths VALUES (?, ?)", (url_hash, length))
+
+  def stats(self):
+    db = self._db()
+    size, count = self._total_size(db), db.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+    lookups = self.hits + self.misses
+    return {
+      'hits': self.hits,
+      'misses': self.misses,
+      'hit_rate': self.hits / lookups if lookups else 0.,
+      'evictions': self.evictions,
+      'size': size,
+      'chunks': count,
+      'max_size': self.max_size,
+    }
@@ -1,22 +1,25 @@
 # pylint: skip-file
+import hashlib
 import json
+import multiprocessing
 import os
-import pickle
 import queue
-import struct
+import shutil
+import sqlite3
 import subprocess
 import tempfile
 import threading
-from functools import wraps
+import urllib.parse
+from collections import defaultdict
 
 import numpy as np
 from aenum import Enum
 from lru import LRU
 
-import _io
 from tools.lib.cache import cache_path_for_file_path
+from tools.lib.chunk_cache import ChunkCache
 from tools.lib.exceptions import DataUnreadableError
-from tools.lib.file_helpers import atomic_write_in_dir
+from tools.lib.file_helpers import atomic_write_in_dir, mkdirs_exists_ok
 
 try:
   from xx.chffr.lib.filereader import FileReader
@@ -26,11 +29,37 @@ except ImportError:
 HEVC_SLICE_B = 0
 HEVC_SLICE_P = 1
 HEVC_SLICE_I = 2
+HEVC_EOS_NAL = b"\x00\x00\x01\x48\x01"
+
+# Table 7-1, NAL unit types
+HEVC_NAL_SLICE_TYPES = set(range(0, 10)) | set(range(16, 22))
+HEVC_NAL_IRAP_BEGIN, HEVC_NAL_IRAP_END = 16, 23
+HEVC_NAL_SPS = 33
+HEVC_NAL_PARAMETER_SET_TYPES = (32, HEVC_NAL_SPS, 34)  # VPS, SPS, PPS
+
+INDEX_CHUNK_SIZE = 1024 * 1024
+
+# Number of long-lived ffmpeg decoders per output format used for random access, 0 disables them
+FFMPEG_POOL_SIZE = int(os.getenv("FFMPEG_POOL_SIZE", str(multiprocessing.cpu_count())))
+# Seconds a pooled decoder gets for a GOP, after that it's killed and the GOP decoded on its own
+FFMPEG_DECODE_TIMEOUT = float(os.getenv("FFMPEG_DECODE_TIMEOUT", "10"))
+
+# Decoded frames are cached in shared memory, so all processes on a host can reuse them
+FRAME_CACHE_DIR = os.getenv("FRAME_CACHE_DIR", "/dev/shm/comma_frames" if os.path.isdir("/dev/shm") else
+                            os.path.join(tempfile.gettempdir(), "comma_frames"))
+# Size of the frame cache in bytes. By default a quarter of the free space in FRAME_CACHE_DIR up to
+# FRAME_CACHE_MAX_SIZE, /dev/shm is often small in containers. 0 disables the cache.
+FRAME_CACHE_SIZE = os.getenv("FRAME_CACHE_SIZE")
+FRAME_CACHE_MAX_SIZE = 2 * 1000 * 1000 * 1000
+# Recently decoded frames each reader keeps in memory, so it doesn't decode a GOP per frame when the
+# frame cache is disabled or too small to hold a GOP
+READER_LRU_SIZE = 64
 
 
 class GOPReader:
   def get_gop(self, num):
     # returns (start_frame_num, num_frames, frames_to_skip, gop_data)
+    # gop_data is any bytes-like object, e.g. a memoryview
     raise NotImplementedError
 
 
@@ -63,86 +92,191 @@ def fingerprint_video(fn):
     raise NotImplementedError(fn)
 
 
-def ffprobe(fn, fmt=None):
-  cmd = ["ffprobe",
-         "-v", "quiet",
-         "-print_format", "json",
-         "-show_format", "-show_streams"]
-  if fmt:
-    cmd += ["-f", fmt]
-  cmd += [fn]
-
-  try:
-    ffprobe_output = subprocess.check_output(cmd)
-  except subprocess.CalledProcessError:
-    raise DataUnreadableError(fn)
-
-  return json.loads(ffprobe_output)
-
-
-def vidindex(fn, typ):
-  vidindex_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "vidindex")
-  vidindex = os.path.join(vidindex_dir, "vidindex")
-
-  subprocess.check_call(["make"], cwd=vidindex_dir, stdout=open("/dev/null", "w"))
-
-  with tempfile.NamedTemporaryFile() as prefix_f, \
-       tempfile.NamedTemporaryFile() as index_f:
-    try:
-      subprocess.check_call([vidindex, typ, fn, prefix_f.name, index_f.name])
-    except subprocess.CalledProcessError:
-      raise DataUnreadableError("vidindex failed on file %s" % fn)
-    with open(index_f.name, "rb") as f:
-      index = f.read()
-    with open(prefix_f.name, "rb") as f:
-      prefix = f.read()
-
-  index = np.frombuffer(index, np.uint32).reshape(-1, 2)
-
-  assert index[-1, 0] == 0xFFFFFFFF
-  assert index[-1, 1] == os.path.getsize(fn)
+class _BitReader:
+  def __init__(self, dat):
+    self.bits = int.from_bytes(dat, "big")
+    self.pos = len(dat) * 8
+
+  def u(self, n):
+    self.pos -= n
+    if self.pos < 0:
+      raise DataUnreadableError("truncated NAL")
+    return (self.bits >> self.pos) & ((1 << n) - 1)
+
+  def ue(self):
+    # exp-golomb
+    leading_zeros = 0
+    while not self.u(1):
+      leading_zeros += 1
+    return (1 << leading_zeros) - 1 + self.u(leading_zeros)
+
+
+def _hevc_slice_type(nal):
+  # parses the slice_type of a slice segment NAL, None if it isn't the first one of a picture
+  bs = _BitReader(nal[5:13])
+  nal_unit_type = (nal[3] >> 1) & 0x3f
+  first_slice_segment_in_pic_flag = bs.u(1)
+  if HEVC_NAL_IRAP_BEGIN <= nal_unit_type <= HEVC_NAL_IRAP_END:
+    bs.u(1)  # no_output_of_prior_pics_flag
+  bs.u(1)  # slice_pic_parameter_set_id, assumed to be 0
+  if not first_slice_segment_in_pic_flag:
+    return None
+  return bs.ue()
+
+
+def _hevc_sps_size(sps):
+  # parses the cropped (width, height) from an SPS NAL, see 7.3.2.2
+  bs = _BitReader(bytes(sps[5:]).replace(b"\x00\x00\x03", b"\x00\x00"))
+  bs.u(4)  # sps_video_parameter_set_id
+  max_sub_layers_minus1 = bs.u(3)
+  bs.u(1)  # sps_temporal_id_nesting_flag
+
+  # profile_tier_level
+  bs.u(88 + 8)
+  sub_layer_flags = [(bs.u(1), bs.u(1)) for _ in range(max_sub_layers_minus1)]
+  if max_sub_layers_minus1 > 0:
+    bs.u(2 * (8 - max_sub_layers_minus1))
+  for profile_present, level_present in sub_layer_flags:
+    bs.u(88 * profile_present + 8 * level_present)
+
+  bs.ue()  # sps_seq_parameter_set_id
+  chroma_format_idc = bs.ue()
+  separate_colour_plane_flag = bs.u(1) if chroma_format_idc == 3 else 0
+  width, height = bs.ue(), bs.ue()
+  if bs.u(1):  # conformance_window_flag
+    sub_width = 2 if chroma_format_idc in (1, 2) and not separate_colour_plane_flag else 1
+    sub_height = 2 if chroma_format_idc == 1 and not separate_colour_plane_flag else 1
+    left, right, top, bottom = bs.ue(), bs.ue(), bs.ue(), bs.ue()
+    width -= sub_width * (left + right)
+    height -= sub_height * (top + bottom)
+  return width, height
+
+
+def index_hevc_stream(f, chunk_size=INDEX_CHUNK_SIZE):
+  """Indexes an hevc stream read from the file object f in chunks, like vidindex.
+
+     Returns (index, prefix, probe). The index has the slice type and byte offset of every
+     frame, followed by (0xFFFFFFFF, file size). prefix is the VPS, SPS and PPS. probe has
+     the frame size from the SPS, in the format of ffprobe.
+  """
+  buf = bytearray()
+  buf_offset = 0  # position of buf in the stream
+  nal_b = None  # start of the current NAL in buf
+  search_b = 0
+  eof = False
+
+  index, prefix, size = [], [], None
+  while True:
+    nal_e = buf.find(b"\x00\x00\x01", search_b)
+    if nal_e == -1:
+      if eof:
+        # like vidindex, the last 4 bytes are never part of the last NAL
+        nal_e = len(buf) - 4
+      else:
+        search_b = max(len(buf) - 2, 0)
+        if nal_b is not None:
+          # only keep the current NAL
+          del buf[:nal_b]
+          buf_offset += nal_b
+          search_b -= nal_b
+          nal_b = 0
+        chunk = f.read(chunk_size)
+        if len(chunk) == 0:
+          eof = True
+          if buf_offset == 0 and (len(buf) < 4 or buf[0] != 0 or buf[1:4] != b"\x00\x00\x01"):
+            raise DataUnreadableError("not an hevc stream")
+        buf += chunk
+        continue
+
+    if nal_b is None:
+      # the stream begins with a 4 byte start code
+      if nal_e != 1 or buf[0] != 0:
+        raise DataUnreadableError("not an hevc stream")
+      nal_b = nal_e
+      search_b = nal_e + 1
+      continue
+
+    if nal_e - nal_b < 6:
+      break
+
+    nal_unit_type = (buf[nal_b + 3] >> 1) & 0x3f
+    if nal_unit_type in HEVC_NAL_PARAMETER_SET_TYPES:
+      prefix.append(bytes(buf[nal_b:nal_e]))
+      if nal_unit_type == HEVC_NAL_SPS and size is None:
+        size = _hevc_sps_size(prefix[-1])
+    elif nal_unit_type in HEVC_NAL_SLICE_TYPES:
+      slice_type = _hevc_slice_type(buf[nal_b:min(nal_e, nal_b + 13)])
+      if slice_type is not None:
+        index.append((slice_type, buf_offset + nal_b))
+
+    if eof and nal_e == len(buf) - 4:
+      break
+    nal_b = nal_e
+    search_b = nal_e + 1
+
+  if size is None:
+    raise DataUnreadableError("no SPS in hevc stream")
+  probe = {'streams': [{'codec_name': 'hevc', 'width': size[0], 'height': size[1]}]}
+
+  index.append((0xFFFFFFFF, buf_offset + len(buf)))
+  return np.array(index, dtype=np.uint32), b"".join(prefix), probe
+
+
+def _video_index_paths(fn, cache_prefix=None):
+  # the frame index is stored as a .npy so it can be mmapped, the rest as json
+  cache_path = cache_path_for_file_path(fn, cache_prefix)
+  return cache_path + "_vidindex.npy", cache_path + "_vidindex.json"
 
-  return index, prefix
 
+def save_video_index(fn, index_data, cache_prefix=None):
+  index_path, meta_path = _video_index_paths(fn, cache_prefix)
+  with atomic_write_in_dir(index_path, mode="wb", overwrite=True) as f:
+    np.save(f, np.ascontiguousarray(index_data['index'], dtype=np.uint32))
+  # written last, an index only counts as cached once this exists
+  with atomic_write_in_dir(meta_path, mode="w", overwrite=True) as f:
+    json.dump({'global_prefix': index_data['global_prefix'].hex(), 'probe': index_data['probe']}, f)
 
-def cache_fn(func):
-  @wraps(func)
-  def cache_inner(fn, *args, **kwargs):
-    if kwargs.pop('no_cache', None):
-      cache_path = None
-    else:
-      cache_prefix = kwargs.pop('cache_prefix', None)
-      cache_path = cache_path_for_file_path(fn, cache_prefix)
 
-    if cache_path and os.path.exists(cache_path):
-      with open(cache_path, "rb") as cache_file:
-        cache_value = pickle.load(cache_file)
-    else:
-      cache_value = func(fn, *args, **kwargs)
+def load_video_index(fn, cache_prefix=None):
+  """Returns the cached index of a video, or None if it isn't cached.
 
-      if cache_path:
-        with atomic_write_in_dir(cache_path, mode="wb", overwrite=True) as cache_file:
-          pickle.dump(cache_value, cache_file, -1)
-
-    return cache_value
+     The frame index is memory mapped, so this doesn't depend on the length of the video.
+  """
+  index_path, meta_path = _video_index_paths(fn, cache_prefix)
+  try:
+    with open(meta_path) as f:
+      meta = json.load(f)
+    index = np.load(index_path, mmap_mode='r')
+  except FileNotFoundError:
+    return None
 
-  return cache_inner
+  return {
+    'index': index,
+    'global_prefix': bytes.fromhex(meta['global_prefix']),
+    'probe': meta['probe'],
+  }
 
 
-@cache_fn
-def index_stream(fn, typ):
+def index_stream(fn, typ, cache_prefix=None, no_cache=False):
   assert typ in ("hevc", )
 
+  if not no_cache:
+    index_data = load_video_index(fn, cache_prefix)
+    if index_data is not None:
+      return index_data
+
+  # index while reading, remote files are never downloaded to disk
   with FileReader(fn) as f:
-    assert os.path.exists(f.name), fn
-    index, prefix = vidindex(f.name, typ)
-    probe = ffprobe(f.name, typ)
+    index, prefix, probe = index_hevc_stream(f)
 
-  return {
+  index_data = {
     'index': index,
     'global_prefix': prefix,
     'probe': probe
   }
+  if not no_cache:
+    save_video_index(fn, index_data, cache_prefix)
+  return index_data
 
 
 def index_videos(camera_paths, cache_prefix=None):
@@ -156,9 +290,7 @@ def index_videos(camera_paths, cache_prefix=None):
 
 
 def index_video(fn, frame_type=None, cache_prefix=None):
-  cache_path = cache_path_for_file_path(fn, cache_prefix)
-
-  if os.path.exists(cache_path):
+  if os.path.exists(_video_index_paths(fn, cache_prefix)[1]):
     return
 
   if frame_type is None:
@@ -171,15 +303,11 @@ def index_video(fn, frame_type=None, cache_prefix=None):
 
 
 def get_video_index(fn, frame_type, cache_prefix=None):
-  cache_path = cache_path_for_file_path(fn, cache_prefix)
-
-  if not os.path.exists(cache_path):
+  index_data = load_video_index(fn, cache_prefix)
+  if index_data is None:
     index_video(fn, frame_type, cache_prefix)
-
-  if not os.path.exists(cache_path):
-    return None
-  with open(cache_path, "rb") as cache_file:
-    return pickle.load(cache_file)
+    index_data = load_video_index(fn, cache_prefix)
+  return index_data
 
 
 def read_file_check_size(f, sz, cookie):
@@ -189,28 +317,66 @@ def read_file_check_size(f, sz, cookie):
   return buff
 
 
+YUV_FROM_RGB = np.array([[ 0.299     ,  0.587     ,  0.114      ],
+                         [-0.14714119, -0.28886916,  0.43601035 ],
+                         [ 0.61497538, -0.51496512, -0.10001026 ]])
+# fixed point coefficients, luma in 8 bits so it can be computed in uint16
+Y_FROM_RGB_FP8 = np.round(YUV_FROM_RGB[0] * (1 << 8)).astype(np.uint16)
+UV_FROM_RGB_FP14 = np.round(YUV_FROM_RGB[1:] * (1 << 14)).astype(np.int32)
+
+
+def _planes_to_yuv420(r, g, b, out=None):
+  # converts r, g, b planes of shape (..., h, w) to yuv420p frames
+  h, w = r.shape[-2:]
+  lead = r.shape[:-2]
+  y_len = h * w
+  uv_len = y_len // 4
+  yuv420 = np.empty(lead + (y_len + 2 * uv_len,), dtype=np.uint8) if out is None else out
+
+  r, g, b = (c.astype(np.uint16) for c in (r, g, b))
+  ys = Y_FROM_RGB_FP8[0] * r
+  ys += Y_FROM_RGB_FP8[1] * g
+  ys += Y_FROM_RGB_FP8[2] * b
+  ys >>= 8
+  yuv420[..., :y_len] = ys.reshape(lead + (-1,))
+
+  # chroma is subsampled before the conversion, it is linear
+  r, g, b = ((c[..., ::2, ::2] + c[..., 1::2, ::2] + c[..., ::2, 1::2] + c[..., 1::2, 1::2]).astype(np.int32) for c in (r, g, b))
+  for i, row in enumerate(UV_FROM_RGB_FP14):
+    uvs = ((row[0] * r + row[1] * g + row[2] * b) >> 16) + 128
+    yuv420[..., y_len + i * uv_len:y_len + (i + 1) * uv_len] = uvs.clip(0, 255).reshape(lead + (-1,))
+
+  return yuv420
+
+
 def rgb24toyuv420(rgb):
-  yuv_from_rgb = np.array([[ 0.299     ,  0.587     ,  0.114      ],
-                           [-0.14714119, -0.28886916,  0.43601035 ],
-                           [ 0.61497538, -0.51496512, -0.10001026 ]])
-  img = np.dot(rgb.reshape(-1, 3), yuv_from_rgb.T).reshape(rgb.shape)
+  """Converts rgb24 frames of shape (..., h, w, 3) to yuv420p of shape (..., h*w*3/2)."""
+  return _planes_to_yuv420(rgb[..., 0], rgb[..., 1], rgb[..., 2])
+
+
+def _bayer_planes(imgs):
+  # r, g, b planes of raw frames, green is the average of both greens
+  g = np.add(imgs[..., 0::2, 0::2], imgs[..., 1::2, 1::2], dtype=np.uint16)
+  g >>= 1
+  return imgs[..., 0::2, 1::2], g.astype(np.uint8), imgs[..., 1::2, 0::2]
 
-  y_len = img.shape[0] * img.shape[1]
-  uv_len = y_len / 4
 
-  ys = img[:, :, 0]
-  us = (img[::2, ::2, 1] + img[1::2, ::2, 1] + img[::2, 1::2, 1] + img[1::2, 1::2, 1]) / 4 + 128
-  vs = (img[::2, ::2, 2] + img[1::2, ::2, 2] + img[::2, 1::2, 2] + img[1::2, 1::2, 2]) / 4 + 128
+def debayer(imgs, out=None):
+  """Debayers raw frames of shape (..., 960, 1280) to rgb24 frames at half resolution."""
+  planes = _bayer_planes(imgs)
+  if out is None:
+    out = np.empty(planes[0].shape + (3,), dtype=np.uint8)
+  for c, plane in enumerate(planes):
+    out[..., c] = plane
+  return out
 
-  yuv420 = np.empty(y_len + 2 * uv_len, dtype=img.dtype)
-  yuv420[:y_len] = ys.reshape(-1)
-  yuv420[y_len:y_len + uv_len] = us.reshape(-1)
-  yuv420[y_len + uv_len:y_len + 2 * uv_len] = vs.reshape(-1)
 
-  return yuv420.clip(0, 255).astype('uint8')
+def _scale_args(w, h, scale):
+  # with scale, w and h are the output size and decoded frames are resized to it
+  return ["-vf", f"scale={w}:{h}:flags=fast_bilinear"] if scale else []
 
 
-def decompress_video_data(rawdat, vid_fmt, w, h, pix_fmt):
+def decompress_video_data(rawdat, vid_fmt, w, h, pix_fmt, scale=False):
   # using a tempfile is much faster than proc.communicate for some reason
 
   with tempfile.TemporaryFile() as tmpf:
@@ -228,8 +394,9 @@ def decompress_video_data(rawdat, vid_fmt, w, h, pix_fmt):
        "-f", vid_fmt,
        "-flags2", "showall",
        "-i", "pipe:0",
-       "-threads", threads,
-       "-f", "rawvideo",
+       "-threads", threads] +
+      _scale_args(w, h, scale) +
+      ["-f", "rawvideo",
        "-pix_fmt", pix_fmt,
        "pipe:1"],
       stdin=tmpf, stdout=subprocess.PIPE, stderr=open("/dev/null"))
@@ -266,28 +433,54 @@ class BaseFrameReader:
   def get(self, num, count=1, pix_fmt="yuv420p"):
     raise NotImplementedError
 
+  def get_many(self, frame_ids, pix_fmt="yuv420p"):
+    """Returns the frames in frame_ids, in any order, as one array."""
+    return np.stack([self.get(num, pix_fmt=pix_fmt)[0] for num in frame_ids])
+
 
-def FrameReader(fn, cache_prefix=None, readahead=False, readbehind=False, index_data=None):
-  frame_type = fingerprint_video(fn)
+def frame_shape(w, h, pix_fmt):
+  # shape of a single decoded frame
+  if pix_fmt == "rgb24":
+    return (h, w, 3)
+  elif pix_fmt == "yuv420p":
+    return (h*w*3//2,)
+  elif pix_fmt == "yuv444p":
+    return (3, h, w)
+  else:
+    raise NotImplementedError
+
+
+def FrameReader(fn, cache_prefix=None, readahead=False, readbehind=False, index_data=None, downscale=1):
+  """Opens a video for random access.
+
+     downscale: frames are scaled down by this factor while decoding, hevc only.
+  """
+  if index_data is None:
+    # only hevc streams are indexed, so a cached index saves opening the file
+    index_data = load_video_index(fn, cache_prefix)
+  frame_type = FrameType.h265_stream if index_data else fingerprint_video(fn)
   if frame_type == FrameType.raw:
+    if downscale != 1:
+      raise NotImplementedError("downscale is not supported for raw frames")
     return RawFrameReader(fn)
   elif frame_type in (FrameType.h265_stream,):
     if not index_data:
       index_data = get_video_index(fn, frame_type, cache_prefix)
-    return StreamFrameReader(fn, frame_type, index_data, readahead=readahead, readbehind=readbehind)
+    return StreamFrameReader(fn, frame_type, index_data, readahead=readahead, readbehind=readbehind, downscale=downscale)
   else:
     raise NotImplementedError(frame_type)
 
 
 class RawData:
   def __init__(self, f):
-    self.f = _io.FileIO(f, 'rb')
-    self.lenn = struct.unpack("I", self.f.read(4))[0]
-    self.count = os.path.getsize(f) / (self.lenn+4)
+    self.f = np.memmap(f, dtype=np.uint8, mode='r')
+    self.lenn = int(self.f[:4].view(np.uint32)[0])
+    self.count = len(self.f) // (self.lenn+4)
+    # fixed size records, each is the frame length followed by the frame
+    self.frames = self.f[:self.count * (self.lenn+4)].reshape(self.count, self.lenn+4)[:, 4:]
 
   def read(self, i):
-    self.f.seek((self.lenn+4)*i + 4)
-    return self.f.read(self.lenn)
+    return self.frames[i]
 
 
 class RawFrameReader(BaseFrameReader):
@@ -300,9 +493,22 @@ class RawFrameReader(BaseFrameReader):
     self.w, self.h = 640, 480
 
   def load_and_debayer(self, img):
-    img = np.frombuffer(img, dtype='uint8').reshape(960, 1280)
-    cimg = np.dstack([img[0::2, 1::2], ((img[0::2, 0::2].astype("uint16") + img[1::2, 1::2].astype("uint16")) >> 1).astype("uint8"), img[1::2, 0::2]])
-    return cimg
+    return debayer(np.frombuffer(img, dtype='uint8').reshape(960, 1280))
+
+  def _convert(self, imgs, pix_fmt):
+    # converts a batch of raw frames into one array. Frames are converted one at a
+    # time, so the temporaries stay in cache.
+    imgs = imgs.reshape(-1, 960, 1280)
+    ret = np.empty((len(imgs),) + frame_shape(self.w, self.h, pix_fmt), dtype=np.uint8)
+    for img, out in zip(imgs, ret):
+      if pix_fmt == "rgb24":
+        debayer(img, out)
+      elif pix_fmt == "yuv420p":
+        # straight from the bayer planes, without interleaving rgb first
+        _planes_to_yuv420(*_bayer_planes(img), out)
+      else:
+        raise NotImplementedError
+    return ret
 
   def get(self, num, count=1, pix_fmt="yuv420p"):
     assert self.frame_count is not None
@@ -311,22 +517,17 @@ class RawFrameReader(BaseFrameReader):
     if pix_fmt not in ("yuv420p", "rgb24"):
       raise ValueError("Unsupported pixel format %r" % pix_fmt)
 
-    app = []
-    for i in range(num, num+count):
-      dat = self.rawfile.read(i)
-      rgb_dat = self.load_and_debayer(dat)
-      if pix_fmt == "rgb24":
-        app.append(rgb_dat)
-      elif pix_fmt == "yuv420p":
-        app.append(rgb24toyuv420(rgb_dat))
-      else:
-        raise NotImplementedError
+    return list(self._convert(self.rawfile.frames[num:num+count], pix_fmt))
 
-    return app
+  def get_many(self, frame_ids, pix_fmt="yuv420p"):
+    if pix_fmt not in ("yuv420p", "rgb24"):
+      raise ValueError("Unsupported pixel format %r" % pix_fmt)
+
+    return self._convert(self.rawfile.frames[np.asarray(frame_ids, dtype=np.int64)], pix_fmt)
 
 
 class VideoStreamDecompressor:
-  def __init__(self, vid_fmt, w, h, pix_fmt):
+  def __init__(self, vid_fmt, w, h, pix_fmt, threads=None, showall=False, scale=False):
     self.vid_fmt = vid_fmt
     self.w = w
     self.h = h
@@ -341,7 +542,7 @@ class VideoStreamDecompressor:
 
     self.out_q = queue.Queue()
 
-    threads = os.getenv("FFMPEG_THREADS", "0")
+    threads = os.getenv("FFMPEG_THREADS", "0") if threads is None else str(threads)
     cuda = os.getenv("FFMPEG_CUDA", "0") == "1"
     self.proc = subprocess.Popen(
       ["ffmpeg",
@@ -354,10 +555,12 @@ class VideoStreamDecompressor:
        "-flush_packets", "0",
        # "-fflags", "nobuffer",
        "-vsync", "0",
-       "-f", vid_fmt,
-       "-i", "pipe:0",
-       "-threads", threads,
-       "-f", "rawvideo",
+       "-f", vid_fmt] +
+      (["-flags2", "showall"] if showall else []) +
+      ["-i", "pipe:0",
+       "-threads", threads] +
+      _scale_args(w, h, scale) +
+      ["-f", "rawvideo",
        "-pix_fmt", pix_fmt,
        "pipe:1"],
       stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=open("/dev/null", "wb"))
@@ -365,10 +568,12 @@ class VideoStreamDecompressor:
     def read_thread():
       while True:
         r = self.proc.stdout.read(self.out_size)
-        if len(r) == 0:
+        if len(r) < self.out_size:
+          # empty, or a partial frame if ffmpeg was killed
           break
-        assert len(r) == self.out_size
         self.out_q.put(r)
+      # ffmpeg exited
+      self.out_q.put(None)
 
     self.t = threading.Thread(target=read_thread)
     self.t.daemon = True
@@ -386,6 +591,9 @@ class VideoStreamDecompressor:
 
   def read(self):
     dat = self.out_q.get(block=True)
+    if dat is None:
+      self.out_q.put(None)
+      raise DataUnreadableError("ffmpeg exited")
 
     if self.pix_fmt == "rgb24":
       ret = np.frombuffer(dat, dtype=np.uint8).reshape((self.h, self.w, 3))
@@ -408,8 +616,113 @@ class VideoStreamDecompressor:
     assert self.proc.wait() == 0
 
 
+class PooledVideoDecompressor(VideoStreamDecompressor):
+  """A VideoStreamDecompressor that decodes one GOP at a time and keeps running between GOPs.
+
+     ffmpeg only outputs the last frames of a GOP once more data arrives, so the I-frame
+     at the start of the GOP is written again after it. Its decoded frame is dropped when
+     the next GOP is decoded. End of sequence NALs go before and after it, otherwise a
+     repeated POC makes ffmpeg drop the frame, e.g. when the GOP is only the I-frame or
+     the same GOP is decoded again. Decoding runs single threaded, frame threading would
+     hold back more frames than the I-frame pushes out.
+  """
+  def __init__(self, vid_fmt, w, h, pix_fmt, scale=False):
+    super().__init__(vid_fmt, w, h, pix_fmt, threads=1, showall=True, scale=scale)
+    self.pending_frames = 0
+
+  def decode(self, rawdat, iframe, count, timeout=None):
+    # a hung ffmpeg blocks the writes once the pipe is full as well as the reads,
+    # so it is killed, which fails both
+    watchdog = threading.Timer(timeout, self.kill) if timeout is not None else None
+    if watchdog is not None:
+      watchdog.daemon = True
+      watchdog.start()
+
+    try:
+      self.write(rawdat)
+      self.write(HEVC_EOS_NAL)
+      self.write(iframe)
+      self.write(HEVC_EOS_NAL)
+
+      for _ in range(self.pending_frames):
+        self.read()
+      self.pending_frames = 1
+      return np.stack([self.read() for _ in range(count)])
+    finally:
+      if watchdog is not None:
+        watchdog.cancel()
+
+  def kill(self):
+    self.proc.kill()
+    self.proc.wait()
+
+
+class VideoDecoderPool:
+  """Long-lived ffmpeg decoders that GOPs can be submitted to, instead of starting a
+     new ffmpeg process for every GOP. Up to size decoders run per output format."""
+  def __init__(self, size):
+    self.size = size
+    self._cv = threading.Condition()
+    self._idle = defaultdict(list)
+    self._count = defaultdict(int)
+
+  def _acquire(self, key):
+    with self._cv:
+      while not self._idle[key] and self._count[key] >= self.size:
+        self._cv.wait()
+      if self._idle[key]:
+        return self._idle[key].pop()
+      self._count[key] += 1
+
+    try:
+      return PooledVideoDecompressor(*key)
+    except Exception:
+      self._release(key, None)
+      raise
+
+  def _release(self, key, dec):
+    with self._cv:
+      if dec is not None:
+        self._idle[key].append(dec)
+      else:
+        self._count[key] -= 1
+      self._cv.notify()
+
+  def decode(self, rawdat, iframe, num_frames, skip_frames, vid_fmt, w, h, pix_fmt, scale=False):
+    """Decodes a GOP from get_gop, returning the same frames as decompress_video_data.
+
+       iframe is the encoded first frame of the GOP. A decoder that fails or takes longer
+       than FFMPEG_DECODE_TIMEOUT is killed and replaced, and the GOP is decoded with
+       decompress_video_data instead.
+    """
+    key = (vid_fmt, w, h, pix_fmt, scale)
+    dec = self._acquire(key)
+    try:
+      frames = dec.decode(rawdat, iframe, skip_frames + num_frames, FFMPEG_DECODE_TIMEOUT)
+    except Exception:
+      # a new decoder is started on the next acquire
+      dec.kill()
+      self._release(key, None)
+      frames = decompress_video_data(rawdat, vid_fmt, w, h, pix_fmt, scale)
+    else:
+      self._release(key, dec)
+    return frames[skip_frames:]
+
+
+_decoder_pool = None
+_decoder_pool_lock = threading.Lock()
+
+
+def get_decoder_pool():
+  global _decoder_pool
+  with _decoder_pool_lock:
+    if _decoder_pool is None:
+      _decoder_pool = VideoDecoderPool(FFMPEG_POOL_SIZE)
+    return _decoder_pool
+
+
 class StreamGOPReader(GOPReader):
-  def __init__(self, fn, frame_type, index_data):
+  def __init__(self, fn, frame_type, index_data, downscale=1):
     assert frame_type == FrameType.h265_stream
 
     self.fn = fn
@@ -429,26 +742,27 @@ class StreamGOPReader(GOPReader):
     self.num_prefix_frames = 0
     self.vid_fmt = "hevc"
 
-    i = 0
-    while i < self.index.shape[0] and self.index[i, 0] != HEVC_SLICE_I:
-      i += 1
-    self.first_iframe = i
+    self.frame_count = len(self.index) - 1
 
-    assert self.first_iframe == 0
+    # positions of the I-frames, every GOP starts at one
+    self.iframes = np.flatnonzero(self.index[:self.frame_count, 0] == HEVC_SLICE_I)
+    self.first_iframe = self.iframes[0] if len(self.iframes) else self.frame_count
 
-    self.frame_count = len(self.index) - 1
+    assert self.first_iframe == 0
 
     self.w = probe['streams'][0]['width']
     self.h = probe['streams'][0]['height']
 
-  def _lookup_gop(self, num):
-    frame_b = num
-    while frame_b > 0 and self.index[frame_b, 0] != HEVC_SLICE_I:
-      frame_b -= 1
+    # frames are scaled down by ffmpeg, keeping the size even for yuv420p
+    self.scale = downscale != 1
+    if self.scale:
+      self.w = self.w // downscale // 2 * 2
+      self.h = self.h // downscale // 2 * 2
 
-    frame_e = num + 1
-    while frame_e < (len(self.index) - 1) and self.index[frame_e, 0] != HEVC_SLICE_I:
-      frame_e += 1
+  def _lookup_gop(self, num):
+    i = np.searchsorted(self.iframes, num, side='right')
+    frame_b = int(self.iframes[i - 1]) if i > 0 else 0
+    frame_e = int(self.iframes[i]) if i < len(self.iframes) else self.frame_count
 
     offset_b = self.index[frame_b, 1]
     offset_e = self.index[frame_e, 1]
@@ -461,15 +775,18 @@ class StreamGOPReader(GOPReader):
 
     num_frames = frame_e - frame_b
 
+    prefix = self.prefix
+    if num < self.first_iframe:
+      assert self.prefix_frame_data
+      prefix = self.prefix + self.prefix_frame_data
+
+    # read the GOP straight into one buffer after the prefix
+    rawdat = memoryview(bytearray(len(prefix) + offset_e - offset_b))
+    rawdat[:len(prefix)] = prefix
     with FileReader(self.fn) as f:
       f.seek(offset_b)
-      rawdat = f.read(offset_e - offset_b)
-
-      if num < self.first_iframe:
-        assert self.prefix_frame_data
-        rawdat = self.prefix_frame_data + rawdat
-
-      rawdat = self.prefix + rawdat
+      bytes_read = f.readinto(rawdat[len(prefix):])
+      assert bytes_read == offset_e - offset_b, (bytes_read, offset_e - offset_b)
 
     skip_frames = 0
     if num < self.first_iframe:
@@ -477,6 +794,113 @@ class StreamGOPReader(GOPReader):
 
     return frame_b, num_frames, skip_frames, rawdat
 
+  def get_keyframe_data(self, num):
+    # returns (keyframe_num, keyframe_data) for the I-frame that starts the GOP of num
+    frame_b = self._lookup_gop(num)[0]
+    offset_b, offset_e = self.index[frame_b, 1], self.index[frame_b + 1, 1]
+
+    rawdat = memoryview(bytearray(len(self.prefix) + offset_e - offset_b))
+    rawdat[:len(self.prefix)] = self.prefix
+    with FileReader(self.fn) as f:
+      f.seek(offset_b)
+      bytes_read = f.readinto(rawdat[len(self.prefix):])
+      assert bytes_read == offset_e - offset_b, (bytes_read, offset_e - offset_b)
+
+    return frame_b, rawdat
+
+  def get_iframe(self, frame_b, num_frames, gop_data):
+    # returns the encoded first frame of a GOP returned by get_gop
+    gop_begin = len(gop_data) - (self.index[frame_b + num_frames, 1] - self.index[frame_b, 1])
+    return gop_data[gop_begin:gop_begin + self.index[frame_b + 1, 1] - self.index[frame_b, 1]]
+
+
+_frame_cache = None
+_frame_cache_lock = threading.Lock()
+
+
+def get_frame_cache():
+  """Returns the decoded frame cache shared by all frame readers, see ChunkCache.stats for hit/miss counters."""
+  global _frame_cache
+  with _frame_cache_lock:
+    if _frame_cache is None:
+      if FRAME_CACHE_SIZE is not None:
+        size = int(FRAME_CACHE_SIZE)
+      else:
+        try:
+          mkdirs_exists_ok(FRAME_CACHE_DIR)
+          size = min(shutil.disk_usage(FRAME_CACHE_DIR).free // 4, FRAME_CACHE_MAX_SIZE)
+        except OSError:
+          size = 0
+      _frame_cache = ChunkCache(FRAME_CACHE_DIR, size)
+    return _frame_cache
+
+
+def _reset_after_fork():
+  # the decoders and the frame cache connection belong to the parent
+  global _decoder_pool, _decoder_pool_lock, _frame_cache, _frame_cache_lock
+  _decoder_pool = None
+  _decoder_pool_lock = threading.Lock()
+  _frame_cache = None
+  _frame_cache_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+class FrameCache:
+  """The decoded frames of one video at size (w, h) in the shared frame cache, keyed by (frame, pix_fmt).
+
+     Frames are stored raw, one file per frame, and returned as writable copies. The least
+     recently used frames are evicted once the cache is over its size, see FRAME_CACHE_SIZE.
+     The cache is best effort, frames that can't be written to it are only left out.
+  """
+  def __init__(self, fn, w, h):
+    self.fn = fn
+    self.w, self.h = w, h
+
+    # local files are also identified by size and mtime, so frames of a replaced file aren't served
+    file_id = cache_path_for_file_path(fn)
+    if urllib.parse.urlparse(fn).scheme == '' and os.path.exists(fn):
+      st = os.stat(fn)
+      file_id += f":{st.st_size}:{st.st_mtime_ns}"
+    self._file_id = file_id
+
+  def _key(self, pix_fmt):
+    return hashlib.sha256(f"{self._file_id}:{self.w}x{self.h}:{pix_fmt}".encode()).hexdigest()
+
+  def get(self, num, pix_fmt, count=True):
+    # sqlite never matches a numpy integer against the stored frame numbers
+    num = int(num)
+    key = self._key(pix_fmt)
+    cache = get_frame_cache()
+    if cache.max_size == 0:
+      return None
+
+    try:
+      if num not in cache.lookup(key, [num], count=count):
+        return None
+      return np.fromfile(cache.chunk_path(key, num), dtype=np.uint8).reshape(frame_shape(self.w, self.h, pix_fmt))
+    except (OSError, ValueError, sqlite3.Error):
+      # evicted by another process in the meantime, or the cache is unusable
+      return None
+
+  def put(self, frame_b, frames, pix_fmt):
+    key = self._key(pix_fmt)
+    cache = get_frame_cache()
+    if cache.max_size == 0:
+      return
+
+    try:
+      for i, frame in enumerate(frames):
+        cache.put(key, frame_b + i, np.ascontiguousarray(frame).ravel().data)
+    except (OSError, sqlite3.Error):
+      # e.g. out of space, the decoded frames are still returned
+      pass
+
+  def clear(self):
+    for pix_fmt in ("yuv420p", "rgb24", "yuv444p"):
+      get_frame_cache().remove(self._key(pix_fmt))
+
 
 class GOPFrameReader(BaseFrameReader):
   #FrameReader with caching and readahead for formats that are group-of-picture based
@@ -486,7 +910,8 @@ class GOPFrameReader(BaseFrameReader):
 
     self.readahead = readahead
     self.readbehind = readbehind
-    self.frame_cache = LRU(64)
+    self.frame_cache = FrameCache(self.fn, self.w, self.h)
+    self.recent_frames = LRU(READER_LRU_SIZE)
 
     if self.readahead:
       self.cache_lock = threading.RLock()
@@ -531,26 +956,45 @@ class GOPFrameReader(BaseFrameReader):
         for k in range(num, min(self.frame_count, num + self.readahead_len)):
           self._get_one(k, pix_fmt)
 
+  def _get_cached(self, num, pix_fmt, count=True):
+    # this reader's recent frames first, then the frame cache shared with other readers
+    ret = self.recent_frames.get((int(num), pix_fmt))
+    if ret is None:
+      ret = self.frame_cache.get(num, pix_fmt, count=count)
+    return ret
+
   def _get_one(self, num, pix_fmt):
     assert num < self.frame_count
 
-    if (num, pix_fmt) in self.frame_cache:
-      return self.frame_cache[(num, pix_fmt)]
+    ret = self._get_cached(num, pix_fmt)
+    if ret is not None:
+      return ret
 
     with self.cache_lock:
-      if (num, pix_fmt) in self.frame_cache:
-        return self.frame_cache[(num, pix_fmt)]
+      ret = self._get_cached(num, pix_fmt, count=False)
+      if ret is not None:
+        return ret
 
-      frame_b, num_frames, skip_frames, rawdat = self.get_gop(num)
+      frame_b, ret = self._decode_gop(num, pix_fmt)
+      return ret[num - frame_b]
 
-      ret = decompress_video_data(rawdat, self.vid_fmt, self.w, self.h, pix_fmt)
-      ret = ret[skip_frames:]
-      assert ret.shape[0] == num_frames
+  def _decode_gop(self, num, pix_fmt):
+    # decodes and caches the GOP containing num, returns (start_frame_num, frames)
+    frame_b, num_frames, skip_frames, rawdat = self.get_gop(num)
 
-      for i in range(ret.shape[0]):
-        self.frame_cache[(frame_b+i, pix_fmt)] = ret[i]
+    if FFMPEG_POOL_SIZE > 0 and hasattr(self, "get_iframe"):
+      iframe = self.get_iframe(frame_b, num_frames, rawdat)
+      ret = get_decoder_pool().decode(rawdat, iframe, num_frames, skip_frames, self.vid_fmt, self.w, self.h, pix_fmt,
+                                      self.scale)
+    else:
+      ret = decompress_video_data(rawdat, self.vid_fmt, self.w, self.h, pix_fmt, self.scale)
+      ret = ret[skip_frames:]
+    assert ret.shape[0] == num_frames
 
-      return self.frame_cache[(num, pix_fmt)]
+    for i in range(ret.shape[0]):
+      self.recent_frames[(frame_b + i, pix_fmt)] = ret[i]
+    self.frame_cache.put(frame_b, ret, pix_fmt)
+    return frame_b, ret
 
   def get(self, num, count=1, pix_fmt="yuv420p"):
     assert self.frame_count is not None
@@ -571,19 +1015,76 @@ class GOPFrameReader(BaseFrameReader):
 
     return ret
 
+  def get_keyframe(self, num, pix_fmt="yuv420p"):
+    """Returns (keyframe_num, frame) for the last I-frame at or before num.
+
+       Only the I-frame is read and decoded, which makes this much cheaper than get for previews.
+    """
+    if pix_fmt not in ("yuv420p", "rgb24", "yuv444p"):
+      raise ValueError("Unsupported pixel format %r" % pix_fmt)
+
+    frame_b, rawdat = self.get_keyframe_data(num)
+    ret = self._get_cached(frame_b, pix_fmt)
+    if ret is not None:
+      return frame_b, ret
+
+    if FFMPEG_POOL_SIZE > 0:
+      iframe = rawdat[len(self.prefix):]
+      ret = get_decoder_pool().decode(rawdat, iframe, 1, 0, self.vid_fmt, self.w, self.h, pix_fmt, self.scale)
+    else:
+      ret = decompress_video_data(rawdat, self.vid_fmt, self.w, self.h, pix_fmt, self.scale)
+
+    # an I-frame decodes the same on its own as in its GOP
+    self.recent_frames[(frame_b, pix_fmt)] = ret[0]
+    self.frame_cache.put(frame_b, ret[:1], pix_fmt)
+    return frame_b, ret[0]
+
+  def get_many(self, frame_ids, pix_fmt="yuv420p"):
+    """Returns the frames in frame_ids, in any order, as one array.
+
+       Frames missing from the cache are grouped by GOP, so every GOP is decoded at most once.
+    """
+    if pix_fmt not in ("yuv420p", "rgb24", "yuv444p"):
+      raise ValueError("Unsupported pixel format %r" % pix_fmt)
+
+    frame_ids = np.asarray(frame_ids, dtype=np.int64)
+    if len(frame_ids) and (frame_ids.min() < 0 or frame_ids.max() >= self.frame_count):
+      raise ValueError("frame ids out of range [0, {})".format(self.frame_count))
+
+    ret = np.empty((len(frame_ids),) + frame_shape(self.w, self.h, pix_fmt), dtype=np.uint8)
+    missing = []
+    for i, num in enumerate(frame_ids):
+      frame = self._get_cached(num, pix_fmt)
+      if frame is None:
+        missing.append(i)
+      else:
+        ret[i] = frame
+
+    # in frame order, all frames of a GOP are filled in from the first one decoding it
+    missing.sort(key=lambda i: frame_ids[i])
+    frame_b, frames = 0, ret[:0]
+    with self.cache_lock:
+      for i in missing:
+        num = frame_ids[i]
+        if not frame_b <= num < frame_b + len(frames):
+          frame_b, frames = self._decode_gop(num, pix_fmt)
+        ret[i] = frames[num - frame_b]
+
+    return ret
+
 
 class StreamFrameReader(StreamGOPReader, GOPFrameReader):
-  def __init__(self, fn, frame_type, index_data, readahead=False, readbehind=False):
-    StreamGOPReader.__init__(self, fn, frame_type, index_data)
+  def __init__(self, fn, frame_type, index_data, readahead=False, readbehind=False, downscale=1):
+    StreamGOPReader.__init__(self, fn, frame_type, index_data, downscale)
     GOPFrameReader.__init__(self, readahead, readbehind)
 
 
-def GOPFrameIterator(gop_reader, pix_fmt):
+def GOPFrameIterator(gop_reader, pix_fmt, keyframes_only=False):
   # this is really ugly. ill think about how to refactor it when i can think good
 
   IN_FLIGHT_GOPS = 6  # should be enough that the stream decompressor starts returning data
 
-  with VideoStreamDecompressor(gop_reader.vid_fmt, gop_reader.w, gop_reader.h, pix_fmt) as dec:
+  with VideoStreamDecompressor(gop_reader.vid_fmt, gop_reader.w, gop_reader.h, pix_fmt, scale=gop_reader.scale) as dec:
     read_work = []
 
     def readthing():
@@ -602,10 +1103,18 @@ def GOPFrameIterator(gop_reader, pix_fmt):
 
     i = 0
     while i < gop_reader.frame_count:
-      frame_b, num_frames, skip_frames, gop_data = gop_reader.get_gop(i)
-      dec.write(gop_data)
-      i += num_frames
-      read_work.append([skip_frames, num_frames])
+      if keyframes_only:
+        # each I-frame on its own, ended so it isn't held back by the decoder
+        frame_b, keyframe_data = gop_reader.get_keyframe_data(i)
+        dec.write(keyframe_data)
+        dec.write(HEVC_EOS_NAL)
+        i = gop_reader._lookup_gop(i)[1]
+        read_work.append([0, 1])
+      else:
+        frame_b, num_frames, skip_frames, gop_data = gop_reader.get_gop(i)
+        dec.write(gop_data)
+        i += num_frames
+        read_work.append([skip_frames, num_frames])
 
       while len(read_work) >= IN_FLIGHT_GOPS:
         for v in readthing():
@@ -618,11 +1127,18 @@ def GOPFrameIterator(gop_reader, pix_fmt):
         yield v
 
 
-def FrameIterator(fn, pix_fmt, **kwargs):
+def FrameIterator(fn, pix_fmt, keyframes_only=False, **kwargs):
+  """Yields the frames of a video in order.
+
+     keyframes_only: only the I-frames are decoded and yielded, their frame numbers
+     are FrameReader(fn).iframes. kwargs are forwarded to FrameReader, e.g. downscale.
+  """
   fr = FrameReader(fn, **kwargs)
   if isinstance(fr, GOPReader):
-    for v in GOPFrameIterator(fr, pix_fmt):
+    for v in GOPFrameIterator(fr, pix_fmt, keyframes_only):
       yield v
+  elif keyframes_only:
+    raise NotImplementedError("keyframes_only is not supported for raw frames")
   else:
     for i in range(fr.frame_count):
       yield fr.get(i, pix_fmt=pix_fmt)[0]
@@ -2,20 +2,53 @@
 import os
 import sys
 import bz2
+import struct
+import bisect
+import heapq
+import json
+import multiprocessing
+import shutil
+import threading
 import urllib.parse
+from collections import deque
 import capnp
+import numpy as np
 
 try:
   from xx.chffr.lib.filereader import FileReader
 except ImportError:
   from tools.lib.filereader import FileReader
 from cereal import log as capnp_log
+from tools.lib.block_log import read_block_log, iter_block_log, write_block_log
+from tools.lib.cache import cache_path_for_file_path
+from tools.lib.file_helpers import atomic_write_in_dir, mkdirs_exists_ok
+
+# size of the compressed reads done by a streaming LogReader
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+# decompressed bytes a PrefetchLogIterator may hold for upcoming logs
+PREFETCH_MAX_BYTES = 1024 * 1024 * 1024
+# assumed decompressed size of a log until one has been loaded
+PREFETCH_SIZE_GUESS = 128 * 1024 * 1024
 
 # this is an iterator itself, and uses private variables from LogReader
 class MultiLogIterator(object):
-  def __init__(self, log_paths, wraparound=True):
+  def __init__(self, log_paths, wraparound=True, services=None, readahead=0.5, keep_behind=1):
+    """Iterates over the events of the logs of a route, one log after another.
+
+       Once the consumer is past the readahead fraction of a log, the next log is
+       loaded in a background thread so there's no stall at the log boundary
+       (None disables this). Only keep_behind logs before the current one are
+       kept in memory.
+    """
     self._log_paths = log_paths
     self._wraparound = wraparound
+    self._services = services
+    self._readahead = readahead
+    self._keep_behind = keep_behind
+
+    # log index -> (loading thread, result dict)
+    self._loading = {}
 
     self._first_log_idx = next(i for i in range(len(log_paths)) if log_paths[i] is not None)
     self._current_log = self._first_log_idx
@@ -23,14 +56,63 @@ class MultiLogIterator(object):
     self._log_readers = [None]*len(log_paths)
     self.start_time = self._log_reader(self._first_log_idx)._ts[0]
 
+  def _load(self, i):
+    log_path = self._log_paths[i]
+    print("LogReader:%s" % log_path)
+    return LogReader(log_path, services=self._services)
+
+  def _load_in_background(self, i):
+    result = {}
+
+    def load():
+      try:
+        result['lr'] = self._load(i)
+      except Exception as e:
+        result['error'] = e
+
+    # daemon, so exiting doesn't wait for a log nobody will read
+    thread = threading.Thread(target=load, daemon=True)
+    thread.start()
+    self._loading[i] = (thread, result)
+
   def _log_reader(self, i):
     if self._log_readers[i] is None and self._log_paths[i] is not None:
-      log_path = self._log_paths[i]
-      print("LogReader:%s" % log_path)
-      self._log_readers[i] = LogReader(log_path)
+      if i in self._loading:
+        thread, result = self._loading.pop(i)
+        thread.join()
+        if 'error' in result:
+          raise result['error']
+        self._log_readers[i] = result['lr']
+      else:
+        self._log_readers[i] = self._load(i)
 
     return self._log_readers[i]
 
+  def _next_log_idx(self):
+    nxt = next((i for i in range(self._current_log + 1, len(self._log_paths)) if self._log_paths[i] is not None), None)
+    if nxt is None and self._wraparound:
+      nxt = self._first_log_idx
+    return nxt
+
+  def _start_readahead(self, lr):
+    if self._readahead is None or self._idx < self._readahead * len(lr._ents):
+      return
+
+    nxt = self._next_log_idx()
+    if nxt is not None and self._log_readers[nxt] is None and nxt not in self._loading:
+      self._load_in_background(nxt)
+
+  def _drop_old_readers(self):
+    # keep the current log, the keep_behind logs before it and the next one, which is
+    # the first log again at the end of a wraparound route
+    keep = set(range(self._current_log - self._keep_behind, self._current_log + 1))
+    keep.add(self._next_log_idx())
+    for i in range(len(self._log_readers)):
+      if i not in keep:
+        self._log_readers[i] = None
+        if i in self._loading and not self._loading[i][0].is_alive():
+          del self._loading[i]
+
   def __iter__(self):
     return self
 
@@ -48,12 +130,14 @@ class MultiLogIterator(object):
           self._current_log = self._first_log_idx
         else:
           raise StopIteration
+      self._drop_old_readers()
 
   def __next__(self):
     while 1:
       lr = self._log_reader(self._current_log)
       ret = lr._ents[self._idx]
       self._inc()
+      self._start_readahead(lr)
       return ret
 
   def tell(self):
@@ -67,37 +151,436 @@ class MultiLogIterator(object):
       return False
 
     self._current_log = minute
+    self._drop_old_readers()
 
-    # HACK: O(n) seek afterward
-    self._idx = 0
-    while self.tell() < ts:
+    t = self.start_time + ts * 1e9
+    lr = self._log_reader(minute)
+    idx = lr._first_event_after(t)
+    while idx is None:
+      # ts is past the last event in this log, continue in the next one
+      prev_log = self._current_log
+      self._idx = len(lr._ts) - 1
       self._inc()
+      if self._current_log <= prev_log:
+        # wrapped around, start over at the first log
+        idx = 0
+        break
+      lr = self._log_reader(self._current_log)
+      idx = lr._first_event_after(t)
+    self._idx = idx
     return True
 
 
+def _capnp_message_size(buf, offset):
+  # returns the size of the framed capnp message starting at offset, or None if the header is incomplete
+  if len(buf) - offset < 4:
+    return None
+  num_segments = struct.unpack_from("<I", buf, offset)[0] + 1
+  header_size = 8 * (num_segments // 2 + 1)
+  if len(buf) - offset < header_size:
+    return None
+  segment_sizes = struct.unpack_from("<%dI" % num_segments, buf, offset + 4)
+  return header_size + 8 * sum(segment_sizes)
+
+
+def _read_chunks(f, chunk_size):
+  # URLFiles don't stop at EOF by themselves, so bound the reads by the file length
+  length = f.get_length() if hasattr(f, "get_length") else None
+  pos = 0
+  while length is None or pos < length:
+    dat = f.read(chunk_size if length is None else min(chunk_size, length - pos))
+    if len(dat) == 0:
+      break
+    pos += len(dat)
+    yield dat
+
+
+def _decompress_chunks(chunks):
+  decompressor = bz2.BZ2Decompressor()
+  for dat in chunks:
+    while dat:
+      yield decompressor.decompress(dat)
+      # concatenated bz2 streams need a fresh decompressor
+      if decompressor.eof:
+        dat = decompressor.unused_data
+        decompressor = bz2.BZ2Decompressor()
+      else:
+        dat = b""
+
+
+def stream_events(fn, chunk_size=STREAM_CHUNK_SIZE):
+  """Yields the events in a log one at a time, decompressing it incrementally.
+
+     Only the current chunk and the events held by the caller are kept in memory.
+  """
+  _, ext = os.path.splitext(urllib.parse.urlparse(fn).path)
+  if ext not in ("", ".bz2"):
+    raise Exception(f"unknown extension {ext}")
+
+  # a conversion of an older version of the log is only replaced by the next full read
+  block_path = block_log_path(fn)
+  if os.path.exists(block_path) and _source_matches(block_path + "_source.json", _source_stamp(fn)):
+    yield from _split_events(iter_block_log(block_path), fn)
+    return
+
+  with FileReader(fn) as f:
+    chunks = _read_chunks(f, chunk_size)
+    if ext == ".bz2":
+      chunks = _decompress_chunks(chunks)
+    yield from _split_events(chunks, fn)
+
+
+def _split_events(chunks, fn):
+  buf = bytearray()
+  for dat in chunks:
+    buf += dat
+
+    offset = 0
+    while True:
+      size = _capnp_message_size(buf, offset)
+      if size is None or len(buf) - offset < size:
+        break
+      yield capnp_log.Event.from_bytes(bytes(buf[offset:offset + size]))
+      offset += size
+    del buf[:offset]
+
+  if len(buf) != 0:
+    raise ValueError(f"truncated event at end of {fn}")
+
+
+def _index_path(fn):
+  return cache_path_for_file_path(fn) + "_index.npz"
+
+
+def index_log(dat):
+  """Indexes a decompressed log.
+
+     Returns the logMonoTime, union type and byte offset of every event. The union
+     type is stored as a position in 'types', -1 (as uint16) for unknown types.
+     'offset' has one extra entry marking the end of the last event.
+  """
+  types = list(capnp_log.Event.schema.union_fields)
+  type_ids = {t: i for i, t in enumerate(types)}
+
+  mono_times, which, offsets = [], [], [0]
+  offset = 0
+  while offset < len(dat):
+    size = _capnp_message_size(dat, offset)
+    if size is None or offset + size > len(dat):
+      raise ValueError("truncated event at offset %d" % offset)
+    ent = capnp_log.Event.from_bytes(dat[offset:offset + size])
+    try:
+      typ = type_ids[str(ent.which())]
+    except capnp.lib.capnp.KjException:
+      typ = np.iinfo(np.uint16).max
+    mono_times.append(ent.logMonoTime)
+    which.append(typ)
+    offset += size
+    offsets.append(offset)
+
+  return {
+    'mono_time': np.array(mono_times, dtype=np.uint64),
+    'which': np.array(which, dtype=np.uint16),
+    'offset': np.array(offsets, dtype=np.uint64),
+    'types': np.array(types),
+  }
+
+
+def _file_size(fn):
+  if urllib.parse.urlparse(fn).scheme == '':
+    return os.path.getsize(fn)
+  with FileReader(fn) as f:
+    return f.get_length()
+
+
+def _source_stamp(fn):
+  """Identifies the version of a log that something was derived from, by its size and for local files its mtime."""
+  if urllib.parse.urlparse(fn).scheme == '':
+    st = os.stat(fn)
+    return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+  return {'size': _file_size(fn)}
+
+
+def _source_matches(stamp_path, stamp):
+  try:
+    with open(stamp_path) as f:
+      return json.load(f) == stamp
+  except (OSError, ValueError):
+    return False
+
+
+def _write_source_stamp(stamp_path, stamp):
+  with atomic_write_in_dir(stamp_path, mode="w", overwrite=True) as f:
+    json.dump(stamp, f)
+
+
+def get_log_index(fn, dat=None):
+  """Returns the index of a log, building and caching it if needed.
+
+     dat is the decompressed log, if the caller already has it in memory.
+  """
+  index_path = _index_path(fn)
+  file_size = _file_size(fn)
+  if os.path.exists(index_path):
+    with np.load(index_path) as index_file:
+      index = {k: index_file[k] for k in index_file.files}
+    # rebuild indices of logs that changed since
+    if 'file_size' in index and int(index['file_size']) == file_size and \
+       (dat is None or int(index['offset'][-1]) == len(dat)):
+      return index
+
+  if dat is None:
+    dat = _read_log(fn)
+  index = index_log(dat)
+  index['file_size'] = np.array(file_size, dtype=np.uint64)
+  with atomic_write_in_dir(index_path, mode="wb", overwrite=True) as index_file:
+    np.savez(index_file, **index)
+  return index
+
+
+def _columns_dir(fn):
+  return cache_path_for_file_path(fn) + "_columns"
+
+
+def _columns_path(fn, column):
+  return os.path.join(_columns_dir(fn), column + ".npy")
+
+
+def _column_value(v):
+  if isinstance(v, capnp.lib.capnp._DynamicListReader):
+    return list(v)
+  elif isinstance(v, (bool, int, float, str, bytes)):
+    return v
+  else:
+    # enums
+    return str(v)
+
+
+def _to_array(field, values):
+  try:
+    arr = np.array(values)
+  except ValueError:
+    arr = None
+  # object arrays could only be cached pickled
+  if arr is None or arr.dtype == object:
+    raise ValueError(f"{field} has values of different lengths, which don't fit in an array")
+  return arr
+
+
+def _split_fields(fields):
+  services = {}
+  for field in fields:
+    service, _, path = field.partition(".")
+    if not path:
+      raise ValueError(f"field {field} must be of the form service.field")
+    services.setdefault(service, []).append(field)
+  return services
+
+
+def log_to_arrays(fn, fields):
+  """Like LogReader.to_arrays, but columns already extracted for this log are
+     loaded from the cache without decompressing or decoding it.
+  """
+  services = _split_fields(fields)
+  columns = list(fields) + [f"{service}.logMonoTime" for service in services]
+
+  # columns extracted from an older version of the log are all extracted again
+  current = _source_matches(os.path.join(_columns_dir(fn), "source.json"), _source_stamp(fn))
+
+  ret, missing = {}, []
+  for column in columns:
+    path = _columns_path(fn, column)
+    if current and os.path.exists(path):
+      ret[column] = np.load(path)
+    else:
+      missing.append(column)
+
+  missing_fields = [f for f in fields if f in missing or f"{f.partition('.')[0]}.logMonoTime" in missing]
+  if missing_fields:
+    lr = LogReader(fn, services=list(_split_fields(missing_fields)))
+    ret.update(lr.to_arrays(missing_fields))
+  return ret
+
+
+def block_log_path(fn):
+  return cache_path_for_file_path(fn) + "_blocks"
+
+
+def convert_log(fn):
+  """Converts a log to a local block log, which LogReader uses instead of the
+     original from then on. Returns the path of the block log."""
+  stamp = _source_stamp(fn)
+  return _write_block_log(fn, _read_source_log(fn), stamp)
+
+
+def _write_block_log(fn, dat, stamp):
+  boundaries = []
+  offset = 0
+  while offset < len(dat):
+    size = _capnp_message_size(dat, offset)
+    if size is None or offset + size > len(dat):
+      raise ValueError("truncated event at offset %d" % offset)
+    offset += size
+    boundaries.append(offset)
+
+  # the source is recorded after the conversion is complete, a conversion without one isn't used
+  dest = block_log_path(fn)
+  with atomic_write_in_dir(dest, mode="wb", overwrite=True) as f:
+    write_block_log(f, dat, boundaries)
+  _write_source_stamp(dest + "_source.json", stamp)
+  return dest
+
+
+def _read_log(fn):
+  block_path = block_log_path(fn)
+  if not os.path.exists(block_path):
+    return _read_source_log(fn)
+
+  stamp = _source_stamp(fn)
+  if _source_matches(block_path + "_source.json", stamp):
+    return read_block_log(block_path)
+
+  # the log was replaced since it was converted
+  dat = _read_source_log(fn)
+  _write_block_log(fn, dat, stamp)
+  return dat
+
+
+def _read_source_log(fn):
+  _, ext = os.path.splitext(urllib.parse.urlparse(fn).path)
+  with FileReader(fn) as f:
+    dat = f.read()
+
+  if ext == "":
+    # old rlogs weren't bz2 compressed
+    return dat
+  elif ext == ".bz2":
+    return bz2.decompress(dat)
+  else:
+    raise Exception(f"unknown extension {ext}")
+
+
+def _read_log_or_error(fn):
+  # runs in the PrefetchLogIterator workers, a corrupt log shouldn't end the whole route
+  try:
+    return _read_log(fn), None
+  except (ValueError, OSError) as e:
+    return None, str(e)
+
+
 class LogReader(object):
-  def __init__(self, fn, canonicalize=True, only_union_types=False):
+  def __init__(self, fn, canonicalize=True, only_union_types=False, streaming=False, services=None):
+    """Reads all events of a log into memory.
+
+       With streaming=True the log is instead decompressed incrementally on every
+       iteration, and events are yielded one at a time with bounded memory use.
+
+       With services set, only events of those union types are decoded, using the
+       per-log index from get_log_index.
+    """
     data_version = None
     _, ext = os.path.splitext(urllib.parse.urlparse(fn).path)
-    with FileReader(fn) as f:
-      dat = f.read()
+    self._fn = fn
+    self._streaming = streaming
+    self.data_version = data_version
+    self._only_union_types = only_union_types
+    self._services = services
+    self._seek_ts = None
 
-    if ext == "":
-      # old rlogs weren't bz2 compressed
-      ents = capnp_log.Event.read_multiple_bytes(dat)
-    elif ext == ".bz2":
-      dat = bz2.decompress(dat)
+    if streaming:
+      if services is not None:
+        raise ValueError("services can't be used with streaming")
+      if ext not in ("", ".bz2"):
+        raise Exception(f"unknown extension {ext}")
+      self._ents = None
+      self._ts = None
+      return
+
+    dat = _read_log(fn)
+
+    if services is None:
       ents = capnp_log.Event.read_multiple_bytes(dat)
+      self._ents = list(ents)
+      self._ts = [x.logMonoTime for x in self._ents]
     else:
-      raise Exception(f"unknown extension {ext}")
+      index = get_log_index(fn, dat)
+      types = list(index['types'])
+      type_ids = [types.index(s) for s in services if s in types]
+      mask = np.isin(index['which'], type_ids)
 
-    self._ents = list(ents)
-    self._ts = [x.logMonoTime for x in self._ents]
-    self.data_version = data_version
-    self._only_union_types = only_union_types
+      begins = index['offset'][:-1][mask].tolist()
+      ends = index['offset'][1:][mask].tolist()
+      self._ents = [capnp_log.Event.from_bytes(dat[b:e]) for b, e in zip(begins, ends)]
+      self._ts = index['mono_time'][mask].tolist()
+
+  def _first_event_after(self, t):
+    """Returns the position of the first event in the log, in file order, logged at or after t.
+
+       Events are in the order they were received, which isn't logMonoTime order.
+    """
+    if self._seek_ts is None:
+      ts = np.array(self._ts, dtype=np.uint64)
+      order = np.argsort(ts, kind="stable")
+      self._seek_ts = ts[order]
+      # the earliest file position of the events sorted at or after each position
+      self._seek_first = np.minimum.accumulate(order[::-1])[::-1]
+
+    i = np.searchsorted(self._seek_ts, t, side="left")
+    return int(self._seek_first[i]) if i < len(self._seek_ts) else None
+
+  def to_arrays(self, fields):
+    """Extracts fields of the form "service.field" into numpy arrays.
+
+       Returns a dict with an array per field, and a "service.logMonoTime" array
+       per service that the field arrays of that service are aligned with. Nested
+       fields ("carState.cruiseState.speed") and fixed length lists are supported,
+       variable length lists raise a ValueError.
+
+       The arrays are also cached per log, see log_to_arrays. Services left out
+       by the services filter of the reader give empty arrays, which aren't cached.
+    """
+    services = _split_fields(fields)
+    values = {f: [] for f in fields}
+    mono_times = {s: [] for s in services}
+    stamp = _source_stamp(self._fn)
+
+    for ent in self:
+      try:
+        service = ent.which()
+      except capnp.lib.capnp.KjException:
+        continue
+      if service not in services:
+        continue
+
+      mono_times[service].append(ent.logMonoTime)
+      msg = getattr(ent, service)
+      for field in services[service]:
+        v = msg
+        for attr in field.split(".")[1:]:
+          v = getattr(v, attr)
+        values[field].append(_column_value(v))
+
+    ret = {f: _to_array(f, v) for f, v in values.items()}
+    ret.update({f"{s}.logMonoTime": np.array(t, dtype=np.uint64) for s, t in mono_times.items()})
+
+    # the columns of an older version of the log are dropped, so they aren't mixed with these
+    columns_dir = _columns_dir(self._fn)
+    stamp_path = os.path.join(columns_dir, "source.json")
+    if not _source_matches(stamp_path, stamp):
+      shutil.rmtree(columns_dir, ignore_errors=True)
+      mkdirs_exists_ok(columns_dir)
+      _write_source_stamp(stamp_path, stamp)
+
+    for column, arr in ret.items():
+      if self._services is not None and column.partition(".")[0] not in self._services:
+        continue
+      with atomic_write_in_dir(_columns_path(self._fn, column), mode="wb", overwrite=True) as f:
+        np.save(f, arr)
+    return ret
 
   def __iter__(self):
-    for ent in self._ents:
+    ents = stream_events(self._fn) if self._streaming else self._ents
+    for ent in ents:
       if self._only_union_types:
         try:
           ent.which()
@@ -107,6 +590,92 @@ class LogReader(object):
       else:
         yield ent
 
+class PrefetchLogIterator(object):
+  """Iterates over the events of consecutive logs (e.g. Route.log_paths()) in time order.
+
+     Upcoming logs are decompressed ahead of the consumer in a pool of worker
+     processes. Only the decompressed bytes are sent back, and the workers stop
+     getting new logs once the loaded and in flight logs would exceed max_bytes.
+     Logs that can't be read or parsed are reported and skipped.
+  """
+  def __init__(self, log_paths, workers=None, max_bytes=PREFETCH_MAX_BYTES):
+    self._log_paths = deque(p for p in log_paths if p is not None)
+    self._workers = workers if workers is not None else multiprocessing.cpu_count()
+    self._max_bytes = max_bytes
+
+    self._pool = None
+    self._pending = deque()
+    self._size_estimate = PREFETCH_SIZE_GUESS
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def close(self):
+    if self._pool is not None:
+      self._pool.terminate()
+      self._pool.join()
+      self._pool = None
+
+  def _fill(self):
+    while self._log_paths and len(self._pending) < 2 * self._workers:
+      if self._pending and (len(self._pending) + 1) * self._size_estimate > self._max_bytes:
+        break
+      log_path = self._log_paths.popleft()
+      self._pending.append((log_path, self._pool.apply_async(_read_log_or_error, (log_path,))))
+
+  def _next_log(self):
+    # returns the events of the next log sorted by time, or None when done. Logs that
+    # can't be read are skipped
+    while True:
+      self._fill()
+      if not self._pending:
+        return None
+
+      log_path, result = self._pending.popleft()
+      dat, error = result.get()
+      if dat is not None:
+        self._size_estimate = max(self._size_estimate, len(dat))
+        self._fill()
+
+        print("LogReader:%s" % log_path)
+        try:
+          ents = list(capnp_log.Event.read_multiple_bytes(dat))
+          break
+        except (ValueError, capnp.lib.capnp.KjException) as e:
+          error = str(e)
+      print(f"Error parsing {log_path}: {error}")
+
+    ts = [ent.logMonoTime for ent in ents]
+    order = sorted(range(len(ents)), key=ts.__getitem__)
+    return [ts[i] for i in order], [ents[i] for i in order]
+
+  def __iter__(self):
+    if self._pool is None:
+      self._pool = multiprocessing.Pool(self._workers)
+
+    try:
+      ts, ents = self._next_log() or ([], [])
+      while True:
+        nxt = self._next_log()
+        if nxt is None:
+          break
+
+        # events logged after the start of the next log are merged with it
+        cut = bisect.bisect_right(ts, nxt[0][0]) if nxt[0] else len(ts)
+        yield from ents[:cut]
+
+        merged = list(heapq.merge(zip(ts[cut:], ents[cut:]), zip(*nxt), key=lambda x: x[0]))
+        ts = [t for t, _ in merged]
+        ents = [ent for _, ent in merged]
+
+      yield from ents
+    finally:
+      self.close()
+
+
 if __name__ == "__main__":
   import codecs
   # capnproto <= 0.8.0 throws errors converting byte data to string
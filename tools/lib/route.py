@@ -1,11 +1,18 @@
 import os
 import re
+import json
+import time
 from urllib.parse import urlparse
 from collections import defaultdict
 from itertools import chain
 
+import numpy as np
+
 from tools.lib.auth_config import get_token
 from tools.lib.api import CommaApi
+from tools.lib.cache import DEFAULT_CACHE_DIR
+from tools.lib.file_helpers import atomic_write_in_dir, mkdirs_exists_ok
+from tools.lib.logreader import log_to_arrays
 
 SEGMENT_NAME_RE = r'[a-z0-9]{16}[|_][0-9]{4}-[0-9]{2}-[0-9]{2}--[0-9]{2}-[0-9]{2}-[0-9]{2}--[0-9]+'
 EXPLORER_FILE_RE = r'^({})--([a-z]+\.[a-z0-9]+)$'.format(SEGMENT_NAME_RE)
@@ -16,13 +23,97 @@ QCAMERA_FILENAMES = ['qcamera.ts']
 LOG_FILENAMES = ['rlog.bz2', 'raw_log.bz2']
 CAMERA_FILENAMES = ['fcamera.hevc', 'video.hevc']
 
+ROUTE_CACHE_DIR = os.path.join(DEFAULT_CACHE_DIR, "routes")
+# remote file listings contain signed urls, so they are only cached for a while
+REMOTE_ROUTE_CACHE_TTL = int(os.getenv("ROUTE_CACHE_TTL", "1800"))
+
+
+def _load_json(path):
+  try:
+    with open(path) as f:
+      return json.load(f)
+  except (OSError, ValueError):
+    return None
+
+
+def _save_json(path, value):
+  mkdirs_exists_ok(os.path.dirname(path))
+  with atomic_write_in_dir(path, mode="w", overwrite=True) as f:
+    json.dump(value, f)
+
+
+def _classify_data_dir_entry(data_dir, f):
+  explorer_match = re.match(EXPLORER_FILE_RE, f)
+  if explorer_match:
+    segment_name, fn = explorer_match.groups()
+    return {'type': 'explorer', 'segment': segment_name, 'fn': fn}
+  elif re.match(OP_SEGMENT_DIR_RE, f) and os.path.isdir(os.path.join(data_dir, f)):
+    return {'type': 'op', 'mtime': None, 'files': []}
+  return {'type': 'other'}
+
+
+def _local_segment_files(data_dir, route_name, refresh=False):
+  """Returns (segment name, path, filename) for the explorer files, openpilot segment
+     directories and route directory of a route in data_dir, in listing order.
+
+     The listing of data_dir is indexed on disk. data_dir is only listed again when
+     its mtime changes or on refresh, and segment directories of the route when theirs change.
+  """
+  index_path = os.path.join(ROUTE_CACHE_DIR, "local" + os.path.abspath(data_dir).replace("/", "_") + ".json")
+  index = None if refresh else _load_json(index_path)
+  index = index or {'mtime': None, 'entries': {}}
+  changed = False
+
+  dir_mtime = os.stat(data_dir).st_mtime_ns
+  if index['mtime'] != dir_mtime:
+    old_entries = index['entries']
+    index = {'mtime': dir_mtime, 'entries': {f: old_entries.get(f) for f in os.listdir(data_dir)}}
+    changed = True
+
+  segment_files = []
+  entries = index['entries']
+  for f in entries:
+    if f == route_name:
+      route_dir = os.path.join(data_dir, f)
+      for seg_num in os.listdir(route_dir):
+        if not seg_num.isdigit():
+          continue
+
+        segment_name = '{}--{}'.format(route_name, seg_num)
+        for seg_f in os.listdir(os.path.join(route_dir, seg_num)):
+          segment_files.append((segment_name, os.path.join(route_dir, seg_num, seg_f), seg_f))
+      continue
+
+    entry = entries[f]
+    if entry is None:
+      entry = entries[f] = _classify_data_dir_entry(data_dir, f)
+      changed = True
+
+    if entry['type'] == 'explorer':
+      if entry['segment'].replace('_', '|').startswith(route_name):
+        segment_files.append((entry['segment'], os.path.join(data_dir, f), entry['fn']))
+    elif entry['type'] == 'op' and f.startswith(route_name):
+      fullpath = os.path.join(data_dir, f)
+      mtime = os.stat(fullpath).st_mtime_ns
+      if entry['mtime'] != mtime:
+        entry['mtime'] = mtime
+        entry['files'] = os.listdir(fullpath)
+        changed = True
+      segment_files += [(f, os.path.join(fullpath, seg_f), seg_f) for seg_f in entry['files']]
+
+  if changed:
+    _save_json(index_path, index)
+  return segment_files
+
+
 class Route(object):
-  def __init__(self, route_name, data_dir=None):
+  def __init__(self, route_name, data_dir=None, refresh=False):
+    """refresh lists the route files again instead of using the cached listing."""
     self.route_name = route_name.replace('_', '|')
     if data_dir is not None:
-      self._segments = self._get_segments_local(data_dir)
+      self._segments = self._get_segments_local(data_dir, refresh)
     else:
-      self._segments = self._get_segments_remote()
+      self._segments = self._get_segments_remote(refresh)
     self.max_seg_number = self._segments[-1].canonical_name.segment_num
 
   @property
@@ -45,9 +136,29 @@ class Route(object):
     qcamera_path_by_seg_num = {s.canonical_name.segment_num: s.qcamera_path for s in self._segments}
     return [qcamera_path_by_seg_num.get(i, None) for i in range(self.max_seg_number+1)]
 
-  def _get_segments_remote(self):
+  def to_arrays(self, fields, qlog=False):
+    """Extracts fields across all segments into numpy arrays, see LogReader.to_arrays."""
+    paths = [p for p in (self.qlog_paths() if qlog else self.log_paths()) if p is not None]
+    if not paths:
+      services = {f.partition(".")[0] for f in fields}
+      return {**{f: np.array([]) for f in fields}, **{f"{s}.logMonoTime": np.array([], dtype=np.uint64) for s in services}}
+
+    segments = [log_to_arrays(p, fields) for p in paths]
+    return {k: np.concatenate([seg[k] for seg in segments]) for k in segments[0]}
+
+  def _get_route_files_remote(self, refresh=False):
+    cache_path = os.path.join(ROUTE_CACHE_DIR, "remote_" + self.route_name.replace('|', '_') + ".json")
+    cached = None if refresh else _load_json(cache_path)
+    if cached is not None and time.time() - cached['time'] < REMOTE_ROUTE_CACHE_TTL:
+      return cached['files']
+
     api = CommaApi(get_token())
     route_files = api.get('v1/route/' + self.route_name + '/files')
+    _save_json(cache_path, {'time': time.time(), 'files': route_files})
+    return route_files
+
+  def _get_segments_remote(self, refresh=False):
+    route_files = self._get_route_files_remote(refresh)
 
     segments = {}
     for url in chain.from_iterable(route_files.values()):
@@ -72,57 +183,25 @@ class Route(object):
 
     return sorted(segments.values(), key=lambda seg: seg.canonical_name.segment_num)
 
-  def _get_segments_local(self, data_dir):
-    files = os.listdir(data_dir)
+  def _get_segments_local(self, data_dir, refresh=False):
     segment_files = defaultdict(list)
-
-    for f in files:
-      fullpath = os.path.join(data_dir, f)
-      explorer_match = re.match(EXPLORER_FILE_RE, f)
-      op_match = re.match(OP_SEGMENT_DIR_RE, f)
-
-      if explorer_match:
-        segment_name, fn = explorer_match.groups()
-        if segment_name.replace('_', '|').startswith(self.route_name):
-          segment_files[segment_name].append((fullpath, fn))
-      elif op_match and os.path.isdir(fullpath):
-        segment_name, = op_match.groups()
-        if segment_name.startswith(self.route_name):
-          for seg_f in os.listdir(fullpath):
-            segment_files[segment_name].append((os.path.join(fullpath, seg_f), seg_f))
-      elif f == self.route_name:
-        for seg_num in os.listdir(fullpath):
-          if not seg_num.isdigit():
-            continue
-
-          segment_name = '{}--{}'.format(self.route_name, seg_num)
-          for seg_f in os.listdir(os.path.join(fullpath, seg_num)):
-            segment_files[segment_name].append((os.path.join(fullpath, seg_num, seg_f), seg_f))
+    for segment_name, fullpath, fn in _local_segment_files(data_dir, self.route_name, refresh):
+      segment_files[segment_name].append((fullpath, fn))
 
     segments = []
     for segment, files in segment_files.items():
-
-      try:
-        log_path = next(path for path, filename in files if filename in LOG_FILENAMES)
-      except StopIteration:
-        log_path = None
-
-      try:
-        qlog_path = next(path for path, filename in files if filename in QLOG_FILENAMES)
-      except StopIteration:
-        qlog_path = None
-
-      try:
-        camera_path = next(path for path, filename in files if filename in CAMERA_FILENAMES)
-      except StopIteration:
-        camera_path = None
-
-      try:
-        qcamera_path = next(path for path, filename in files if filename in QCAMERA_FILENAMES)
-      except StopIteration:
-        qcamera_path = None
-
-      segments.append(RouteSegment(segment, log_path, qlog_path, camera_path, qcamera_path))
+      # filename -> (listing position, path) of its first file
+      first_by_filename = {}
+      for i, (path, filename) in enumerate(files):
+        first_by_filename.setdefault(filename, (i, path))
+
+      def find_path(filenames):
+        # the file listed first wins, whichever of the filenames it has
+        found = [first_by_filename[fn] for fn in filenames if fn in first_by_filename]
+        return min(found)[1] if found else None
+
+      segments.append(RouteSegment(segment, find_path(LOG_FILENAMES), find_path(QLOG_FILENAMES),
+                                   find_path(CAMERA_FILENAMES), find_path(QCAMERA_FILENAMES)))
 
     if len(segments) == 0:
       raise ValueError('Could not find segments for route {} in data directory {}'.format(self.route_name, data_dir))
@@ -1,5 +1,16 @@
 """RouteFrameReader indexes and reads frames across routes, by frameId or segment indices."""
-from tools.lib.framereader import FrameReader
+import multiprocessing
+from collections import defaultdict
+
+import numpy as np
+
+from tools.lib.framereader import FrameReader, frame_shape
+
+
+def _get_many_from_segment(args):
+  camera_path, cache_path, framereader_kwargs, segment_ids, pix_fmt = args
+  with FrameReader(camera_path, cache_path, **framereader_kwargs) as frame_reader:
+    return frame_reader.get_many(segment_ids, pix_fmt)
 
 
 class _FrameReaderDict(dict):
@@ -79,6 +90,44 @@ class RouteFrameReader(object):
 
     return self._frame_readers[segment_num].get(segment_id, **kwargs)[0]
 
+  def get_many(self, frame_ids, pix_fmt="yuv420p", workers=None):
+    """Get many frames for a route based on frameId, as one array.
+
+       Inputs:
+        frame_ids: The frameIds of the returned frames, in any order.
+        pix_fmt: Forwarded to BaseFrameReader.get_many.
+        workers: Number of processes segments are read in parallel by, defaults to the cpu count.
+    """
+    # segment_num -> (positions in frame_ids, segment_ids)
+    segments = defaultdict(lambda: ([], []))
+    for i, frame_id in enumerate(frame_ids):
+      segment_num, segment_id = self._frame_id_lookup.get(frame_id, (None, None))
+      if segment_num is None or segment_num == -1 or segment_id == -1:
+        raise KeyError("frameId not in route: {}".format(frame_id))
+      segments[segment_num][0].append(i)
+      segments[segment_num][1].append(segment_id)
+
+    ret = np.empty((len(frame_ids),) + frame_shape(self.w, self.h, pix_fmt), dtype=np.uint8)
+
+    workers = min(workers or multiprocessing.cpu_count(), len(segments))
+    if workers <= 1:
+      for segment_num, (idxs, segment_ids) in segments.items():
+        ret[idxs] = self._frame_readers[segment_num].get_many(segment_ids, pix_fmt)
+      return ret
+
+    camera_paths = self._frame_readers._camera_paths
+    cache_paths = self._frame_readers._cache_paths
+    for segment_num in segments:
+      if camera_paths.get(segment_num) is None:
+        raise KeyError("Segment index out of bounds: {}".format(segment_num))
+
+    work = [(camera_paths[segment_num], cache_paths.get(segment_num), self._frame_readers._framereader_kwargs,
+             segment_ids, pix_fmt) for segment_num, (_, segment_ids) in segments.items()]
+    with multiprocessing.Pool(workers) as pool:
+      for (idxs, _), frames in zip(segments.values(), pool.imap(_get_many_from_segment, work)):
+        ret[idxs] = frames
+    return ret
+
   def close(self):
     frs = self._frame_readers
     self._frame_readers.clear()
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+import os
+import sys
+import time
+
+from tools.lib.logreader import LogReader, block_log_path, convert_log
+
+N = int(os.getenv("N", "3"))
+
+
+def benchmark(fn):
+  # best of N, in msgs/sec
+  rates = []
+  for _ in range(N):
+    t = time.monotonic()
+    num_msgs = len(LogReader(fn)._ents)
+    rates.append(num_msgs / (time.monotonic() - t))
+  return num_msgs, max(rates)
+
+
+if __name__ == "__main__":
+  if len(sys.argv) != 2:
+    print(f"usage: {sys.argv[0]} <rlog.bz2>")
+    sys.exit(1)
+  fn = sys.argv[1]
+
+  block_path = block_log_path(fn)
+  if os.path.exists(block_path):
+    os.remove(block_path)
+
+  num_msgs, bz2_rate = benchmark(fn)
+
+  t = time.monotonic()
+  convert_log(fn)
+  convert_time = time.monotonic() - t
+
+  _, block_rate = benchmark(fn)
+  os.remove(block_path)
+
+  print(f"{num_msgs} msgs, best of {N}")
+  print(f"\tbz2:   {bz2_rate:.0f} msgs/sec")
+  print(f"\tblock: {block_rate:.0f} msgs/sec ({block_rate / bz2_rate:.1f}x), conversion took {convert_time:.2f}s")
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+import os
+import sys
+import time
+import random
+
+import numpy as np
+
+import tools.lib.framereader as framereader
+from tools.lib.framereader import FrameReader
+
+N = int(os.getenv("N", "100"))
+
+
+def fetch_latencies(fr, frames):
+  # random access latency in seconds, every fetch needs to decode a GOP
+  latencies = []
+  for num in frames:
+    fr.frame_cache.clear()
+    t = time.monotonic()
+    fr.get(num, pix_fmt="rgb24")
+    latencies.append(time.monotonic() - t)
+  return np.array(latencies)
+
+
+def keyframe_latencies(fr, frames):
+  latencies = []
+  for num in frames:
+    fr.frame_cache.clear()
+    t = time.monotonic()
+    fr.get_keyframe(num, pix_fmt="rgb24")
+    latencies.append(time.monotonic() - t)
+  return np.array(latencies)
+
+
+if __name__ == "__main__":
+  if len(sys.argv) != 2:
+    print(f"usage: {sys.argv[0]} <fcamera.hevc>")
+    sys.exit(1)
+
+  fr = FrameReader(sys.argv[1])
+  frames = [random.randrange(fr.frame_count) for _ in range(N)]
+
+  results = {}
+  for pool_size in (0, framereader.FFMPEG_POOL_SIZE or 1):
+    framereader.FFMPEG_POOL_SIZE = pool_size
+    fetch_latencies(fr, frames[:1])  # warm up
+    results[f"pool of {pool_size}" if pool_size else "ffmpeg per GOP"] = fetch_latencies(fr, frames)
+  results["keyframe, 1/4 size"] = keyframe_latencies(FrameReader(sys.argv[1], downscale=4), frames)
+
+  print(f"random frame fetch latency over {N} frames")
+  for name, latencies in results.items():
+    p50, p99 = np.percentile(latencies, [50, 99]) * 1e3
+    print(f"\t{name}:\tp50 {p50:.1f} ms\tp99 {p99:.1f} ms")
@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+import os
+import sys
+import time
+
+from tools.lib.logreader import MultiLogIterator
+from tools.lib.route import Route
+
+# consume the logs this many times faster than realtime
+SPEED = float(os.getenv("SPEED", "20"))
+
+
+def max_stall(lr):
+  # replays the logs at SPEED and returns the longest time the consumer waited on a message
+  stall = 0.
+  start_wall, start_mono = None, None
+  while True:
+    t = time.monotonic()
+    try:
+      msg = next(lr)
+    except StopIteration:
+      return stall
+    stall = max(stall, time.monotonic() - t)
+
+    if start_wall is None:
+      start_wall, start_mono = time.monotonic(), msg.logMonoTime
+    wait = (msg.logMonoTime - start_mono) * 1e-9 / SPEED - (time.monotonic() - start_wall)
+    if wait > 0:
+      time.sleep(wait)
+
+
+if __name__ == "__main__":
+  if len(sys.argv) < 2:
+    print(f"usage: {sys.argv[0]} <route name> [data dir]")
+    sys.exit(1)
+  log_paths = Route(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else None).log_paths()[:3]
+
+  stall_sync = max_stall(MultiLogIterator(log_paths, wraparound=False, readahead=None))
+  stall_readahead = max_stall(MultiLogIterator(log_paths, wraparound=False))
+
+  print(f"max stall at {SPEED}x realtime over {len(log_paths)} logs")
+  print(f"\twithout readahead: {stall_sync * 1e3:.1f} ms")
+  print(f"\twith readahead:    {stall_readahead * 1e3:.1f} ms")
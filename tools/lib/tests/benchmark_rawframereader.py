@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+import os
+import sys
+import time
+import struct
+import tempfile
+
+import numpy as np
+
+from tools.lib.framereader import RawFrameReader
+
+N = int(os.getenv("N", "3"))
+COUNT = int(os.getenv("COUNT", "20"))
+
+
+def reference_get(fn, num, count, pix_fmt):
+  # the per frame implementation RawFrameReader.get used to have
+  yuv_from_rgb = np.array([[ 0.299     ,  0.587     ,  0.114      ],
+                           [-0.14714119, -0.28886916,  0.43601035 ],
+                           [ 0.61497538, -0.51496512, -0.10001026 ]])
+  ret = []
+  with open(fn, "rb") as f:
+    lenn = struct.unpack("I", f.read(4))[0]
+    for i in range(num, num+count):
+      f.seek((lenn+4)*i + 4)
+      img = np.frombuffer(f.read(lenn), dtype='uint8').reshape(960, 1280)
+      rgb = np.dstack([img[0::2, 1::2], ((img[0::2, 0::2].astype("uint16") + img[1::2, 1::2].astype("uint16")) >> 1).astype("uint8"), img[1::2, 0::2]])
+      if pix_fmt == "rgb24":
+        ret.append(rgb)
+        continue
+
+      yuv = np.dot(rgb.reshape(-1, 3), yuv_from_rgb.T).reshape(rgb.shape)
+      y_len = yuv.shape[0] * yuv.shape[1]
+      uv_len = y_len // 4
+      us = (yuv[::2, ::2, 1] + yuv[1::2, ::2, 1] + yuv[::2, 1::2, 1] + yuv[1::2, 1::2, 1]) / 4 + 128
+      vs = (yuv[::2, ::2, 2] + yuv[1::2, ::2, 2] + yuv[::2, 1::2, 2] + yuv[1::2, 1::2, 2]) / 4 + 128
+      yuv420 = np.empty(y_len + 2 * uv_len, dtype=yuv.dtype)
+      yuv420[:y_len] = yuv[:, :, 0].reshape(-1)
+      yuv420[y_len:y_len + uv_len] = us.reshape(-1)
+      yuv420[y_len + uv_len:] = vs.reshape(-1)
+      ret.append(yuv420.clip(0, 255).astype('uint8'))
+  return ret
+
+
+def best_time(f):
+  times = []
+  for _ in range(N):
+    t = time.monotonic()
+    ret = f()
+    times.append(time.monotonic() - t)
+  return ret, min(times)
+
+
+def write_random_raw(f, count):
+  lenn = 960 * 1280
+  f.write(struct.pack("I", lenn))
+  for i in range(count):
+    f.write(np.random.randint(0, 256, lenn, dtype=np.uint8).tobytes())
+    if i != count - 1:
+      f.write(struct.pack("I", lenn))
+  f.flush()
+
+
+if __name__ == "__main__":
+  with tempfile.NamedTemporaryFile() as tmp:
+    if len(sys.argv) > 1:
+      fn = sys.argv[1]
+    else:
+      write_random_raw(tmp, COUNT)
+      fn = tmp.name
+
+    fr = RawFrameReader(fn)
+    count = min(COUNT, fr.frame_count)
+    print(f"{count} frames, best of {N}")
+    for pix_fmt in ("rgb24", "yuv420p"):
+      ref, ref_time = best_time(lambda: reference_get(fn, 0, count, pix_fmt))
+      new, new_time = best_time(lambda: fr.get(0, count, pix_fmt))
+      max_diff = np.abs(np.array(ref, dtype=np.int16) - np.array(new, dtype=np.int16)).max()
+      print(f"\t{pix_fmt}:\tseek and read {ref_time * 1e3:.0f} ms\tmemmap {new_time * 1e3:.0f} ms ({ref_time / new_time:.1f}x)\tmax diff {max_diff}")
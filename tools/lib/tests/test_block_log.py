@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+import os
+import tempfile
+import unittest
+
+from tools.lib import block_log
+from tools.lib.block_log import iter_block_log, read_block_log, write_block_log
+
+
+class TestBlockLog(unittest.TestCase):
+  def setUp(self):
+    # fake events of varying sizes
+    self.events = [os.urandom(8 * (i % 100 + 1)) for i in range(5000)]
+    self.dat = b"".join(self.events)
+    self.boundaries = []
+    offset = 0
+    for ev in self.events:
+      offset += len(ev)
+      self.boundaries.append(offset)
+
+    self.block_size = block_log.BLOCK_SIZE
+    block_log.BLOCK_SIZE = 16 * 1024
+
+  def tearDown(self):
+    block_log.BLOCK_SIZE = self.block_size
+
+  def test_roundtrip(self):
+    with tempfile.NamedTemporaryFile() as f:
+      write_block_log(f, self.dat, self.boundaries)
+      f.flush()
+
+      self.assertEqual(read_block_log(f.name), self.dat)
+      self.assertEqual(read_block_log(f.name, workers=1), self.dat)
+
+      blocks = list(iter_block_log(f.name))
+      self.assertGreater(len(blocks), 1)
+      self.assertEqual(b"".join(blocks), self.dat)
+
+      # blocks are only split between events
+      end = 0
+      for block in blocks:
+        end += len(block)
+        self.assertIn(end, self.boundaries)
+
+      self.assertEqual(b"".join(iter_block_log(f.name, first_block=1)), b"".join(blocks[1:]))
+
+  def test_not_block_log(self):
+    with tempfile.NamedTemporaryFile() as f:
+      f.write(os.urandom(1000))
+      f.flush()
+      with self.assertRaises(ValueError):
+        read_block_log(f.name)
+
+
+if __name__ == "__main__":
+  unittest.main()
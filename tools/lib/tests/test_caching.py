@@ -1,10 +1,73 @@
 #!/usr/bin/env python3
 import os
+import re
 import shutil
+import tempfile
+import threading
+import time
 import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 os.environ["COMMA_CACHE"] = "/tmp/__test_cache__"
-from tools.lib.url_file import URLFile, CACHE_DIR
+from tools.lib import url_file
+from tools.lib.chunk_cache import ChunkCache
+from tools.lib.url_file import URLFile, CACHE_DIR, CHUNK_SIZE
+
+LATENCY = 0.1
+FILE_DATA = os.urandom(int(CHUNK_SIZE * 16.5))
+
+
+class SlowRangeHandler(BaseHTTPRequestHandler):
+  """Serves FILE_DATA with range support, delaying every response by LATENCY.
+
+     The requested ranges and the most requests served at once are recorded.
+  """
+  protocol_version = "HTTP/1.1"
+  lock = threading.Lock()
+  ranges = []
+  active = 0
+  max_active = 0
+
+  @classmethod
+  def reset(cls):
+    with cls.lock:
+      cls.ranges = []
+      cls.active = 0
+      cls.max_active = 0
+
+  def log_message(self, *args):
+    pass
+
+  def do_HEAD(self):
+    self.send_response(200)
+    self.send_header("Content-Length", str(len(FILE_DATA)))
+    self.end_headers()
+
+  def do_GET(self):
+    cls = type(self)
+    with cls.lock:
+      cls.ranges.append(self.headers.get("Range", ""))
+      cls.active += 1
+      cls.max_active = max(cls.max_active, cls.active)
+    try:
+      time.sleep(LATENCY)
+      self._send_range()
+    finally:
+      with cls.lock:
+        cls.active -= 1
+
+  def _send_range(self):
+    m = re.match(r"bytes=(\d+)-(\d+)", self.headers.get("Range", ""))
+    if m is None:
+      self.send_response(200)
+      dat = FILE_DATA
+    else:
+      begin, end = int(m.group(1)), int(m.group(2))
+      self.send_response(206)
+      dat = FILE_DATA[begin:end + 1]
+    self.send_header("Content-Length", str(len(dat)))
+    self.end_headers()
+    self.wfile.write(dat)
 
 
 class TestFileDownload(unittest.TestCase):
@@ -65,5 +128,171 @@ class TestFileDownload(unittest.TestCase):
     self.compare_loads(large_file_url)
 
 
+class TestParallelDownload(unittest.TestCase):
+  def setUp(self):
+    self.server = ThreadingHTTPServer(("127.0.0.1", 0), SlowRangeHandler)
+    self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+    self.thread.start()
+    self.url = f"http://127.0.0.1:{self.server.server_port}/fcamera.hevc"
+    shutil.rmtree(CACHE_DIR, ignore_errors=True)
+    # a new index, the connections of the download threads could still be to the removed one
+    url_file._chunk_cache = None
+    SlowRangeHandler.reset()
+
+  def tearDown(self):
+    # prefetches still running would be recorded in the next test's ranges
+    self.wait_for_downloads()
+    self.server.shutdown()
+    self.server.server_close()
+
+  def test_throughput(self):
+    f = URLFile(self.url, cache=True)
+    dat = f.read()
+
+    num_chunks = len(FILE_DATA) // CHUNK_SIZE + 1
+    self.assertEqual(dat, FILE_DATA)
+    # every chunk is requested once, and chunks are fetched concurrently
+    self.assertEqual(len(SlowRangeHandler.ranges), num_chunks)
+    self.assertEqual(len(set(SlowRangeHandler.ranges)), num_chunks)
+    self.assertGreater(SlowRangeHandler.max_active, 1)
+
+  def wait_for_downloads(self):
+    while True:
+      with url_file._download_lock:
+        futures = list(url_file._inflight_chunks.values())
+      if not futures:
+        return
+      for future in futures:
+        future.result()
+
+  def test_sequential_prefetch(self):
+    f = URLFile(self.url, cache=True)
+    dat = f.read(CHUNK_SIZE)
+    dat += f.read(CHUNK_SIZE)
+    self.wait_for_downloads()
+
+    # the second, sequential read prefetched the chunks after it
+    chunk_ranges = [f"bytes={i * CHUNK_SIZE}-{(i + 1) * CHUNK_SIZE - 1}" for i in range(2 + url_file.PREFETCH_CHUNKS)]
+    self.assertEqual(sorted(SlowRangeHandler.ranges), sorted(chunk_ranges))
+    for _ in range(url_file.PREFETCH_CHUNKS):
+      dat += f.read(CHUNK_SIZE)
+    self.assertEqual(dat, FILE_DATA[:(url_file.PREFETCH_CHUNKS + 2) * CHUNK_SIZE])
+
+    # those reads were served from the cache, only further prefetches were requested
+    self.assertEqual(len(set(SlowRangeHandler.ranges)), len(SlowRangeHandler.ranges))
+
+  def test_readinto(self):
+    f = URLFile(self.url, cache=True)
+    f.read()
+
+    # warm cache, reads span chunk boundaries
+    buf = bytearray(3 * CHUNK_SIZE)
+    start = CHUNK_SIZE // 2
+    f.seek(start)
+    self.assertEqual(f.readinto(memoryview(buf)[10:]), len(buf) - 10)
+    self.assertEqual(buf[10:], FILE_DATA[start:start + len(buf) - 10])
+
+    # reads are bounded by the end of the file
+    f.seek(len(FILE_DATA) - 100)
+    self.assertEqual(f.readinto(buf), 100)
+    self.assertEqual(buf[:100], FILE_DATA[-100:])
+
+  def test_eviction(self):
+    max_size = 4 * CHUNK_SIZE
+    url_file._chunk_cache = cache = ChunkCache(CACHE_DIR, max_size)
+    try:
+      f = URLFile(self.url, cache=True)
+      self.assertEqual(f.read(), FILE_DATA)
+      stats = cache.stats()
+      self.assertLessEqual(stats['size'], max_size)
+      self.assertGreater(stats['evictions'], 0)
+      self.assertEqual(len([fn for fn in os.listdir(CACHE_DIR) if fn.startswith(url_file.hash_256(self.url))]), stats['chunks'])
+
+      # the most recently used chunks are still cached
+      f.seek(len(FILE_DATA) - 100)
+      misses = cache.misses
+      self.assertEqual(f.read(100), FILE_DATA[-100:])
+      self.assertEqual(cache.misses, misses)
+    finally:
+      url_file._chunk_cache = None
+
+  def test_missing_chunk_file(self):
+    f = URLFile(self.url, cache=True)
+    f.read(CHUNK_SIZE)
+
+    # the index still has the chunk, but its file is gone
+    chunk_path = url_file.get_chunk_cache().chunk_path(url_file.hash_256(self.url), 0)
+    os.remove(chunk_path)
+    f.seek(0)
+    self.assertEqual(f.read(CHUNK_SIZE), FILE_DATA[:CHUNK_SIZE])
+    self.assertTrue(os.path.exists(chunk_path))
+
+    requests = len(SlowRangeHandler.ranges)
+    f.seek(0)
+    self.assertEqual(f.read(CHUNK_SIZE), FILE_DATA[:CHUNK_SIZE])
+    self.assertEqual(len(SlowRangeHandler.ranges), requests)
+
+
+class TestChunkCache(unittest.TestCase):
+  def test_migrate_old_format(self):
+    with tempfile.TemporaryDirectory() as cache_dir:
+      url_hash = url_file.hash_256("https://example.com/rlog.bz2")
+      for chunk in range(3):
+        path = os.path.join(cache_dir, f"{url_hash}_{float(chunk)}")
+        with open(path, "wb") as f:
+          f.write(bytes(100))
+        os.utime(path, (1000 + chunk, 1000 + chunk))
+      with open(os.path.join(cache_dir, f"{url_hash}_length"), "w") as f:
+        f.write("250")
+
+      cache = ChunkCache(cache_dir, 250)
+      self.assertEqual(cache.get_length(url_hash), 250)
+      # migrated chunks count towards the size, the oldest one was evicted
+      stats = cache.stats()
+      self.assertEqual((stats['chunks'], stats['size'], stats['evictions']), (2, 200, 1))
+      self.assertEqual(cache.lookup(url_hash, range(3)), {1, 2})
+      self.assertEqual(sorted(fn for fn in os.listdir(cache_dir) if fn.startswith(url_hash)), [f"{url_hash}_1", f"{url_hash}_2"])
+
+      # only migrated once
+      with open(os.path.join(cache_dir, f"{url_hash}_5.0"), "wb") as f:
+        f.write(bytes(100))
+      self.assertEqual(ChunkCache(cache_dir, 250).stats()['chunks'], 2)
+
+  def test_total_size(self):
+    with tempfile.TemporaryDirectory() as cache_dir:
+      cache = ChunkCache(cache_dir, 1000)
+
+      def total_size():
+        # the size kept by the triggers, and counted from scratch
+        db = cache._db()
+        return cache.stats()['size'], db.execute("SELECT COALESCE(SUM(size), 0) FROM chunks").fetchone()[0]
+
+      for chunk in range(3):
+        cache.put("a", chunk, bytes(100))
+      cache.put("b", 0, bytes(300))
+      self.assertEqual(total_size(), (600, 600))
+      cache.put("a", 1, bytes(50))
+      self.assertEqual(total_size(), (550, 550))
+      cache.remove("a")
+      self.assertEqual(total_size(), (300, 300))
+      cache.put("c", 0, bytes(900))
+      self.assertEqual(total_size(), (900, 900))
+      self.assertEqual(cache.stats()['evictions'], 1)
+
+  def test_evict_least_recently_used(self):
+    with tempfile.TemporaryDirectory() as cache_dir:
+      cache = ChunkCache(cache_dir, 300)
+      for chunk in range(3):
+        cache.put("a", chunk, bytes(100))
+        time.sleep(0.01)
+
+      # the access times of hits are written before evicting, not on every hit
+      self.assertEqual(cache.lookup("a", [0]), {0})
+      self.assertEqual(cache._db().execute("SELECT chunk FROM chunks ORDER BY last_access").fetchall()[0], (0,))
+      time.sleep(0.01)
+      cache.put("a", 3, bytes(100))
+      self.assertEqual(cache.lookup("a", range(4)), {0, 2, 3})
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+import os
+import random
+import shutil
+import signal
+import subprocess
+import tempfile
+import unittest
+import unittest.mock
+
+import numpy as np
+
+from tools.lib import cache
+from tools.lib import framereader
+from tools.lib.chunk_cache import ChunkCache
+from tools.lib.framereader import FrameIterator, FrameReader, decompress_video_data, index_hevc_stream, rgb24toyuv420
+
+FRAME_COUNT = 25
+GOP_SIZE = 10
+W, H = 128, 96
+
+VIDINDEX_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "vidindex")
+
+
+def encode_hevc(path, frame_count=FRAME_COUNT, gop_size=GOP_SIZE, w=W, h=H):
+  subprocess.check_call(["ffmpeg", "-v", "quiet", "-f", "lavfi", "-i", f"testsrc=size={w}x{h}:rate=20",
+                         "-frames:v", str(frame_count), "-pix_fmt", "yuv420p", "-c:v", "libx265",
+                         "-x265-params", f"keyint={gop_size}:min-keyint={gop_size}:bframes=0:log-level=none",
+                         "-f", "hevc", path])
+
+
+class TestFrameReader(unittest.TestCase):
+  @classmethod
+  def setUpClass(cls):
+    cls.tmp = tempfile.mkdtemp()
+    cls.fn = os.path.join(cls.tmp, "fcamera.hevc")
+    encode_hevc(cls.fn)
+    with open(cls.fn, "rb") as f:
+      dat = f.read()
+    # decoded in one go, in order
+    cls.frames = {pix_fmt: decompress_video_data(dat, "hevc", W, H, pix_fmt) for pix_fmt in ("yuv420p", "rgb24")}
+
+  @classmethod
+  def tearDownClass(cls):
+    shutil.rmtree(cls.tmp)
+
+  def setUp(self):
+    self.cache_dir = tempfile.mkdtemp()
+    self._cache_dir = cache.DEFAULT_CACHE_DIR
+    cache.DEFAULT_CACHE_DIR = self.cache_dir
+    framereader._frame_cache = ChunkCache(os.path.join(self.cache_dir, "frames"), 100 * 1000 * 1000)
+    framereader._decoder_pool = None
+
+  def tearDown(self):
+    cache.DEFAULT_CACHE_DIR = self._cache_dir
+    framereader._frame_cache = None
+    framereader._decoder_pool = None
+    shutil.rmtree(self.cache_dir)
+
+  def assert_random_access(self, pix_fmt):
+    random.seed(0)
+    nums = list(range(FRAME_COUNT)) * 2
+    random.shuffle(nums)
+
+    fr = FrameReader(self.fn)
+    self.assertEqual((fr.frame_count, fr.w, fr.h), (FRAME_COUNT, W, H))
+    for num in nums:
+      np.testing.assert_array_equal(fr.get(num, pix_fmt=pix_fmt)[0], self.frames[pix_fmt][num], f"frame {num}")
+
+  def test_random_access(self):
+    for pix_fmt in ("yuv420p", "rgb24"):
+      with self.subTest(pix_fmt=pix_fmt):
+        self.assert_random_access(pix_fmt)
+
+  def test_random_access_uncached(self):
+    # every get decodes its GOP again, on the same pooled decoder
+    with unittest.mock.patch.object(framereader.GOPFrameReader, "_get_cached", return_value=None), \
+         unittest.mock.patch.object(framereader, "FFMPEG_POOL_SIZE", 1):
+      self.assert_random_access("yuv420p")
+    self.assertEqual(framereader.get_decoder_pool()._count[("hevc", W, H, "yuv420p", False)], 1)
+
+  def test_random_access_without_pool(self):
+    with unittest.mock.patch.object(framereader, "FFMPEG_POOL_SIZE", 0):
+      self.assert_random_access("yuv420p")
+
+  def test_frame_cache_disabled(self):
+    # a disabled frame cache, and one too small for a GOP
+    for size in ["0", "20000"]:
+      with self.subTest(size=size), \
+           unittest.mock.patch.object(framereader, "FRAME_CACHE_SIZE", size), \
+           unittest.mock.patch.object(framereader, "FRAME_CACHE_DIR", os.path.join(self.cache_dir, size)):
+        framereader._frame_cache = None
+        fr = FrameReader(self.fn)
+        with unittest.mock.patch.object(fr, "_decode_gop", wraps=fr._decode_gop) as decode_gop:
+          frames = fr.get(0, count=GOP_SIZE)
+          # the reader keeps the GOP it decoded last
+          self.assertEqual(decode_gop.call_count, 1)
+
+          frames += fr.get(GOP_SIZE, count=FRAME_COUNT - GOP_SIZE)
+          self.assertEqual(decode_gop.call_count, 3)
+        np.testing.assert_array_equal(np.stack(frames), self.frames["yuv420p"])
+
+  def test_decoder_timeout(self):
+    fr = FrameReader(self.fn)
+    pool = framereader.get_decoder_pool()
+    frame_b, num_frames, skip_frames, rawdat = fr.get_gop(12)
+    iframe = fr.get_iframe(frame_b, num_frames, rawdat)
+    key = ("hevc", W, H, "yuv420p", False)
+
+    pool.decode(rawdat, iframe, num_frames, skip_frames, *key)
+    hung, = pool._idle[key]
+    os.kill(hung.proc.pid, signal.SIGSTOP)
+
+    # the hung decoder is killed, and the GOP decoded without the pool
+    with unittest.mock.patch.object(framereader, "FFMPEG_DECODE_TIMEOUT", 0.5):
+      frames = pool.decode(rawdat, iframe, num_frames, skip_frames, *key)
+    np.testing.assert_array_equal(frames, self.frames["yuv420p"][frame_b:frame_b + num_frames])
+    self.assertIsNotNone(hung.proc.poll())
+    self.assertEqual((pool._idle[key], pool._count[key]), ([], 0))
+
+    # and replaced by a new one
+    frames = pool.decode(rawdat, iframe, num_frames, skip_frames, *key)
+    np.testing.assert_array_equal(frames, self.frames["yuv420p"][frame_b:frame_b + num_frames])
+    self.assertEqual(pool._count[key], 1)
+
+  def test_index(self):
+    fr = FrameReader(self.fn)
+    np.testing.assert_array_equal(fr.iframes, np.arange(0, FRAME_COUNT, GOP_SIZE))
+
+    # indexing in small chunks splits NALs and start codes between reads
+    with open(self.fn, "rb") as f:
+      index, prefix, probe = index_hevc_stream(f, chunk_size=7)
+    np.testing.assert_array_equal(index, fr.index)
+    self.assertEqual(prefix, fr.prefix)
+    self.assertEqual((probe['streams'][0]['width'], probe['streams'][0]['height']), (W, H))
+
+    # the cached index is memory mapped, without fingerprinting the file again
+    with unittest.mock.patch.object(framereader, "fingerprint_video", side_effect=AssertionError):
+      cached = FrameReader(self.fn)
+    self.assertIsInstance(cached.index, np.memmap)
+    np.testing.assert_array_equal(cached.index, fr.index)
+
+  def test_index_matches_vidindex(self):
+    subprocess.check_call(["make"], cwd=VIDINDEX_DIR, stdout=subprocess.DEVNULL)
+
+    # not a multiple of the coding block size, so the SPS has a conformance window
+    fn = os.path.join(self.cache_dir, "odd.hevc")
+    encode_hevc(fn, w=100, h=70)
+    for path, size in [(self.fn, (W, H)), (fn, (100, 70))]:
+      with self.subTest(path=path):
+        prefix_fn, index_fn = os.path.join(self.cache_dir, "prefix"), os.path.join(self.cache_dir, "index")
+        subprocess.check_call([os.path.join(VIDINDEX_DIR, "vidindex"), "hevc", path, prefix_fn, index_fn])
+        with open(prefix_fn, "rb") as f:
+          prefix = f.read()
+        index = np.fromfile(index_fn, dtype=np.uint32).reshape(-1, 2)
+
+        with open(path, "rb") as f:
+          index_data = index_hevc_stream(f)
+        np.testing.assert_array_equal(index_data[0], index)
+        self.assertEqual(index_data[1], prefix)
+        self.assertEqual((index_data[2]['streams'][0]['width'], index_data[2]['streams'][0]['height']), size)
+
+  def test_get_many(self):
+    fr = FrameReader(self.fn)
+    fr.get(3)
+    frame_ids = [24, 3, 0, 17, 3, 11, 12, 9]
+    with unittest.mock.patch.object(fr, "_decode_gop", wraps=fr._decode_gop) as decode_gop:
+      frames = fr.get_many(frame_ids)
+    np.testing.assert_array_equal(frames, self.frames["yuv420p"][frame_ids])
+    # the GOP of frame 3 is cached, every other GOP is decoded once
+    self.assertEqual(decode_gop.call_count, 2)
+
+  def test_keyframes(self):
+    fr = FrameReader(self.fn)
+    for num in [0, 9, 10, 24]:
+      keyframe_num, frame = fr.get_keyframe(num, pix_fmt="rgb24")
+      self.assertEqual(keyframe_num, num // GOP_SIZE * GOP_SIZE)
+      np.testing.assert_array_equal(frame, self.frames["rgb24"][keyframe_num])
+
+    keyframes = np.stack(list(FrameIterator(self.fn, "rgb24", keyframes_only=True)))
+    np.testing.assert_array_equal(keyframes, self.frames["rgb24"][fr.iframes])
+
+  def test_downscale(self):
+    with open(self.fn, "rb") as f:
+      expected = decompress_video_data(f.read(), "hevc", W // 2, H // 2, "yuv420p", scale=True)
+
+    fr = FrameReader(self.fn, downscale=2)
+    self.assertEqual((fr.w, fr.h), (W // 2, H // 2))
+    np.testing.assert_array_equal(fr.get_many([20, 5, 13]), expected[[20, 5, 13]])
+    np.testing.assert_array_equal(np.stack(list(FrameIterator(self.fn, "yuv420p", downscale=2))), expected)
+
+
+class TestRawFrameReader(unittest.TestCase):
+  def test_raw(self):
+    np.random.seed(0)
+    imgs = np.random.randint(0, 256, (3, 960, 1280), dtype=np.uint8)
+    with tempfile.NamedTemporaryFile() as f:
+      for img in imgs:
+        f.write(np.uint32(img.size).tobytes() + img.tobytes())
+      f.flush()
+
+      fr = FrameReader(f.name)
+      self.assertEqual(fr.frame_count, 3)
+
+      # red, the mean of both greens and blue of each 2x2 bayer block
+      green = ((imgs[:, 0::2, 0::2].astype(np.uint16) + imgs[:, 1::2, 1::2]) // 2).astype(np.uint8)
+      rgb = np.stack([imgs[:, 0::2, 1::2], green, imgs[:, 1::2, 0::2]], axis=-1)
+      np.testing.assert_array_equal(np.stack(fr.get(0, 3, pix_fmt="rgb24")), rgb)
+      np.testing.assert_array_equal(fr.get_many([2, 0, 2], pix_fmt="rgb24"), rgb[[2, 0, 2]])
+      np.testing.assert_array_equal(fr.get_many([1, 2]), rgb24toyuv420(rgb[[1, 2]]))
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+import bz2
+import os
+import random
+import shutil
+import tempfile
+import threading
+import unittest
+import unittest.mock
+
+import numpy as np
+
+from cereal import log as capnp_log
+from tools.lib import cache
+from tools.lib import logreader
+from tools.lib.logreader import LogReader, MultiLogIterator, PrefetchLogIterator, convert_log, get_log_index, \
+                                 log_to_arrays
+from tools.lib.route import Route
+
+
+def car_state(mono_time, v_ego=0.):
+  msg = capnp_log.Event.new_message(logMonoTime=int(mono_time))
+  msg.init('carState').vEgo = v_ego
+  return msg
+
+
+def controls_state(mono_time, v_cruise=0.):
+  msg = capnp_log.Event.new_message(logMonoTime=int(mono_time))
+  msg.init('controlsState').vCruise = v_cruise
+  return msg
+
+
+def live_calibration(mono_time, rpy):
+  msg = capnp_log.Event.new_message(logMonoTime=int(mono_time))
+  msg.init('liveCalibration').rpyCalib = rpy
+  return msg
+
+
+def write_log(path, msgs):
+  with open(path, "wb") as f:
+    f.write(bz2.compress(b"".join(m.to_bytes() for m in msgs)))
+
+
+class TestLogReader(unittest.TestCase):
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp()
+    self._cache_dir = cache.DEFAULT_CACHE_DIR
+    cache.DEFAULT_CACHE_DIR = os.path.join(self.tmp, "cache")
+
+  def tearDown(self):
+    cache.DEFAULT_CACHE_DIR = self._cache_dir
+    shutil.rmtree(self.tmp)
+
+  def test_seek_out_of_order(self):
+    # events are logged in receive order, jittered around their logMonoTime
+    random.seed(0)
+    log_paths = []
+    for minute in range(3):
+      mono_times = [int((minute * 60 + i * 0.1 + random.uniform(-0.3, 0.3)) * 1e9) + 10**9 for i in range(600)]
+      log_paths.append(os.path.join(self.tmp, f"{minute}.bz2"))
+      write_log(log_paths[-1], [car_state(t) for t in mono_times])
+
+    def scan(mli, ts):
+      # O(n) seek: the first event in file order at or after ts
+      mli._idx = 0
+      while mli.tell() < ts:
+        mli._inc()
+      return mli._current_log, mli._idx
+
+    mli = MultiLogIterator(log_paths, wraparound=False, readahead=None)
+    for ts in [0., 0.05, 7.33, 59.99, 60.2, 119.95, 150.]:
+      self.assertTrue(mli.seek(ts))
+      seeked = (mli._current_log, mli._idx)
+      mli._current_log = int(ts / 60)
+      self.assertEqual(seeked, scan(mli, ts), f"seek to {ts}")
+
+  def test_index_rebuilt_when_log_changes(self):
+    fn = os.path.join(self.tmp, "rlog.bz2")
+    write_log(fn, [car_state(i) for i in range(10)])
+    self.assertEqual(len(LogReader(fn, services=['carState'])._ents), 10)
+
+    write_log(fn, [car_state(i) for i in range(20)] + [controls_state(20)])
+    self.assertEqual(len(get_log_index(fn)['mono_time']), 21)
+    self.assertEqual(len(LogReader(fn, services=['carState'])._ents), 20)
+
+  def test_block_log_replaced_source(self):
+    fn = os.path.join(self.tmp, "rlog.bz2")
+    write_log(fn, [car_state(i) for i in range(10)])
+    convert_log(fn)
+
+    # the conversion is used instead of the log
+    with unittest.mock.patch.object(logreader, "_read_source_log", side_effect=AssertionError):
+      self.assertEqual([m.logMonoTime for m in LogReader(fn)], list(range(10)))
+
+    write_log(fn, [car_state(i) for i in range(20, 25)])
+    self.assertEqual([m.logMonoTime for m in LogReader(fn, streaming=True)], list(range(20, 25)))
+    self.assertEqual([m.logMonoTime for m in LogReader(fn)], list(range(20, 25)))
+
+    # and converted again on the full read
+    with unittest.mock.patch.object(logreader, "_read_source_log", side_effect=AssertionError):
+      self.assertEqual([m.logMonoTime for m in LogReader(fn, streaming=True)], list(range(20, 25)))
+
+  def test_to_arrays_cached(self):
+    fn = os.path.join(self.tmp, "rlog.bz2")
+    write_log(fn, [car_state(i, v_ego=i) for i in range(10)] + [controls_state(i, v_cruise=2 * i) for i in range(5)] +
+                  [live_calibration(i, [i, 0, 1]) for i in range(3)])
+    fields = ['carState.vEgo', 'controlsState.vCruise', 'liveCalibration.rpyCalib']
+    arrays = LogReader(fn).to_arrays(fields)
+    np.testing.assert_array_equal(arrays['carState.vEgo'], np.arange(10))
+    np.testing.assert_array_equal(arrays['controlsState.logMonoTime'], np.arange(5))
+    self.assertEqual(arrays['liveCalibration.rpyCalib'].shape, (3, 3))
+
+    # served from the cache, without reading the log
+    with unittest.mock.patch.object(logreader, "LogReader", side_effect=AssertionError):
+      cached = log_to_arrays(fn, fields)
+    self.assertEqual(cached.keys(), arrays.keys())
+    for k in arrays:
+      np.testing.assert_array_equal(cached[k], arrays[k])
+
+  def test_to_arrays_replaced_source(self):
+    fn = os.path.join(self.tmp, "rlog.bz2")
+    write_log(fn, [car_state(i, v_ego=i) for i in range(10)] + [controls_state(i, v_cruise=i) for i in range(5)])
+    LogReader(fn).to_arrays(['carState.vEgo', 'controlsState.vCruise'])
+
+    write_log(fn, [car_state(i, v_ego=2 * i) for i in range(10)] + [controls_state(i, v_cruise=2 * i) for i in range(5)])
+    st = os.stat(fn)
+    os.utime(fn, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    np.testing.assert_array_equal(log_to_arrays(fn, ['carState.vEgo'])['carState.vEgo'], 2 * np.arange(10))
+
+    # the columns of the old log aren't served next to the new ones
+    arrays = log_to_arrays(fn, ['carState.vEgo', 'controlsState.vCruise'])
+    np.testing.assert_array_equal(arrays['controlsState.vCruise'], 2 * np.arange(5))
+
+  def test_to_arrays_filtered(self):
+    fn = os.path.join(self.tmp, "rlog.bz2")
+    write_log(fn, [car_state(i, v_ego=i) for i in range(10)] + [controls_state(i, v_cruise=2 * i) for i in range(5)])
+
+    arrays = LogReader(fn, services=['carState']).to_arrays(['carState.vEgo', 'controlsState.vCruise'])
+    self.assertEqual(len(arrays['carState.vEgo']), 10)
+    self.assertEqual(len(arrays['controlsState.vCruise']), 0)
+
+    # the services left out by the filter weren't cached as empty
+    arrays = log_to_arrays(fn, ['carState.vEgo', 'controlsState.vCruise'])
+    np.testing.assert_array_equal(arrays['controlsState.vCruise'], 2 * np.arange(5))
+
+  def test_to_arrays_variable_length(self):
+    fn = os.path.join(self.tmp, "rlog.bz2")
+    write_log(fn, [live_calibration(0, [0, 0, 0]), live_calibration(1, [0, 0])])
+    with self.assertRaises(ValueError):
+      LogReader(fn).to_arrays(['liveCalibration.rpyCalib'])
+
+  def test_route_to_arrays_without_logs(self):
+    segment_dir = os.path.join(self.tmp, "a2a0ccea32023010|2020-07-24--17-56-14--0")
+    os.mkdir(segment_dir)
+    write_log(os.path.join(segment_dir, "qlog.bz2"), [car_state(0)])
+
+    arrays = Route("a2a0ccea32023010|2020-07-24--17-56-14", self.tmp).to_arrays(['carState.vEgo'])
+    self.assertEqual(len(arrays['carState.vEgo']), 0)
+    self.assertEqual(len(arrays['carState.logMonoTime']), 0)
+
+  def test_prefetch_skips_corrupt_logs(self):
+    log_paths = [os.path.join(self.tmp, f"{i}.bz2") for i in range(4)]
+    write_log(log_paths[0], [car_state(i) for i in range(10)])
+    with open(log_paths[1], "wb") as f:
+      f.write(os.urandom(1000))
+    write_log(log_paths[2], [car_state(i) for i in range(20, 30)])
+    with open(log_paths[3], "wb") as f:
+      f.write(bz2.compress(car_state(40).to_bytes())[:-10])
+
+    with PrefetchLogIterator(log_paths + [None], workers=2) as it:
+      mono_times = [m.logMonoTime for m in it]
+    self.assertEqual(mono_times, list(range(10)) + list(range(20, 30)))
+
+  def test_readahead(self):
+    log_paths = [os.path.join(self.tmp, f"{i}.bz2") for i in range(3)]
+    for i, path in enumerate(log_paths):
+      write_log(path, [car_state(i * 100 + j) for j in range(100)])
+
+    # which logs were loaded, and if in the foreground, stalling the consumer
+    loads = []
+    load = MultiLogIterator._load
+    def record_load(mli, i):
+      loads.append((i, threading.current_thread() is threading.main_thread()))
+      return load(mli, i)
+
+    with unittest.mock.patch.object(MultiLogIterator, "_load", record_load):
+      mli = MultiLogIterator(log_paths, wraparound=True)
+      mono_times = [next(mli).logMonoTime for _ in range(2 * 300 + 1)]
+
+    self.assertEqual(mono_times, 2 * list(range(300)) + [0])
+    # the first log is still kept when wrapping around to it, only the last one is read again
+    self.assertEqual(loads, [(0, True), (1, False), (2, False), (2, False)])
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -1,11 +1,16 @@
 #!/usr/bin/env python
+import errno
+import os
 import unittest
+import unittest.mock
 import requests
 import tempfile
 
 from collections import defaultdict
 import numpy as np
-from tools.lib.framereader import FrameReader
+from tools.lib import framereader
+from tools.lib.chunk_cache import ChunkCache
+from tools.lib.framereader import FrameCache, FrameReader
 from tools.lib.logreader import LogReader
 
 
@@ -28,6 +33,9 @@ class TestReaders(unittest.TestCase):
       lr_file = LogReader(fp.name)
       _check_data(lr_file)
 
+      lr_stream = LogReader(fp.name, streaming=True)
+      _check_data(lr_stream)
+
     lr_url = LogReader("https://github.com/commaai/comma2k19/blob/master/Example_1/b0c9d2329ad1606b%7C2018-08-02--08-34-47/40/raw_log.bz2?raw=true")
     _check_data(lr_url)
 
@@ -63,5 +71,55 @@ class TestReaders(unittest.TestCase):
     fr_url = FrameReader("https://github.com/commaai/comma2k19/blob/master/Example_1/b0c9d2329ad1606b%7C2018-08-02--08-34-47/40/video.hevc?raw=true")
     _check_data(fr_url)
 
+  def test_frame_cache(self):
+    with tempfile.TemporaryDirectory() as cache_dir:
+      framereader._frame_cache = ChunkCache(cache_dir, 3 * 4 * 6 * 3)
+      try:
+        frames = np.random.randint(0, 256, (4, 4, 6, 3), dtype=np.uint8)
+        cache = FrameCache("video.hevc", 6, 4)
+        cache.put(10, frames, "rgb24")
+
+        # over budget, the first frame was evicted
+        self.assertIsNone(cache.get(10, "rgb24"))
+        for i in range(1, 4):
+          np.testing.assert_array_equal(cache.get(10 + i, "rgb24"), frames[i])
+        self.assertIsNone(cache.get(11, "yuv420p"))
+        self.assertIsNone(FrameCache("other.hevc", 6, 4).get(11, "rgb24"))
+
+        stats = framereader.get_frame_cache().stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['evictions']), (3, 3, 1))
+      finally:
+        framereader._frame_cache = None
+
+  def test_frame_cache_file_changed(self):
+    with tempfile.TemporaryDirectory() as cache_dir, tempfile.NamedTemporaryFile(suffix=".hevc") as video:
+      framereader._frame_cache = ChunkCache(cache_dir, 10 * 1000)
+      try:
+        frames = np.random.randint(0, 256, (2, 4, 6, 3), dtype=np.uint8)
+        FrameCache(video.name, 6, 4).put(0, frames, "rgb24")
+
+        # a writable copy, and the same file through a relative path
+        frame = FrameCache(os.path.relpath(video.name), 6, 4).get(1, "rgb24")
+        np.testing.assert_array_equal(frame, frames[1])
+        frame[:] = 0
+        np.testing.assert_array_equal(FrameCache(video.name, 6, 4).get(1, "rgb24"), frames[1])
+
+        st = os.stat(video.name)
+        os.utime(video.name, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+        self.assertIsNone(FrameCache(video.name, 6, 4).get(1, "rgb24"))
+      finally:
+        framereader._frame_cache = None
+
+  def test_frame_cache_out_of_space(self):
+    with tempfile.TemporaryDirectory() as cache_dir:
+      framereader._frame_cache = ChunkCache(cache_dir, 10 * 1000)
+      try:
+        cache = FrameCache("video.hevc", 6, 4)
+        with unittest.mock.patch.object(ChunkCache, "put", side_effect=OSError(errno.ENOSPC, "No space left on device")):
+          cache.put(0, np.zeros((2, 4, 6, 3), dtype=np.uint8), "rgb24")
+        self.assertIsNone(cache.get(0, "rgb24"))
+      finally:
+        framereader._frame_cache = None
+
 if __name__ == "__main__":
   unittest.main()
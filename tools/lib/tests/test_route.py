@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+import os
+import shutil
+import tempfile
+import unittest
+import unittest.mock
+
+from tools.lib import route
+from tools.lib.route import Route
+
+ROUTE_NAME = "a2a0ccea32023010|2020-07-24--17-56-14"
+
+
+def route_files(sig):
+  url = "https://commadata2.blob.core.windows.net/commadata2/a2a0ccea32023010/2020-07-24--17-56-14/{}/{}?sig=" + sig
+  return {
+    'logs': [url.format(i, "rlog.bz2") for i in range(2)],
+    'cameras': [url.format(i, "fcamera.hevc") for i in range(2)],
+  }
+
+
+class TestRoute(unittest.TestCase):
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp()
+    self.data_dir = os.path.join(self.tmp, "data")
+    os.mkdir(self.data_dir)
+    self._cache_dir = route.ROUTE_CACHE_DIR
+    route.ROUTE_CACHE_DIR = os.path.join(self.tmp, "routes")
+
+  def tearDown(self):
+    route.ROUTE_CACHE_DIR = self._cache_dir
+    shutil.rmtree(self.tmp)
+
+  def touch(self, *path):
+    path = os.path.join(self.data_dir, *path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, "w").close()
+    return path
+
+  def test_local_listing_order(self):
+    video = self.touch(f"{ROUTE_NAME}--0", "video.hevc")
+    fcamera = self.touch(f"{ROUTE_NAME}--0", "fcamera.hevc")
+    raw_log = self.touch(f"{ROUTE_NAME}--0", "raw_log.bz2")
+    rlog = self.touch(ROUTE_NAME, "0", "rlog.bz2")
+
+    # the first file in the listing wins, not the first of the accepted filenames
+    listdir = os.listdir
+    for reverse in [False, True]:
+      with unittest.mock.patch("os.listdir", lambda p: sorted(listdir(p), reverse=reverse)):
+        seg, = Route(ROUTE_NAME, self.data_dir, refresh=True).segments
+      self.assertEqual(seg.camera_path, video if reverse else fcamera)
+      # the segment directory sorts after the route directory
+      self.assertEqual(seg.log_path, raw_log if reverse else rlog)
+
+  def test_local_index_updated(self):
+    self.touch(f"{ROUTE_NAME}--0", "rlog.bz2")
+    self.assertEqual(len(Route(ROUTE_NAME, self.data_dir).segments), 1)
+
+    qlog = self.touch(f"{ROUTE_NAME}--0", "qlog.bz2")
+    rlog = self.touch(f"{ROUTE_NAME}--1", "rlog.bz2")
+    segments = Route(ROUTE_NAME, self.data_dir).segments
+    self.assertEqual([s.qlog_path for s in segments], [qlog, None])
+    self.assertEqual(segments[1].log_path, rlog)
+
+  @unittest.mock.patch.object(route, "get_token", lambda: None)
+  def test_remote_listing_cached(self):
+    with unittest.mock.patch.object(route, "CommaApi") as api:
+      api.return_value.get.side_effect = [route_files("a"), route_files("b"), route_files("c")]
+
+      self.assertTrue(Route(ROUTE_NAME).segments[0].log_path.endswith("sig=a"))
+      self.assertTrue(Route(ROUTE_NAME).segments[0].log_path.endswith("sig=a"))
+      self.assertEqual(api.return_value.get.call_count, 1)
+
+      # refreshing replaces the cached listing
+      self.assertTrue(Route(ROUTE_NAME, refresh=True).segments[0].log_path.endswith("sig=b"))
+      self.assertTrue(Route(ROUTE_NAME).segments[0].log_path.endswith("sig=b"))
+      self.assertEqual(api.return_value.get.call_count, 2)
+
+      with unittest.mock.patch.object(route, "REMOTE_ROUTE_CACHE_TTL", 0):
+        self.assertTrue(Route(ROUTE_NAME).segments[0].log_path.endswith("sig=c"))
+      self.assertEqual(api.return_value.get.call_count, 3)
+
+
+if __name__ == "__main__":
+  unittest.main()
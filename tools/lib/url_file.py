@@ -1,20 +1,35 @@
 # pylint: skip-file
 
 import os
+import mmap
 import time
 import tempfile
 import threading
 import urllib.parse
 import pycurl
+from concurrent.futures import ThreadPoolExecutor
 from hashlib import sha256
 from io import BytesIO
 from tenacity import retry, wait_random_exponential, stop_after_attempt
-from tools.lib.file_helpers import mkdirs_exists_ok, atomic_write_in_dir
+from tools.lib.chunk_cache import ChunkCache
+from tools.lib.file_helpers import mkdirs_exists_ok
 #  Cache chunk size
 K = 1000
 CHUNK_SIZE = 1000 * K
 
 CACHE_DIR = os.environ.get("COMMA_CACHE", "/tmp/comma_download_cache/")
+# Maximum size of the chunk cache, least recently used chunks are evicted past it
+CACHE_MAX_SIZE = int(os.environ.get("COMMA_CACHE_MAX_SIZE", str(10 * 1000 * 1000 * K)))
+
+# Number of chunks downloaded in parallel, shared by all URLFiles
+DOWNLOAD_THREADS = int(os.environ.get("URLFILE_THREADS", "8"))
+# Number of chunks fetched ahead of sequential reads
+PREFETCH_CHUNKS = int(os.environ.get("URLFILE_PREFETCH", "4"))
+
+_download_pool = None
+_download_lock = threading.RLock()
+_inflight_chunks = {}
+_chunk_cache = None
 
 
 def hash_256(link):
@@ -22,6 +37,37 @@ def hash_256(link):
   return hsh
 
 
+def _get_download_pool():
+  global _download_pool
+  with _download_lock:
+    if _download_pool is None:
+      # worker threads keep their curl handle, so connections stay alive across files
+      _download_pool = ThreadPoolExecutor(max_workers=DOWNLOAD_THREADS)
+    return _download_pool
+
+
+def get_chunk_cache():
+  """Returns the chunk cache shared by all URLFiles, see ChunkCache.stats for hit/miss counters."""
+  global _chunk_cache
+  with _download_lock:
+    if _chunk_cache is None:
+      _chunk_cache = ChunkCache(CACHE_DIR, CACHE_MAX_SIZE)
+    return _chunk_cache
+
+
+def _reset_after_fork():
+  # download threads, curl handles and sqlite connections don't survive a fork
+  global _download_pool, _download_lock, _inflight_chunks, _chunk_cache
+  _download_pool = None
+  _download_lock = threading.RLock()
+  _inflight_chunks = {}
+  _chunk_cache = None
+  URLFile._tlocal = threading.local()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
 class URLFile(object):
   _tlocal = threading.local()
 
@@ -36,10 +82,7 @@ class URLFile(object):
     if cache is not None:
       self._force_download = not cache
 
-    try:
-      self._curl = self._tlocal.curl
-    except AttributeError:
-      self._curl = self._tlocal.curl = pycurl.Curl()
+    self._last_read_end = None
     mkdirs_exists_ok(CACHE_DIR)
 
   def __enter__(self):
@@ -51,6 +94,15 @@ class URLFile(object):
       self._local_file.close()
       self._local_file = None
 
+  @property
+  def _curl(self):
+    # curl handles can't be shared between threads
+    try:
+      return self._tlocal.curl
+    except AttributeError:
+      self._tlocal.curl = pycurl.Curl()
+      return self._tlocal.curl
+
   @retry(wait=wait_random_exponential(multiplier=1, max=5), stop=stop_after_attempt(3), reraise=True)
   def get_length_online(self):
     c = self._curl
@@ -68,57 +120,120 @@ class URLFile(object):
   def get_length(self):
     if self._length is not None:
       return self._length
-    file_length_path = os.path.join(CACHE_DIR, hash_256(self._url) + "_length")
-    if os.path.exists(file_length_path) and not self._force_download:
-      with open(file_length_path, "r") as file_length:
-          content = file_length.read()
-          self._length = int(content)
-          return self._length
+    if not self._force_download:
+      self._length = get_chunk_cache().get_length(hash_256(self._url))
+      if self._length is not None:
+        return self._length
 
     self._length = self.get_length_online()
     if not self._force_download:
-      with atomic_write_in_dir(file_length_path, mode="w") as file_length:
-        file_length.write(str(self._length))
+      get_chunk_cache().put_length(hash_256(self._url), self._length)
     return self._length
 
+  def _download_chunk(self, chunk_number):
+    data = self._read_range(chunk_number * CHUNK_SIZE, CHUNK_SIZE)
+    get_chunk_cache().put(hash_256(self._url), chunk_number, data)
+    return data
+
+  def _fetch_chunk(self, chunk_number):
+    """Returns a future for the chunk data. Chunks already being downloaded
+       by another reader aren't requested twice."""
+    key = (hash_256(self._url), chunk_number)
+    with _download_lock:
+      future = _inflight_chunks.get(key)
+      if future is None:
+        future = _get_download_pool().submit(self._download_chunk, chunk_number)
+        _inflight_chunks[key] = future
+
+        def done(_, key=key):
+          with _download_lock:
+            _inflight_chunks.pop(key, None)
+        future.add_done_callback(done)
+    return future
+
+  def _prefetch(self, first_chunk):
+    num_chunks = (self.get_length() + CHUNK_SIZE - 1) // CHUNK_SIZE
+    chunks = range(first_chunk, min(num_chunks, first_chunk + PREFETCH_CHUNKS))
+    cached = get_chunk_cache().lookup(hash_256(self._url), chunks, count=False)
+    for chunk_number in chunks:
+      if chunk_number not in cached:
+        self._fetch_chunk(chunk_number)
+
+  def _copy_chunk(self, chunk_number, dest, begin):
+    # copies chunk[begin:begin + len(dest)] from the memory mapped chunk file
+    try:
+      with open(get_chunk_cache().chunk_path(hash_256(self._url), chunk_number), "rb") as cached_file, \
+           mmap.mmap(cached_file.fileno(), 0, access=mmap.ACCESS_READ) as m, \
+           memoryview(m) as data:
+        dest[:] = data[begin:begin + len(dest)]
+    except FileNotFoundError:
+      # evicted by another reader in the meantime, or the file is gone but the index
+      # still has it. Downloading puts it back, so it's not missed on every read
+      data = self._download_chunk(chunk_number)
+      dest[:] = data[begin:begin + len(dest)]
+
+  def _readinto(self, buf):
+    file_begin = self._pos
+    file_end = min(file_begin + len(buf), self.get_length())
+    if file_end <= file_begin:
+      return 0
+    #  We have to allign with chunks we store
+    first_chunk = file_begin // CHUNK_SIZE
+    end_chunk = (file_end + CHUNK_SIZE - 1) // CHUNK_SIZE
+
+    #  Download all missing chunks in parallel
+    chunks = range(first_chunk, end_chunk)
+    cached = get_chunk_cache().lookup(hash_256(self._url), chunks)
+    futures = {i: self._fetch_chunk(i) for i in chunks if i not in cached}
+    sequential = self._last_read_end == file_begin
+    if sequential and PREFETCH_CHUNKS > 0:
+      self._prefetch(end_chunk)
+
+    #  Assemble the chunks directly into the destination buffer
+    with memoryview(buf) as view:
+      for chunk_number in chunks:
+        position = chunk_number * CHUNK_SIZE
+        begin = max(0, file_begin - position)
+        end = min(CHUNK_SIZE, file_end - position)
+        dest = view[position + begin - file_begin:position + end - file_begin]
+        if chunk_number in futures:
+          dest[:] = futures[chunk_number].result()[begin:end]
+        else:
+          self._copy_chunk(chunk_number, dest, begin)
+
+    self._pos = file_end
+    self._last_read_end = file_end
+    return file_end - file_begin
+
+  def readinto(self, buf):
+    """Reads up to len(buf) bytes into a writable buffer, without intermediate copies on cache hits."""
+    if self._force_download:
+      dat = self.read_aux(ll=len(buf))
+      buf[:len(dat)] = dat
+      return len(dat)
+    return self._readinto(buf)
+
   def read(self, ll=None):
     if self._force_download:
       return self.read_aux(ll=ll)
 
-    file_begin = self._pos
-    file_end = self._pos + ll if ll is not None else self.get_length()
-    #  We have to allign with chunks we store. Position is the begginiing of the latest chunk that starts before or at our file
-    position = (file_begin // CHUNK_SIZE) * CHUNK_SIZE
-    response = b""
-    while True:
-      self._pos = position
-      chunk_number = self._pos / CHUNK_SIZE
-      file_name = hash_256(self._url) + "_" + str(chunk_number)
-      full_path = os.path.join(CACHE_DIR, str(file_name))
-      data = None
-      #  If we don't have a file, download it
-      if not os.path.exists(full_path):
-        data = self.read_aux(ll=CHUNK_SIZE)
-        with atomic_write_in_dir(full_path, mode="wb") as new_cached_file:
-          new_cached_file.write(data)
-      else:
-        with open(full_path, "rb") as cached_file:
-          data = cached_file.read()
-
-      response += data[max(0, file_begin - position): min(CHUNK_SIZE, file_end - position)]
-
-      position += CHUNK_SIZE
-      if position >= file_end:
-        self._pos = file_end
-        return response
+    length = self.get_length() - self._pos if ll is None else min(ll, self.get_length() - self._pos)
+    buf = bytearray(max(0, length))
+    self._readinto(buf)
+    return bytes(buf)
 
-  @retry(wait=wait_random_exponential(multiplier=1, max=5), stop=stop_after_attempt(3), reraise=True)
   def read_aux(self, ll=None):
+    ret = self._read_range(self._pos, ll)
+    self._pos += len(ret)
+    return ret
+
+  @retry(wait=wait_random_exponential(multiplier=1, max=5), stop=stop_after_attempt(3), reraise=True)
+  def _read_range(self, pos, ll=None):
     download_range = False
     headers = ["Connection: keep-alive"]
-    if self._pos != 0 or ll is not None:
-      end = (self._pos + ll if ll is not None else self.get_length()) - 1
-      headers.append(f"Range: bytes={self._pos}-{end}")
+    if pos != 0 or ll is not None:
+      end = (pos + ll if ll is not None else self.get_length()) - 1
+      headers.append(f"Range: bytes={pos}-{end}")
       download_range = True
 
     dats = BytesIO()
@@ -161,9 +276,7 @@ class URLFile(object):
     if (not download_range) and response_code != 200:  # OK
       raise Exception(f"Error {response_code} {headers} ({self._url}): {repr(dats.getvalue())[:500]}")
 
-    ret = dats.getvalue()
-    self._pos += len(ret)
-    return ret
+    return dats.getvalue()
 
   def seek(self, pos):
     self._pos = pos
@@ -188,6 +301,7 @@ class URLFile(object):
 
       self._local_file = local_file
       self.read = self._local_file.read
+      self.readinto = self._local_file.readinto
       self.seek = self._local_file.seek
 
     return self._local_file.name
@@ -1,29 +1,16 @@
 #!/usr/bin/env python3
 import os
 import sys
-import multiprocessing
 import subprocess
 import argparse
 from tempfile import NamedTemporaryFile
 
 from common.basedir import BASEDIR
-from selfdrive.test.process_replay.compare_logs import save_log
 from tools.lib.route import Route
-from tools.lib.logreader import LogReader
+from tools.lib.logreader import PrefetchLogIterator
 
 juggle_dir = os.path.dirname(os.path.realpath(__file__))
 
-def load_segment(segment_name):
-  print(f"Loading {segment_name}")
-  if segment_name is None:
-    return []
-
-  try:
-    return list(LogReader(segment_name))
-  except ValueError as e:
-    print(f"Error parsing {segment_name}: {e}")
-    return []
-
 def start_juggler(fn=None, dbc=None, layout=None):
   env = os.environ.copy()
   env["BASEDIR"] = BASEDIR
@@ -62,27 +49,25 @@ def juggle_route(route_name, segment_number, qlog, can, layout):
       print(f"Please try a different {'segment' if segment_number is not None else 'route'}")
       return
 
-  all_data = []
-  pool = multiprocessing.Pool(24)
-  for d in pool.map(load_segment, logs):
-    all_data += d
-
-  if not can:
-    all_data = [d for d in all_data if d.which() not in ['can', 'sendcan']]
+  tempfile = NamedTemporaryFile(suffix='.rlog', dir=juggle_dir)
 
-  # Infer DBC name from logs
   dbc = None
-  for cp in [m for m in all_data if m.which() == 'carParams']:
-    try:
-      DBC = __import__(f"selfdrive.car.{cp.carParams.carName}.values", fromlist=['DBC']).DBC
-      dbc = DBC[cp.carParams.carFingerprint]['pt']
-    except (ImportError, KeyError, AttributeError):
-      pass
-    break
-
-  tempfile = NamedTemporaryFile(suffix='.rlog', dir=juggle_dir)
-  save_log(tempfile.name, all_data, compress=False)
-  del all_data
+  found_car_params = False
+  for m in PrefetchLogIterator(logs):
+    if not can and m.which() in ['can', 'sendcan']:
+      continue
+
+    # Infer DBC name from logs
+    if not found_car_params and m.which() == 'carParams':
+      found_car_params = True
+      try:
+        DBC = __import__(f"selfdrive.car.{m.carParams.carName}.values", fromlist=['DBC']).DBC
+        dbc = DBC[m.carParams.carFingerprint]['pt']
+      except (ImportError, KeyError, AttributeError):
+        pass
+
+    tempfile.write(m.as_builder().to_bytes())
+  tempfile.flush()
 
   start_juggler(tempfile.name, dbc, layout)
 
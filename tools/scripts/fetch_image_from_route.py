@@ -2,8 +2,9 @@
 import sys
 
 if len(sys.argv) < 4:
-  print("%s <route> <segment> <frame number>" % sys.argv[0])
+  print("%s <route> <segment> <frame number> [downscale]" % sys.argv[0])
   print('example: ./fetch_image_from_route.py "02c45f73a2e5c6e9|2020-06-01--18-03-08" 3 500')
+  print("with a downscale factor, a thumbnail of the closest keyframe before the frame is saved")
   exit(0)
 
 import requests
@@ -16,6 +17,7 @@ jwt = get_token()
 route = sys.argv[1]
 segment = int(sys.argv[2])
 frame = int(sys.argv[3])
+downscale = int(sys.argv[4]) if len(sys.argv) > 4 else None
 
 url = 'https://api.commadotai.com/v1/route/'+sys.argv[1]+"/files"
 r = requests.get(url, headers={"Authorization": "JWT "+jwt})
@@ -26,11 +28,15 @@ cameras = r.json()['cameras']
 if segment >= len(cameras):
   raise Exception("segment %d not found, got %d segments" % (segment, len(cameras)))
 
-fr = FrameReader(cameras[segment])
+fr = FrameReader(cameras[segment], downscale=downscale or 1)
 if frame >= fr.frame_count:
   raise Exception("frame %d not found, got %d frames" % (frame, fr.frame_count))
 
-im = Image.fromarray(fr.get(frame, count=1, pix_fmt="rgb24")[0])
+if downscale:
+  frame, img = fr.get_keyframe(frame, pix_fmt="rgb24")
+else:
+  img = fr.get(frame, count=1, pix_fmt="rgb24")[0]
+im = Image.fromarray(img)
 fn = "uxxx_"+route.replace("|", "_")+"_%d_%d.png" % (segment, frame)
 im.save(fn)
 print("saved %s" % fn)